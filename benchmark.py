@@ -0,0 +1,215 @@
+"""
+Benchmark del sistema RAG
+Misura indicizzazione e query (latenza, time-to-first-token) contro il server
+OpenAI simulato di mock_openai_server.py e Qdrant in memoria, senza rete né costi.
+
+Uso:
+    python benchmark.py --profile realistic --documents 50 --queries 40 --concurrency 8
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+from mock_openai_server import PROFILES, MockOpenAIServer
+from rag_logic import RAGSystem, chunk_text, get_vector_size
+
+
+SAMPLE_QUERIES = [
+    "Cos'è DataPizza?",
+    "Come funziona il retrieval?",
+    "Quali sono i componenti principali della pipeline?",
+    "Come vengono indicizzati i documenti?",
+    "Che modello di embedding viene usato?",
+]
+
+
+def percentile(values, p):
+    """Percentile p (0-100) con interpolazione lineare"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * p / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def summarize(values):
+    """Statistiche riassuntive (ms) di una lista di misure"""
+    if not values:
+        return {}
+    return {
+        "mean": round(statistics.mean(values), 1),
+        "p50": round(percentile(values, 50), 1),
+        "p95": round(percentile(values, 95), 1),
+        "p99": round(percentile(values, 99), 1),
+        "max": round(max(values), 1),
+    }
+
+
+def build_corpus(path, documents, chunk_size, chunk_overlap):
+    """Crea un corpus sintetico replicando il documento di esempio"""
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    chunks = []
+    for doc_index in range(documents):
+        # Ogni copia è leggermente diversa, così non viene deduplicata
+        for chunk in chunk_text(f"[Documento {doc_index}]\n{text}", chunk_size, chunk_overlap):
+            chunks.append({"text": chunk, "document_id": f"doc_{doc_index}", "filename": f"doc_{doc_index}.txt"})
+    return chunks
+
+
+def run_indexing(rag_system, collection_name, chunks, args):
+    """Indicizza il corpus e restituisce le statistiche di throughput"""
+    rag_system.create_collection_if_not_exists(
+        collection_name, vector_size=get_vector_size(rag_system.embedding_model), recreate=True,
+        quantization=args.quantization, hnsw_m=args.hnsw_m, hnsw_ef_construct=args.hnsw_ef_construct,
+        on_disk=args.on_disk or None, on_disk_payload=args.on_disk or None, hybrid=args.hybrid
+    )
+    start = time.perf_counter()
+    indexed = rag_system.index_documents(
+        collection_name, chunks,
+        batch_size=args.batch_size,
+        max_concurrency=args.embedding_concurrency
+    )
+    elapsed = time.perf_counter() - start
+    return {
+        "chunks": indexed,
+        "seconds": round(elapsed, 3),
+        "chunks_per_second": round(indexed / elapsed, 1) if elapsed else None,
+    }
+
+
+async def run_queries(rag_system, collection_name, args):
+    """Esegue le query con la concorrenza richiesta e raccoglie le metriche"""
+    semaphore = asyncio.Semaphore(args.concurrency)
+    results = []
+
+    async def one_query(index):
+        question = SAMPLE_QUERIES[index % len(SAMPLE_QUERIES)]
+        async with semaphore:
+            metrics = None
+            async for _, _, chunk_metrics in rag_system.aquery_stream(
+                question, collection_name, k=args.k,
+                speculative_retrieval=args.speculative, include_metrics=True,
+                hnsw_ef=args.hnsw_ef, exact=args.exact,
+                search_options={"mmr_lambda": args.mmr_lambda}
+            ):
+                if chunk_metrics is not None:
+                    metrics = chunk_metrics
+            results.append(metrics)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one_query(i) for i in range(args.queries)))
+    elapsed = time.perf_counter() - start
+
+    spans = {}
+    for metrics in results:
+        for name, ms in metrics.spans.items():
+            spans.setdefault(name, []).append(ms)
+
+    return {
+        "queries": len(results),
+        "concurrency": args.concurrency,
+        "seconds": round(elapsed, 3),
+        "queries_per_second": round(len(results) / elapsed, 2) if elapsed else None,
+        "total_ms": summarize([m.total_ms for m in results]),
+        "time_to_first_token_ms": summarize(
+            [m.time_to_first_token_ms for m in results if m.time_to_first_token_ms is not None]
+        ),
+        "spans_ms": {name: summarize(values) for name, values in spans.items()},
+    }
+
+
+def print_report(report):
+    """Stampa il report in forma leggibile"""
+    indexing = report["indexing"]
+    print(f"\n📥 Indicizzazione: {indexing['chunks']} chunk in {indexing['seconds']}s "
+          f"({indexing['chunks_per_second']} chunk/s)")
+
+    queries = report["queries"]
+    print(f"💬 Query: {queries['queries']} in {queries['seconds']}s "
+          f"({queries['queries_per_second']} query/s, concorrenza {queries['concurrency']})")
+    print(f"   {'fase':<22}{'mean':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    rows = [("totale", queries["total_ms"]), ("time to first token", queries["time_to_first_token_ms"])]
+    rows += sorted(queries["spans_ms"].items())
+    for name, stats in rows:
+        if stats:
+            print(f"   {name:<22}" + "".join(f"{stats[key]:>9}" for key in ("mean", "p50", "p95", "p99", "max")))
+
+    server = report["server"]
+    print(f"🧪 Mock: {server['embeddings']} richieste di embedding ({server['embedding_inputs']} testi), "
+          f"{server['responses']} risposte, {server['errors']} errori simulati")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline del sistema RAG")
+    parser.add_argument("--profile", default="fast", choices=sorted(PROFILES))
+    parser.add_argument("--error-rate", type=float, default=None)
+    parser.add_argument("--document", default="sample_document.txt")
+    parser.add_argument("--documents", type=int, default=20, help="Copie del documento da indicizzare")
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--chunk-overlap", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--embedding-concurrency", type=int, default=4)
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--speculative", action="store_true", help="Usa il retrieval speculativo")
+    parser.add_argument("--quantization", default=None, choices=["scalar", "binary", "product"])
+    parser.add_argument("--hnsw-m", type=int, default=None)
+    parser.add_argument("--hnsw-ef-construct", type=int, default=None)
+    parser.add_argument("--hnsw-ef", type=int, default=None, help="ef di ricerca HNSW per le query")
+    parser.add_argument("--exact", action="store_true", help="Ricerca esatta, senza indice HNSW")
+    parser.add_argument("--hybrid", action="store_true", help="Ricerca ibrida BM25 + semantica")
+    parser.add_argument("--mmr-lambda", type=float, default=None,
+                        help="Diversifica i risultati con MMR (1 = solo rilevanza)")
+    parser.add_argument("--on-disk", action="store_true", help="Vettori originali e payload su disco")
+    parser.add_argument("--qdrant-host", default=None,
+                        help="Server Qdrant da usare al posto di Qdrant in memoria (host:porta)")
+    parser.add_argument("--grpc", action="store_true", help="Usa gRPC con il server Qdrant")
+    parser.add_argument("--grpc-port", type=int, default=6334)
+    parser.add_argument("--pool-size", type=int, default=None, help="Connessioni del pool verso Qdrant")
+    parser.add_argument("--qdrant-timeout", type=int, default=None, help="Timeout (s) delle richieste a Qdrant")
+    parser.add_argument("--json", dest="json_path", default=None, help="Salva il report in JSON")
+    args = parser.parse_args()
+
+    overrides = {}
+    if args.error_rate is not None:
+        overrides["error_rate"] = args.error_rate
+
+    with MockOpenAIServer(profile=args.profile, **overrides) as server:
+        print(f"🧪 Mock OpenAI su {server.base_url} (profilo: {args.profile})")
+        rag_system = RAGSystem(openai_api_key="mock-key", openai_base_url=server.base_url)
+        if args.qdrant_host:
+            host, _, port = args.qdrant_host.partition(":")
+            rag_system.initialize_qdrant(
+                use_memory=False, host=host, port=int(port or 6333),
+                prefer_grpc=args.grpc, grpc_port=args.grpc_port,
+                pool_size=args.pool_size, timeout=args.qdrant_timeout
+            )
+        else:
+            rag_system.initialize_qdrant(use_memory=True, storage_path=":memory:")
+        collection_name = "benchmark"
+
+        chunks = build_corpus(args.document, args.documents, args.chunk_size, args.chunk_overlap)
+        report = {
+            "profile": args.profile,
+            "indexing": run_indexing(rag_system, collection_name, chunks, args),
+            "queries": asyncio.run(run_queries(rag_system, collection_name, args)),
+            "quantization": rag_system.quantization_report(collection_name) if args.quantization else None,
+            "server": dict(server.stats),
+        }
+
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"💾 Report salvato in {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+Chunk Dedup Module
+Eliminazione dei chunk duplicati prima dell'embedding: duplicati esatti tramite
+hash del testo normalizzato e quasi-duplicati tramite MinHash con LSH
+"""
+
+import hashlib
+import re
+import zlib
+
+import numpy as np
+
+from embedding_cache import normalize_text
+
+
+# Primo di Mersenne 2^31 - 1: a * x resta sotto 2^63 per hash a 32 bit
+_MERSENNE_PRIME = np.uint64((1 << 31) - 1)
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def content_hash(text):
+    """
+    Hash del contenuto di un chunk (uguale per testi che differiscono solo negli spazi)
+
+    Args:
+        text: Testo del chunk
+
+    Returns:
+        Digest SHA-256 esadecimale del testo normalizzato
+    """
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+def _choose_bands(num_perm, threshold):
+    """Sceglie bande e righe LSH con soglia (1/b)^(1/r) più vicina a threshold"""
+    best = None
+    for bands in range(1, num_perm + 1):
+        if num_perm % bands:
+            continue
+        rows = num_perm // bands
+        error = abs((1 / bands) ** (1 / rows) - threshold)
+        if best is None or error < best[0]:
+            best = (error, bands, rows)
+    return best[1], best[2]
+
+
+class ChunkDeduplicator:
+    """Filtra in streaming i chunk duplicati o quasi duplicati, ricordando le fonti rappresentate"""
+
+    def __init__(self, threshold=0.9, num_perm=128, shingle_size=3, seed=42):
+        """
+        Args:
+            threshold: Similarità di Jaccard (stimata) oltre cui un chunk è un quasi-duplicato;
+                       None per rimuovere solo i duplicati esatti
+            num_perm: Numero di permutazioni MinHash
+            shingle_size: Numero di parole per shingle
+            seed: Seed delle permutazioni
+        """
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.bands, self.rows = _choose_bands(num_perm, threshold) if threshold else (0, 0)
+
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, int(_MERSENNE_PRIME), size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, int(_MERSENNE_PRIME), size=num_perm, dtype=np.uint64)
+
+        # Per ogni chunk tenuto si conserva solo {"content_hash", "sources", "duplicates"},
+        # non il testo: la memoria resta limitata anche su corpora grandi
+        self._by_hash = {}       # content_hash -> voce del chunk tenuto
+        self._signatures = []    # firme MinHash dei chunk tenuti
+        self._kept = []          # voci dei chunk tenuti, allineate a _signatures
+        self._buckets = {}       # (banda, valori) -> indici in _kept
+
+        self.stats = {"kept": 0, "exact_duplicates": 0, "near_duplicates": 0}
+
+    def signature(self, text):
+        """
+        Firma MinHash di un testo
+
+        Args:
+            text: Testo del chunk
+
+        Returns:
+            numpy.ndarray uint64 di lunghezza num_perm
+        """
+        words = _WORD_RE.findall(text.lower())
+        size = min(self.shingle_size, len(words)) or 1
+        shingles = {" ".join(words[i:i + size]) for i in range(max(1, len(words) - size + 1))}
+        hashes = np.fromiter(
+            (zlib.crc32(shingle.encode("utf-8")) for shingle in shingles),
+            dtype=np.uint64, count=len(shingles)
+        )
+        # (a * x + b) mod p per ogni permutazione e ogni shingle, poi minimo per riga
+        values = (np.outer(self._a, hashes) + self._b[:, None]) % _MERSENNE_PRIME
+        return values.min(axis=1)
+
+    def _find_near_duplicate(self, signature):
+        """Indice di un chunk tenuto simile alla firma, oppure None"""
+        candidates = set()
+        for band in range(self.bands):
+            key = (band, signature[band * self.rows:(band + 1) * self.rows].tobytes())
+            candidates.update(self._buckets.get(key, ()))
+        best, best_similarity = None, self.threshold
+        for index in candidates:
+            similarity = float(np.mean(self._signatures[index] == signature))
+            if similarity >= best_similarity:
+                best, best_similarity = index, similarity
+        return best
+
+    def _add(self, entry, signature):
+        """Registra la firma di un chunk tenuto nei bucket LSH"""
+        index = len(self._kept)
+        self._kept.append(entry)
+        self._signatures.append(signature)
+        for band in range(self.bands):
+            key = (band, signature[band * self.rows:(band + 1) * self.rows].tobytes())
+            self._buckets.setdefault(key, []).append(index)
+
+    @staticmethod
+    def _add_source(kept, duplicate):
+        """Registra un duplicato sulla voce del chunk tenuto"""
+        kept["duplicates"] = kept.get("duplicates", 0) + 1
+        source = duplicate.get("document_id")
+        if source is not None and source not in kept["sources"]:
+            kept["sources"].append(source)
+
+    def filter(self, chunks, on_duplicate=None):
+        """
+        Restituisce i soli chunk non duplicati, nell'ordine originale
+
+        Ogni chunk tenuto è un dizionario con "content_hash", "sources" (document_id
+        dei documenti che rappresenta, compreso il proprio) e "duplicates" (copie
+        rimosse). I duplicati di solito arrivano dopo il chunk tenuto: le fonti
+        complete sono in updated_chunks() al termine dell'iterazione.
+
+        Args:
+            chunks: Iterabile di chunk: stringhe o dizionari con chiave "text"
+            on_duplicate: Funzione chiamata con ogni chunk scartato (opzionale)
+
+        Yields:
+            Dizionari dei chunk tenuti
+        """
+        for chunk in chunks:
+            chunk = {"text": chunk} if isinstance(chunk, str) else dict(chunk)
+            digest = content_hash(chunk["text"])
+
+            kept = self._by_hash.get(digest)
+            if kept is not None:
+                self.stats["exact_duplicates"] += 1
+            elif self.threshold:
+                signature = self.signature(chunk["text"])
+                index = self._find_near_duplicate(signature)
+                if index is not None:
+                    kept = self._kept[index]
+                    self.stats["near_duplicates"] += 1
+
+            if kept is not None:
+                self._add_source(kept, chunk)
+                if on_duplicate:
+                    on_duplicate(chunk)
+                continue
+
+            entry = {
+                "content_hash": digest,
+                "sources": [chunk["document_id"]] if chunk.get("document_id") is not None else [],
+                "duplicates": 0,
+            }
+            chunk.update(content_hash=digest, sources=list(entry["sources"]), duplicates=0)
+            self._by_hash[digest] = entry
+            if self.threshold:
+                self._add(entry, signature)
+            self.stats["kept"] += 1
+            yield chunk
+
+    def updated_chunks(self):
+        """
+        Chunk tenuti che rappresentano almeno un duplicato
+
+        Returns:
+            Lista di dizionari {"content_hash", "sources", "duplicates"} con "duplicates" > 0
+        """
+        return [chunk for chunk in self._by_hash.values() if chunk["duplicates"]]
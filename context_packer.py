@@ -0,0 +1,153 @@
+"""
+Context Packer Module
+Assemblaggio del contesto per la generazione entro un budget di token: i chunk
+sovrapposti o contigui dello stesso documento vengono riuniti in un unico brano,
+e quando il budget è esaurito si scartano i brani meno rilevanti.
+"""
+
+from token_chunker import count_tokens, token_offsets
+
+
+def merge_overlapping(first, second, min_overlap=16):
+    """
+    Unisce due testi se uno contiene l'altro o se la fine del primo coincide con l'inizio del secondo
+
+    Args:
+        first: Testo che precede
+        second: Testo che segue
+        min_overlap: Caratteri minimi in comune per considerarli sovrapposti
+
+    Returns:
+        Testo unito, oppure None se non si sovrappongono
+    """
+    if second in first:
+        return first
+    if first in second:
+        return second
+    if len(second) < min_overlap:
+        return None
+    # La sovrapposizione più lunga è la prima occorrenza dell'inizio di second
+    # nella coda di first che prosegue fino alla fine di first
+    probe = second[:min_overlap]
+    index = first.find(probe, max(0, len(first) - len(second)))
+    while index >= 0:
+        if second.startswith(first[index:]):
+            return first[:index] + second
+        index = first.find(probe, index + 1)
+    return None
+
+
+def merge_positioned(first, second):
+    """
+    Unisce due brani di cui è nota la posizione nel documento, se si sovrappongono o si toccano
+
+    Args:
+        first: Brano {"text", "offset"}
+        second: Brano {"text", "offset"}
+
+    Returns:
+        Tuple (testo, offset) del brano unito, oppure None se c'è del testo tra i due
+    """
+    if second["offset"] < first["offset"]:
+        first, second = second, first
+    first_end = first["offset"] + len(first["text"])
+    if second["offset"] > first_end:
+        return None
+    tail = second["text"][first_end - second["offset"]:]
+    return first["text"] + tail, first["offset"]
+
+
+def _merge_into(spans, span, min_overlap):
+    """Unisce span a un brano dello stesso documento, se si sovrappongono; True se unito"""
+    for other in spans:
+        if other is span or other["document_id"] != span["document_id"]:
+            continue
+        if other["offset"] is not None and span["offset"] is not None:
+            # Posizioni note (chunk_offset): anche i chunk contigui senza overlap
+            merged = merge_positioned(other, span)
+            if merged is not None:
+                merged, other["offset"] = merged
+        else:
+            merged = merge_overlapping(other["text"], span["text"], min_overlap)
+            if merged is None:
+                merged = merge_overlapping(span["text"], other["text"], min_overlap)
+            if merged is not None:
+                # Il brano unito non ha più una posizione nota
+                other["offset"] = None
+        if merged is not None:
+            other["text"] = merged
+            other["rank"] = min(other["rank"], span["rank"])
+            other["chunks"] += span["chunks"]
+            return True
+    return False
+
+
+def merge_chunks(chunks, min_overlap=16):
+    """
+    Riunisce i chunk sovrapposti dello stesso documento in brani contigui
+
+    Se i chunk hanno la loro posizione nel documento ("offset") vengono riuniti
+    anche quelli contigui senza overlap; altrimenti la sovrapposizione viene
+    cercata nel testo (vedi merge_overlapping).
+
+    Args:
+        chunks: Dizionari {"text", "document_id", "offset" opzionale} ordinati per rilevanza
+        min_overlap: Caratteri minimi in comune per unire due chunk senza posizione
+
+    Returns:
+        Lista di brani {"text", "document_id", "offset", "rank", "chunks"} ordinata
+        per rilevanza: rank è la posizione del chunk più rilevante del brano,
+        chunks il numero di chunk riuniti
+    """
+    spans = []
+    for rank, chunk in enumerate(chunks):
+        span = {
+            "text": chunk["text"], "document_id": chunk.get("document_id"), "offset": chunk.get("offset"),
+            "rank": rank, "chunks": 1
+        }
+        if span["document_id"] is None or not _merge_into(spans, span, min_overlap):
+            spans.append(span)
+            continue
+        # Il brano allargato può ora toccarne un altro dello stesso documento
+        merged = True
+        while merged:
+            merged = False
+            for candidate in spans:
+                if candidate["document_id"] == span["document_id"] and _merge_into(spans, candidate, min_overlap):
+                    spans.remove(candidate)
+                    merged = True
+                    break
+    return sorted(spans, key=lambda span: span["rank"])
+
+
+def pack_context(chunks, max_tokens=None, model="gpt-4o-mini", min_overlap=16):
+    """
+    Sceglie i brani da mettere nel contesto entro il budget di token
+
+    I chunk sovrapposti o contigui dello stesso documento vengono riuniti (merge_chunks), poi
+    i brani entrano in ordine di rilevanza finché c'è spazio; quelli che non
+    entrano vengono scartati. Se nemmeno il brano più rilevante entra, viene troncato.
+
+    Args:
+        chunks: Dizionari {"text", "document_id", "offset" opzionale} ordinati per rilevanza
+        max_tokens: Budget di token del contesto (None = nessun limite)
+        model: Modello di cui usare il tokenizer
+        min_overlap: Caratteri minimi in comune per unire due chunk
+
+    Returns:
+        Lista dei brani tenuti, ordinata per rilevanza, ognuno con "tokens"
+    """
+    packed = []
+    used = 0
+    for span in merge_chunks(chunks, min_overlap):
+        span["tokens"] = count_tokens(span["text"], model)
+        if max_tokens is None or used + span["tokens"] <= max_tokens:
+            packed.append(span)
+            used += span["tokens"]
+        elif not packed:
+            offsets = token_offsets(span["text"], model)
+            span["text"] = span["text"][:offsets[max_tokens]] if max_tokens < len(offsets) else span["text"]
+            span["tokens"] = min(span["tokens"], max_tokens)
+            packed.append(span)
+            used += span["tokens"]
+    return packed
@@ -0,0 +1,186 @@
+"""
+Embedding Cache Module
+Cache persistente su disco (SQLite) degli embedding, indirizzata per contenuto
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+
+
+def normalize_text(text):
+    """
+    Normalizza un testo prima del calcolo della chiave di cache
+
+    Args:
+        text: Testo da normalizzare
+
+    Returns:
+        Testo in forma NFC con spazi consecutivi compressi
+    """
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def cache_key(text, model, dimensions=None):
+    """
+    Calcola la chiave di cache per (testo normalizzato, modello, dimensioni)
+
+    Args:
+        text: Testo del chunk o della query
+        model: Nome del modello di embedding
+        dimensions: Dimensione richiesta dei vettori (None = default del modello)
+
+    Returns:
+        Digest SHA-256 esadecimale
+    """
+    h = hashlib.sha256()
+    h.update(f"{model}\x00{dimensions or ''}\x00".encode("utf-8"))
+    h.update(normalize_text(text).encode("utf-8"))
+    return h.hexdigest()
+
+
+class EmbeddingCache:
+    """Cache degli embedding su SQLite con vettori float32 ed eviction LRU per dimensione"""
+
+    def __init__(self, path="./embedding_cache.sqlite", max_size_mb=512):
+        """
+        Apre (o crea) la cache
+
+        Args:
+            path: Percorso del file SQLite
+            max_size_mb: Dimensione massima dei vettori salvati, in MB; oltre questa
+                         soglia vengono rimossi gli embedding usati meno di recente
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.path = path
+        self.max_bytes = int(max_size_mb * 1024 * 1024)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key TEXT PRIMARY KEY,"
+            " vector BLOB NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " last_access REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings(last_access)"
+        )
+        self._conn.commit()
+        self._total_bytes = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM embeddings"
+        ).fetchone()[0]
+
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, texts, model, dimensions=None):
+        """
+        Recupera gli embedding presenti in cache
+
+        Args:
+            texts: Lista di testi
+            model: Nome del modello di embedding
+            dimensions: Dimensione richiesta dei vettori
+
+        Returns:
+            Lista allineata a texts con l'embedding oppure None se assente
+        """
+        keys = [cache_key(text, model, dimensions) for text in texts]
+        found = {}
+        with self._lock:
+            # SQLite limita il numero di parametri per query
+            unique_keys = list(dict.fromkeys(keys))
+            for start in range(0, len(unique_keys), 500):
+                part = unique_keys[start:start + 500]
+                placeholders = ",".join("?" * len(part))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", part
+                ).fetchall()
+                for key, blob in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    found[key] = vector.tolist()
+
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                    [(now, key) for key in found]
+                )
+                self._conn.commit()
+
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+
+        return [found.get(key) for key in keys]
+
+    def put_many(self, texts, embeddings, model, dimensions=None):
+        """
+        Salva gli embedding in cache
+
+        Args:
+            texts: Lista di testi
+            embeddings: Lista di embedding allineata a texts
+            model: Nome del modello di embedding
+            dimensions: Dimensione richiesta dei vettori
+        """
+        now = time.time()
+        # Un testo ripetuto occupa una sola riga: conta una volta nella dimensione della cache
+        rows = {}
+        for text, embedding in zip(texts, embeddings):
+            blob = array("f", embedding).tobytes()
+            key = cache_key(text, model, dimensions)
+            rows[key] = (key, blob, len(blob), now)
+        rows = list(rows.values())
+
+        with self._lock:
+            for key, _, size, _ in rows:
+                previous = self._conn.execute(
+                    "SELECT size FROM embeddings WHERE key = ?", (key,)
+                ).fetchone()
+                self._total_bytes += size - (previous[0] if previous else 0)
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, size, last_access) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            self._conn.commit()
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Rimuove gli embedding meno usati fino a scendere al 90% della dimensione massima"""
+        target = int(self.max_bytes * 0.9)
+        while self._total_bytes > target:
+            rows = self._conn.execute(
+                "SELECT key, size FROM embeddings ORDER BY last_access LIMIT 1000"
+            ).fetchall()
+            if not rows:
+                self._total_bytes = 0
+                break
+            to_delete = []
+            for key, size in rows:
+                to_delete.append((key,))
+                self._total_bytes -= size
+                if self._total_bytes <= target:
+                    break
+            self._conn.executemany("DELETE FROM embeddings WHERE key = ?", to_delete)
+        self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def close(self):
+        """Chiude la connessione al database"""
+        with self._lock:
+            self._conn.close()
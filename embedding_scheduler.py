@@ -0,0 +1,224 @@
+"""
+Embedding Scheduler Module
+Scheduler concorrente per le richieste di embedding, con rispetto dei limiti
+di richieste/token al minuto e backoff automatico su errori 429/5xx
+"""
+
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import openai
+
+
+def _default_token_counter(text):
+    """Stima grezza dei token (circa 4 caratteri per token)"""
+    return max(1, (len(text) + 3) // 4)
+
+
+def is_retryable_error(exc):
+    """
+    Indica se un errore dell'API di embedding va ritentato
+
+    Args:
+        exc: Eccezione sollevata dalla chiamata
+
+    Returns:
+        True per rate limit (429), errori del server (5xx), timeout e errori di connessione
+    """
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    if status is not None:
+        return status in (408, 409, 429) or status >= 500
+    return isinstance(exc, (openai.APIConnectionError, ConnectionError, TimeoutError))
+
+
+def _retry_after(exc):
+    """Legge l'header Retry-After (in secondi) dalla risposta di errore, se presente"""
+    headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is not None:
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    return None
+
+
+class EmbeddingScheduler:
+    """Esegue le richieste di embedding in parallelo mantenendo l'ordine dei batch"""
+
+    def __init__(self, embed_fn, max_concurrency=4, min_concurrency=1,
+                 requests_per_minute=3000, tokens_per_minute=1_000_000,
+                 max_retries=6, base_backoff=1.0, max_backoff=60.0,
+                 max_pending=None, token_counter=None):
+        """
+        Inizializza lo scheduler
+
+        Args:
+            embed_fn: Funzione che riceve una lista di testi e restituisce la lista di embedding
+            max_concurrency: Numero massimo di richieste contemporanee
+            min_concurrency: Numero minimo di richieste contemporanee dopo un rate limit
+            requests_per_minute: Budget di richieste al minuto (None = illimitato)
+            tokens_per_minute: Budget di token al minuto (None = illimitato)
+            max_retries: Numero massimo di tentativi per batch sugli errori ritentabili
+            base_backoff: Attesa iniziale (secondi) del backoff esponenziale
+            max_backoff: Attesa massima (secondi) tra due tentativi
+            max_pending: Numero massimo di batch completati in attesa di essere
+                         restituiti in ordine (default: 4 * max_concurrency)
+            token_counter: Funzione che stima i token di un testo
+        """
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency deve essere almeno 1")
+
+        self.embed_fn = embed_fn
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = max(1, min(min_concurrency, max_concurrency))
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.max_pending = max_pending or 4 * max_concurrency
+        self.token_counter = token_counter or _default_token_counter
+
+        # La concorrenza parte dal massimo e si adatta (AIMD) in base ai 429
+        self._concurrency = float(max_concurrency)
+        self._window = deque()  # (timestamp, token) delle richieste dell'ultimo minuto
+        self._window_tokens = 0
+        self._pause_until = 0.0
+        self._lock = threading.Lock()
+
+        self.stats = {"requests": 0, "retries": 0, "rate_limited": 0, "tokens": 0}
+
+    @property
+    def concurrency(self):
+        """Numero attuale di richieste contemporanee consentite"""
+        return max(self.min_concurrency, int(self._concurrency))
+
+    def _acquire(self, tokens):
+        """Attende finché la richiesta rientra nei budget al minuto e nella pausa globale"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._window and now - self._window[0][0] >= 60:
+                    _, old_tokens = self._window.popleft()
+                    self._window_tokens -= old_tokens
+
+                wait_for = self._pause_until - now
+                if wait_for <= 0:
+                    rpm_ok = self.requests_per_minute is None or len(self._window) < self.requests_per_minute
+                    # Una richiesta più grande dell'intero budget passa se la finestra è vuota
+                    tpm_ok = (self.tokens_per_minute is None or not self._window
+                              or self._window_tokens + tokens <= self.tokens_per_minute)
+                    if rpm_ok and tpm_ok:
+                        self._window.append((now, tokens))
+                        self._window_tokens += tokens
+                        self.stats["requests"] += 1
+                        self.stats["tokens"] += tokens
+                        return
+                    wait_for = self._window[0][0] + 60 - now
+            time.sleep(min(max(wait_for, 0.01), 1.0))
+
+    def _on_success(self):
+        """Incremento additivo della concorrenza"""
+        with self._lock:
+            self._concurrency = min(self.max_concurrency, self._concurrency + 1 / self._concurrency)
+
+    def _on_rate_limited(self, delay):
+        """Riduzione moltiplicativa della concorrenza e pausa globale delle nuove richieste"""
+        with self._lock:
+            self.stats["rate_limited"] += 1
+            self._concurrency = max(self.min_concurrency, self._concurrency / 2)
+            self._pause_until = max(self._pause_until, time.monotonic() + delay)
+
+    def _run_batch(self, batch):
+        """Esegue un batch con retry e backoff esponenziale (eseguito nei thread del pool)"""
+        tokens = sum(self.token_counter(text) for text in batch)
+        attempt = 0
+        while True:
+            self._acquire(tokens)
+            try:
+                embeddings = self.embed_fn(batch)
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable_error(e):
+                    raise
+                delay = _retry_after(e)
+                if delay is None:
+                    delay = min(self.max_backoff, self.base_backoff * (2 ** attempt))
+                    delay *= random.uniform(0.5, 1.0)  # jitter
+                attempt += 1
+                with self._lock:
+                    self.stats["retries"] += 1
+                if getattr(e, "status_code", None) == 429:
+                    self._on_rate_limited(delay)
+                time.sleep(delay)
+                continue
+
+            if len(embeddings) != len(batch):
+                raise ValueError(
+                    f"Numero di embedding non valido: attesi {len(batch)}, ricevuti {len(embeddings)}"
+                )
+            self._on_success()
+            return embeddings
+
+    def map(self, batches):
+        """
+        Esegue gli embedding di tutti i batch mantenendo N richieste in volo
+
+        I batch vengono letti dall'iterabile solo quando c'è spazio per nuove
+        richieste, quindi è possibile passare un generatore.
+
+        Args:
+            batches: Iterabile di liste di testi
+
+        Yields:
+            Tuple (batch, embeddings) nello stesso ordine dei batch in input
+        """
+        batch_iter = iter(batches)
+        exhausted = False
+        next_submit = 0
+        next_emit = 0
+        in_flight = {}
+        completed = {}
+
+        pool = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        try:
+            while True:
+                # Riempie la finestra di richieste in volo
+                while (not exhausted and len(in_flight) < self.concurrency
+                       and next_submit - next_emit < self.max_pending):
+                    try:
+                        batch = next(batch_iter)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    future = pool.submit(self._run_batch, batch)
+                    in_flight[future] = (next_submit, batch)
+                    next_submit += 1
+
+                # Restituisce i batch completati rispettando l'ordine originale
+                while next_emit in completed:
+                    yield completed.pop(next_emit)
+                    next_emit += 1
+
+                if not in_flight:
+                    if exhausted:
+                        break
+                    continue
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index, batch = in_flight.pop(future)
+                    completed[index] = (batch, future.result())
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,558 @@
+"""
+Flat Index Module
+Indice vettoriale piatto su disco: i vettori (normalizzati) stanno in una matrice
+.npy float32 o float16 aperta in memory-map, i payload in un file JSON Lines a
+parte. La ricerca è un prodotto matrice-vettore (BLAS) seguito da argpartition:
+nessun grafo da costruire e apertura immediata anche con centinaia di migliaia di chunk.
+"""
+
+import json
+import os
+import threading
+
+import numpy as np
+
+
+# Righe convertite a float32 per volta quando la matrice è float16
+_SEARCH_BLOCK_ROWS = 16_384
+_MIN_CAPACITY = 1024
+# Campi del payload indicizzati in memoria (valore -> ID): i filtri su questi
+# campi non leggono i payload, gli altri vengono verificati sul file dei payload
+INDEXED_FIELDS = ("document_id", "filename", "page", "tenant_id", "sources")
+
+
+def match_value(value, condition):
+    """
+    Verifica un valore del payload rispetto a una condizione di filtro
+
+    Come in Qdrant, un campo che contiene una lista soddisfa la condizione se
+    almeno uno dei suoi elementi la soddisfa.
+
+    Args:
+        value: Valore del campo nel payload (None se assente)
+        condition: Valore richiesto, lista di valori ammessi oppure dizionario
+                   di limiti {"gt", "gte", "lt", "lte"}
+
+    Returns:
+        True se il valore soddisfa la condizione
+    """
+    if value is None:
+        return False
+    if isinstance(value, list):
+        return any(match_value(item, condition) for item in value)
+    if isinstance(condition, dict):
+        try:
+            return (
+                ("gt" not in condition or value > condition["gt"])
+                and ("gte" not in condition or value >= condition["gte"])
+                and ("lt" not in condition or value < condition["lt"])
+                and ("lte" not in condition or value <= condition["lte"])
+            )
+        except TypeError:
+            return False
+    if isinstance(condition, (list, tuple, set, frozenset)):
+        return value in condition
+    return value == condition
+
+
+def filter_fields(key):
+    """Campi di una chiave di filtro: una tupla di campi è soddisfatta se lo è almeno uno"""
+    return key if isinstance(key, tuple) else (key,)
+
+
+def payload_matches(payload, filters):
+    """True se il payload soddisfa tutte le condizioni di filters (campo -> condizione)"""
+    return all(
+        any(match_value(payload.get(field), condition) for field in filter_fields(key))
+        for key, condition in filters.items()
+    )
+
+
+class FlatIndex:
+    """Indice vettoriale esatto (similarità coseno) su file in memory-map"""
+
+    def __init__(self, path, dimensions=None, dtype="float32", metadata=None):
+        """
+        Apre l'indice in path, creandolo se non esiste
+
+        Files nella cartella:
+            meta.json      dimensione, dtype, numero di righe, metadati
+            vectors.npy    matrice (capacità x dimensione) dei vettori normalizzati
+            offsets.npy    offset nel file dei payload di ogni riga (-1 = cancellata)
+            payloads.jsonl un record {"id", "payload"} per riga, in append
+
+        Args:
+            path: Cartella dell'indice
+            dimensions: Dimensione dei vettori (obbligatoria se l'indice non esiste)
+            dtype: "float32" oppure "float16" (metà memoria e disco, ma ricerca più
+                   lenta: i blocchi vanno convertiti in float32 prima del prodotto)
+            metadata: Metadati da salvare con un nuovo indice (es. modello di embedding)
+        """
+        self.path = path
+        self._meta_path = os.path.join(path, "meta.json")
+        self._vectors_path = os.path.join(path, "vectors.npy")
+        self._offsets_path = os.path.join(path, "offsets.npy")
+        self._payloads_path = os.path.join(path, "payloads.jsonl")
+        self._lock = threading.RLock()
+        # Mappe id -> riga, id -> valori dei campi indicizzati e campo -> valore -> id,
+        # costruite solo quando servono (scritture e filtri): la sola ricerca non
+        # legge i payload all'apertura
+        self._rows = None
+        self._point_fields = None
+        self._fields = None
+        # Incrementata da compact: le righe lette prima non sono più valide
+        self._generation = 0
+
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if dimensions is not None and dimensions != meta["dimensions"]:
+                raise ValueError(
+                    f"L'indice in {path} ha dimensione {meta['dimensions']}, richiesta {dimensions}"
+                )
+            self.dimensions = meta["dimensions"]
+            self.dtype = np.dtype(meta["dtype"])
+            self.metadata = meta.get("metadata", {})
+            self._size = meta["size"]
+            self._deleted = meta.get("deleted", 0)
+            self._vectors = np.load(self._vectors_path, mmap_mode="r+")
+            self._offsets = np.load(self._offsets_path, mmap_mode="r+")
+        else:
+            if dimensions is None:
+                raise ValueError(f"Indice non trovato in {path}: specifica dimensions per crearlo")
+            if np.dtype(dtype) not in (np.float32, np.float16):
+                raise ValueError("dtype deve essere 'float32' o 'float16'")
+            os.makedirs(path, exist_ok=True)
+            self.dimensions = dimensions
+            self.dtype = np.dtype(dtype)
+            self.metadata = dict(metadata or {})
+            self._size = 0
+            self._deleted = 0
+            self._vectors, self._offsets = self._allocate(_MIN_CAPACITY, self._vectors_path, self._offsets_path)
+            open(self._payloads_path, "ab").close()
+            self._save_meta()
+
+    def __len__(self):
+        """Numero di punti presenti (escluse le righe cancellate)"""
+        return self._size - self._deleted
+
+    def _allocate(self, capacity, vectors_path, offsets_path):
+        """Crea i file .npy di vettori e offset con la capacità indicata"""
+        vectors = np.lib.format.open_memmap(
+            vectors_path, mode="w+", dtype=self.dtype, shape=(capacity, self.dimensions)
+        )
+        offsets = np.lib.format.open_memmap(offsets_path, mode="w+", dtype=np.int64, shape=(capacity,))
+        offsets[:] = -1
+        return vectors, offsets
+
+    def _save_meta(self):
+        """Scrive meta.json in modo atomico (dopo vettori e payload)"""
+        meta = {
+            "dimensions": self.dimensions,
+            "dtype": self.dtype.name,
+            "size": self._size,
+            "deleted": self._deleted,
+            "metadata": self.metadata,
+        }
+        tmp_path = self._meta_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self._meta_path)
+
+    def _grow(self, needed):
+        """Raddoppia la capacità dei file .npy finché contiene needed righe"""
+        capacity = len(self._offsets)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        vectors, offsets = self._allocate(capacity, self._vectors_path + ".tmp", self._offsets_path + ".tmp")
+        vectors[:self._size] = self._vectors[:self._size]
+        offsets[:self._size] = self._offsets[:self._size]
+        vectors.flush()
+        offsets.flush()
+        del vectors, offsets
+        self._vectors = self._offsets = None
+        os.replace(self._vectors_path + ".tmp", self._vectors_path)
+        os.replace(self._offsets_path + ".tmp", self._offsets_path)
+        self._vectors = np.load(self._vectors_path, mmap_mode="r+")
+        self._offsets = np.load(self._offsets_path, mmap_mode="r+")
+
+    def _read_records(self, rows):
+        """Legge i record {"id", "payload"} delle righe indicate"""
+        records = []
+        offsets = self._offsets
+        with open(self._payloads_path, "rb") as f:
+            for row in rows:
+                f.seek(int(offsets[row]))
+                records.append(json.loads(f.readline()))
+        return records
+
+    def _append_records(self, records):
+        """Accoda i record al file dei payload e restituisce i loro offset"""
+        offsets = []
+        with open(self._payloads_path, "ab") as f:
+            for record in records:
+                offsets.append(f.tell())
+                f.write(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+        return offsets
+
+    def _load_lookup(self):
+        """Costruisce le mappe id -> riga e campo -> valore -> id leggendo i payload una volta"""
+        if self._rows is not None:
+            return
+        self._rows, self._point_fields = {}, {}
+        self._fields = {field: {} for field in INDEXED_FIELDS}
+        alive = np.flatnonzero(self._offsets[:self._size] >= 0)
+        for row, record in zip(alive, self._read_records(alive)):
+            self._remember(record["id"], int(row), record["payload"])
+
+    def _remember(self, point_id, row, payload):
+        """Registra un punto nelle mappe in memoria"""
+        self._rows[point_id] = row
+        values = {field: payload[field] for field in INDEXED_FIELDS if payload.get(field) is not None}
+        if values:
+            self._point_fields[point_id] = values
+            for field, value in values.items():
+                for item in (value if isinstance(value, list) else (value,)):
+                    self._fields[field].setdefault(item, set()).add(point_id)
+
+    def _forget(self, point_id):
+        """Toglie un punto dalle mappe in memoria"""
+        del self._rows[point_id]
+        for field, value in self._point_fields.pop(point_id, {}).items():
+            for item in (value if isinstance(value, list) else (value,)):
+                self._fields[field][item].discard(point_id)
+
+    def _is_indexed(self, key):
+        """True se tutti i campi della chiave di filtro sono in INDEXED_FIELDS"""
+        return all(field in self._fields for field in filter_fields(key))
+
+    def upsert(self, ids, vectors, payloads):
+        """
+        Inserisce o sostituisce dei punti
+
+        Args:
+            ids: Lista di ID (stringhe)
+            vectors: Vettori (lista di liste o matrice), normalizzati prima di essere salvati
+            payloads: Lista di dizionari JSON-serializzabili
+        """
+        matrix = np.asarray(vectors, dtype=np.float32).reshape(len(ids), self.dimensions)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix /= np.where(norms == 0, 1, norms)
+
+        with self._lock:
+            self._load_lookup()
+            rows = []
+            assigned = {}
+            for point_id in ids:
+                row = assigned.get(point_id, self._rows.get(point_id))
+                if row is None:
+                    row = self._size + len(assigned)
+                    assigned[point_id] = row
+                rows.append(row)
+            new_rows = len(assigned)
+            self._grow(self._size + new_rows)
+
+            offsets = self._append_records(
+                {"id": point_id, "payload": payload} for point_id, payload in zip(ids, payloads)
+            )
+            rows = np.asarray(rows, dtype=np.int64)
+            self._vectors[rows] = matrix.astype(self.dtype)
+            self._offsets[rows] = offsets
+            self._vectors.flush()
+            self._offsets.flush()
+            self._size += new_rows
+            self._save_meta()
+
+            for point_id, row, payload in zip(ids, rows, payloads):
+                if point_id in self._rows:
+                    self._forget(point_id)
+                self._remember(point_id, int(row), payload)
+
+    def set_payload(self, point_ids, payload):
+        """
+        Aggiorna (unisce) il payload di alcuni punti
+
+        Args:
+            point_ids: Lista di ID
+            payload: Chiavi da impostare nel payload
+        """
+        with self._lock:
+            self._load_lookup()
+            rows = [self._rows[point_id] for point_id in point_ids if point_id in self._rows]
+            if not rows:
+                return
+            records = self._read_records(rows)
+            for record in records:
+                record["payload"].update(payload)
+            self._offsets[rows] = self._append_records(records)
+            self._offsets.flush()
+            if any(field in payload for field in INDEXED_FIELDS):
+                for record, row in zip(records, rows):
+                    self._forget(record["id"])
+                    self._remember(record["id"], row, record["payload"])
+
+    def delete(self, point_ids):
+        """
+        Cancella dei punti (le righe vengono riutilizzate solo dopo compact)
+
+        Args:
+            point_ids: Lista di ID
+
+        Returns:
+            Numero di punti cancellati
+        """
+        with self._lock:
+            self._load_lookup()
+            deleted = 0
+            for point_id in point_ids:
+                row = self._rows.get(point_id)
+                if row is None:
+                    continue
+                self._offsets[row] = -1
+                self._forget(point_id)
+                deleted += 1
+            if deleted:
+                self._offsets.flush()
+                self._deleted += deleted
+                self._save_meta()
+                if self._deleted > max(_MIN_CAPACITY, len(self)):
+                    self.compact()
+            return deleted
+
+    def existing_ids(self, point_ids):
+        """
+        Args:
+            point_ids: Lista di ID
+
+        Returns:
+            Insieme degli ID presenti nell'indice
+        """
+        with self._lock:
+            self._load_lookup()
+            return {point_id for point_id in point_ids if point_id in self._rows}
+
+    def document_ids(self, document_id):
+        """
+        Args:
+            document_id: ID del documento
+
+        Returns:
+            Insieme degli ID dei punti con quel document_id nel payload
+        """
+        with self._lock:
+            self._load_lookup()
+            return set(self._fields["document_id"].get(document_id, ()))
+
+    def missing_field_ids(self, field):
+        """
+        Args:
+            field: Campo del payload tra INDEXED_FIELDS
+
+        Returns:
+            Insieme degli ID dei punti senza quel campo nel payload
+        """
+        with self._lock:
+            self._load_lookup()
+            return {point_id for point_id in self._rows if field not in self._point_fields.get(point_id, {})}
+
+    def field_values(self, field, filters=None):
+        """
+        Args:
+            field: Campo del payload tra INDEXED_FIELDS
+            filters: Considera solo i punti che soddisfano i filtri (es. di un tenant)
+
+        Returns:
+            Insieme dei valori del campo presenti in almeno un punto
+        """
+        with self._lock:
+            self._load_lookup()
+            ids = self.point_ids(filters) if filters else None
+            return {
+                value for value, point_ids in self._fields[field].items()
+                if point_ids and (ids is None or not point_ids.isdisjoint(ids))
+            }
+
+    def _indexed_ids(self, filters):
+        """ID che soddisfano le condizioni sui campi indicizzati (None se non ce ne sono)"""
+        self._load_lookup()
+        ids = None
+        for key, condition in filters.items():
+            if not self._is_indexed(key):
+                continue
+            matching = set()
+            for field in filter_fields(key):
+                for value, point_ids in self._fields[field].items():
+                    if match_value(value, condition):
+                        matching |= point_ids
+            ids = matching if ids is None else ids & matching
+        return ids
+
+    def point_ids(self, filters):
+        """
+        Args:
+            filters: Dizionario campo -> condizione (vedi match_value)
+
+        Returns:
+            Insieme degli ID dei punti il cui payload soddisfa i filtri
+        """
+        with self._lock:
+            ids = self._indexed_ids(filters)
+            if ids is not None and all(self._is_indexed(key) for key in filters):
+                return ids
+            return {record["id"] for record in self._read_records(self.filter_rows(filters))}
+
+    def filter_rows(self, filters):
+        """
+        Righe dei punti il cui payload soddisfa i filtri
+
+        Le condizioni sui campi di INDEXED_FIELDS usano le mappe in memoria; le
+        altre vengono verificate leggendo i payload delle sole righe già selezionate.
+
+        Args:
+            filters: Dizionario campo -> condizione (vedi match_value)
+
+        Returns:
+            numpy.ndarray ordinato delle righe
+        """
+        with self._lock:
+            ids = self._indexed_ids(filters)
+            if ids is None:
+                rows = np.flatnonzero(self._offsets[:self._size] >= 0)
+            else:
+                rows = np.sort(np.fromiter((self._rows[point_id] for point_id in ids), dtype=np.int64, count=len(ids)))
+            others = {key: condition for key, condition in filters.items() if not self._is_indexed(key)}
+            if others and len(rows):
+                keep = [payload_matches(record["payload"], others) for record in self._read_records(rows)]
+                rows = rows[np.asarray(keep, dtype=bool)]
+            return rows
+
+    def retrieve(self, point_ids):
+        """
+        Args:
+            point_ids: Lista di ID
+
+        Returns:
+            Lista di tuple (id, payload) per gli ID presenti
+        """
+        with self._lock:
+            self._load_lookup()
+            rows = [self._rows[point_id] for point_id in point_ids if point_id in self._rows]
+            return [(record["id"], record["payload"]) for record in self._read_records(rows)]
+
+    def scores(self, query_vector, rows=None):
+        """
+        Similarità coseno della query con tutte le righe (-inf per le righe cancellate)
+
+        Args:
+            query_vector: Vettore della query
+            rows: Righe da confrontare (None = tutte), es. da filter_rows
+
+        Returns:
+            Tuple (numpy.ndarray float32 con uno score per riga, o per ognuna di
+            rows, generazione dell'indice)
+        """
+        query = np.asarray(query_vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+        with self._lock:
+            size, vectors, offsets, deleted = self._size, self._vectors, self._offsets, self._deleted
+            generation = self._generation
+
+        if rows is not None:
+            # Solo le righe selezionate: vengono lette (e convertite) solo quelle
+            return vectors[rows].astype(np.float32, copy=False) @ query, generation
+        if vectors.dtype == np.float32:
+            # Un solo prodotto matrice-vettore BLAS sulla memory-map
+            scores = vectors[:size] @ query
+        else:
+            # BLAS non lavora in float16: si converte un blocco di righe per volta
+            # in un buffer riutilizzato (la conversione domina il tempo di ricerca)
+            scores = np.empty(size, dtype=np.float32)
+            buffer = np.empty((min(_SEARCH_BLOCK_ROWS, size), self.dimensions), dtype=np.float32)
+            for start in range(0, size, _SEARCH_BLOCK_ROWS):
+                block = vectors[start:min(start + _SEARCH_BLOCK_ROWS, size)]
+                np.copyto(buffer[:len(block)], block)
+                np.matmul(buffer[:len(block)], query, out=scores[start:start + len(block)])
+        if deleted:
+            scores[offsets[:size] < 0] = -np.inf
+        return scores, generation
+
+    def search(self, query_vector, k=10, with_vectors=False, filters=None):
+        """
+        Restituisce i k punti più simili alla query
+
+        Args:
+            query_vector: Vettore della query
+            k: Numero di risultati
+            with_vectors: Se True, restituisce anche i vettori (normalizzati, float32)
+            filters: Condizioni sul payload (campo -> condizione, vedi match_value):
+                     vengono confrontate con la query solo le righe che le soddisfano
+
+        Returns:
+            Lista di tuple (id, score, payload), o (id, score, payload, vettore) se
+            with_vectors, ordinate per score decrescente
+        """
+        while True:
+            with self._lock:
+                rows = self.filter_rows(filters) if filters else None
+                generation = self._generation
+            scores, _ = self.scores(query_vector, rows)
+            k = min(k, len(scores))
+            if k <= 0:
+                return []
+            if k < len(scores):
+                top = np.argpartition(-scores, k - 1)[:k]
+            else:
+                top = np.arange(len(scores))
+            top = top[np.argsort(-scores[top], kind="stable")]
+            top = top[np.isfinite(scores[top])]
+            top_rows = top if rows is None else rows[top]
+            with self._lock:
+                # Un compact nel frattempo ha spostato le righe: si ripete la ricerca
+                if generation == self._generation:
+                    records = self._read_records(top_rows)
+                    vectors = self._vectors[top_rows].astype(np.float32) if with_vectors else None
+                    break
+        results = [(record["id"], float(scores[index]), record["payload"]) for index, record in zip(top, records)]
+        if with_vectors:
+            return [result + (vector,) for result, vector in zip(results, vectors)]
+        return results
+
+    def update_metadata(self, metadata):
+        """Unisce metadata ai metadati dell'indice"""
+        with self._lock:
+            self.metadata.update(metadata)
+            self._save_meta()
+
+    def compact(self):
+        """Riscrive vettori e payload senza le righe cancellate e le versioni superate dei payload"""
+        with self._lock:
+            alive = np.flatnonzero(self._offsets[:self._size] >= 0)
+            records = self._read_records(alive)
+            capacity = max(_MIN_CAPACITY, len(alive))
+            vectors, offsets = self._allocate(capacity, self._vectors_path + ".tmp", self._offsets_path + ".tmp")
+            vectors[:len(alive)] = self._vectors[alive]
+
+            payloads_tmp = self._payloads_path + ".tmp"
+            with open(payloads_tmp, "wb") as f:
+                for row, record in enumerate(records):
+                    offsets[row] = f.tell()
+                    f.write(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+            vectors.flush()
+            offsets.flush()
+            del vectors, offsets
+            self._vectors = self._offsets = None
+
+            os.replace(self._vectors_path + ".tmp", self._vectors_path)
+            os.replace(self._offsets_path + ".tmp", self._offsets_path)
+            os.replace(payloads_tmp, self._payloads_path)
+            self._vectors = np.load(self._vectors_path, mmap_mode="r+")
+            self._offsets = np.load(self._offsets_path, mmap_mode="r+")
+            self._size = len(alive)
+            self._deleted = 0
+            self._save_meta()
+            self._generation += 1
+            self._rows = self._point_fields = self._fields = None
@@ -0,0 +1,712 @@
+"""
+Ingestion Queue Module
+Indicizzazione in background: una coda persistente di job su SQLite e dei worker
+che li eseguono (estrazione → chunking → embedding → upsert) fuori dalla sessione
+Streamlit. Dopo ogni blocco di points scritto il job registra un checkpoint, così
+dopo un errore o un riavvio riprende dal primo chunk non ancora indicizzato.
+
+Uso (worker in processi separati, con un server Qdrant):
+    OPENAI_API_KEY=... python ingestion_queue.py --workers 2 --qdrant-host localhost:6333
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from rag_logic import RAGSystem, iter_uploaded_documents
+
+
+# Stati di un job: queued -> running -> done; un job fallito torna in coda
+# finché non esaurisce i tentativi, poi resta failed (vedi IngestionQueue.fail)
+JOB_STATUSES = ("queued", "running", "done", "failed", "cancelled")
+
+
+class JobCancelled(Exception):
+    """Il job è stato annullato (o assegnato a un altro worker) durante l'esecuzione"""
+
+
+class WorkerStopped(Exception):
+    """Il worker è stato fermato durante l'esecuzione di un job"""
+
+
+class StoredUpload:
+    """File caricato salvato su disco, con l'interfaccia dei file di Streamlit usata da rag_logic"""
+
+    def __init__(self, path, name, type=None):
+        """
+        Args:
+            path: Percorso del file salvato
+            name: Nome originale del file (diventa il document_id dei chunk)
+            type: MIME type originale (es. "application/pdf")
+        """
+        self.path = path
+        self.name = name
+        self.type = type
+        self._file = open(path, "rb")
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def seek(self, offset, whence=0):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def getvalue(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def close(self):
+        self._file.close()
+
+
+class IngestionQueue:
+    """Coda dei job di indicizzazione su SQLite, condivisibile da più thread e processi"""
+
+    def __init__(self, path="./ingestion_jobs.sqlite", uploads_dir="./ingestion_uploads", max_attempts=3):
+        """
+        Apre (o crea) la coda
+
+        Args:
+            path: Percorso del file SQLite dei job
+            uploads_dir: Cartella in cui vengono copiati i file dei job in attesa
+            max_attempts: Tentativi di un job prima di considerarlo fallito
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        if not os.path.exists(uploads_dir):
+            os.makedirs(uploads_dir)
+
+        self.path = path
+        self.uploads_dir = uploads_dir
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        # API key dei job inviati da questo processo: restano solo in memoria, mai nel database
+        self._api_keys = {}
+        # Transazioni esplicite: BEGIN IMMEDIATE serializza le assegnazioni tra processi
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY,"
+            " status TEXT NOT NULL,"
+            " collection_name TEXT NOT NULL,"
+            " tenant_id TEXT,"
+            " settings TEXT NOT NULL,"
+            " chunks_done INTEGER NOT NULL DEFAULT 0,"
+            " stats TEXT,"
+            " error TEXT,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " worker_id TEXT,"
+            " heartbeat REAL,"
+            " created_at REAL NOT NULL,"
+            " started_at REAL,"
+            " finished_at REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, created_at)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS job_files ("
+            " job_id TEXT NOT NULL,"
+            " position INTEGER NOT NULL,"
+            " name TEXT NOT NULL,"
+            " type TEXT,"
+            " path TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " PRIMARY KEY (job_id, position))"
+        )
+
+    def _execute(self, sql, params=()):
+        """Esegue una singola istruzione (in autocommit)"""
+        with self._lock:
+            return self._conn.execute(sql, params)
+
+    def submit(self, files, collection_name, settings=None, openai_api_key=None):
+        """
+        Mette in coda l'indicizzazione di un gruppo di file
+
+        I file vengono copiati in uploads_dir: il job non dipende più dalla
+        sessione che l'ha inviato.
+
+        Args:
+            files: File caricati (con name, type e getvalue() o read())
+            collection_name: Collection in cui indicizzare
+            settings: Impostazioni del job, salvate in chiaro (vedi IngestionWorker.process):
+                      modello e dimensione di embedding, tenant_id, parametri di
+                      chunking, deduplicate, parallel, collection_options, backend
+            openai_api_key: API key per i worker di questo processo (non viene salvata)
+
+        Returns:
+            ID del job
+        """
+        settings = dict(settings or {})
+        job_id = uuid.uuid4().hex
+        job_dir = os.path.join(self.uploads_dir, job_id)
+        os.makedirs(job_dir)
+
+        file_rows = []
+        for position, uploaded_file in enumerate(files):
+            data = uploaded_file.getvalue() if hasattr(uploaded_file, "getvalue") else uploaded_file.read()
+            # Il nome originale resta solo nel database: su disco un nome sicuro
+            path = os.path.join(job_dir, f"{position:05d}")
+            with open(path, "wb") as f:
+                f.write(data)
+            file_rows.append((job_id, position, uploaded_file.name, getattr(uploaded_file, "type", None),
+                              path, len(data)))
+
+        if openai_api_key:
+            self._api_keys[job_id] = openai_api_key
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT INTO jobs (id, status, collection_name, tenant_id, settings, created_at)"
+                    " VALUES (?, 'queued', ?, ?, ?, ?)",
+                    (job_id, collection_name, settings.get("tenant_id"), json.dumps(settings), time.time())
+                )
+                self._conn.executemany("INSERT INTO job_files VALUES (?, ?, ?, ?, ?, ?)", file_rows)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                shutil.rmtree(job_dir, ignore_errors=True)
+                raise
+        print(f"📬 Job {job_id[:8]} in coda: {len(file_rows)} file per '{collection_name}'")
+        return job_id
+
+    def claim(self, worker_id, stale_after=60):
+        """
+        Assegna a un worker il job in attesa più vecchio
+
+        Un job "running" il cui worker non dà segni di vita da stale_after secondi
+        (processo terminato, riavvio del server) torna assegnabile e riprende
+        dal suo ultimo checkpoint.
+
+        Args:
+            worker_id: Identificativo del worker
+            stale_after: Secondi senza heartbeat dopo cui un job in esecuzione è abbandonato
+
+        Returns:
+            Dizionario del job (vedi status), oppure None se non c'è nulla da fare
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # I job abbandonati troppe volte non vengono più ripresi
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'failed', finished_at = ?,"
+                    " error = COALESCE(error, 'Worker interrotto durante l''esecuzione')"
+                    " WHERE status = 'running' AND heartbeat < ? AND attempts >= ?",
+                    (now, now - stale_after, self.max_attempts)
+                )
+                row = self._conn.execute(
+                    "SELECT id FROM jobs WHERE status = 'queued'"
+                    " OR (status = 'running' AND heartbeat < ?)"
+                    " ORDER BY created_at LIMIT 1",
+                    (now - stale_after,)
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'running', worker_id = ?, heartbeat = ?,"
+                        " started_at = COALESCE(started_at, ?), attempts = attempts + 1 WHERE id = ?",
+                        (worker_id, now, now, row[0])
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return self.status(row[0]) if row is not None else None
+
+    def heartbeat(self, job_id, worker_id):
+        """
+        Segnala che il worker sta ancora eseguendo il job
+
+        Returns:
+            False se il job non è più assegnato al worker (annullato o ripreso da un altro)
+        """
+        cursor = self._execute(
+            "UPDATE jobs SET heartbeat = ? WHERE id = ? AND worker_id = ? AND status = 'running'",
+            (time.time(), job_id, worker_id)
+        )
+        return cursor.rowcount == 1
+
+    def checkpoint(self, job_id, worker_id, chunks_done, stats=None):
+        """
+        Registra i chunk completati del job (da cui riprendere dopo un'interruzione)
+
+        Args:
+            job_id: ID del job
+            worker_id: Worker a cui è assegnato
+            chunks_done: Numero di chunk già scritti nella collection
+            stats: Statistiche di indicizzazione correnti
+
+        Returns:
+            False se il job non è più assegnato al worker (va interrotto)
+        """
+        cursor = self._execute(
+            "UPDATE jobs SET chunks_done = ?, stats = ?, heartbeat = ?"
+            " WHERE id = ? AND worker_id = ? AND status = 'running'",
+            (chunks_done, json.dumps(stats) if stats is not None else None, time.time(), job_id, worker_id)
+        )
+        return cursor.rowcount == 1
+
+    def finish(self, job_id, worker_id, stats=None):
+        """Segna il job come completato e rimuove i suoi file"""
+        cursor = self._execute(
+            "UPDATE jobs SET status = 'done', stats = ?, error = NULL, finished_at = ?"
+            " WHERE id = ? AND worker_id = ? AND status = 'running'",
+            (json.dumps(stats) if stats is not None else None, time.time(), job_id, worker_id)
+        )
+        if cursor.rowcount == 1:
+            self._remove_files(job_id)
+        return cursor.rowcount == 1
+
+    def fail(self, job_id, worker_id, error):
+        """
+        Registra l'errore di un job: torna in coda (dal suo checkpoint) finché
+        non esaurisce i tentativi, poi resta "failed" con i suoi file (vedi retry)
+
+        Returns:
+            Nuovo stato del job
+        """
+        cursor = self._execute(
+            "UPDATE jobs SET error = ?, worker_id = NULL,"
+            " status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END,"
+            " finished_at = CASE WHEN attempts >= ? THEN ? ELSE NULL END"
+            " WHERE id = ? AND worker_id = ? AND status = 'running'",
+            (error, self.max_attempts, self.max_attempts, time.time(), job_id, worker_id)
+        )
+        if cursor.rowcount == 0:
+            return None
+        return self._execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+
+    def release(self, job_id, worker_id):
+        """Rimette in coda un job interrotto dall'arresto del worker, senza contare il tentativo"""
+        cursor = self._execute(
+            "UPDATE jobs SET status = 'queued', worker_id = NULL, attempts = MAX(attempts - 1, 0)"
+            " WHERE id = ? AND worker_id = ? AND status = 'running'",
+            (job_id, worker_id)
+        )
+        return cursor.rowcount == 1
+
+    def retry(self, job_id, openai_api_key=None):
+        """
+        Rimette in coda un job fallito, dal suo ultimo checkpoint
+
+        Args:
+            job_id: ID del job
+            openai_api_key: API key per i worker di questo processo (es. dopo un riavvio
+                            del server, quando quella dell'invio non è più in memoria)
+
+        Returns:
+            True se il job è stato rimesso in coda
+        """
+        if openai_api_key:
+            self._api_keys[job_id] = openai_api_key
+        cursor = self._execute(
+            "UPDATE jobs SET status = 'queued', attempts = 0, error = NULL, finished_at = NULL"
+            " WHERE id = ? AND status = 'failed'",
+            (job_id,)
+        )
+        return cursor.rowcount == 1
+
+    def cancel(self, job_id):
+        """
+        Annulla un job in coda o in esecuzione (il worker si ferma al checkpoint
+        successivo; i chunk già scritti restano nella collection)
+
+        Returns:
+            True se il job è stato annullato
+        """
+        cursor = self._execute(
+            "UPDATE jobs SET status = 'cancelled', finished_at = ?"
+            " WHERE id = ? AND status IN ('queued', 'running', 'failed')",
+            (time.time(), job_id)
+        )
+        if cursor.rowcount == 1:
+            self._remove_files(job_id)
+            self._api_keys.pop(job_id, None)
+        return cursor.rowcount == 1
+
+    def _remove_files(self, job_id):
+        """Rimuove i file salvati di un job concluso"""
+        shutil.rmtree(os.path.join(self.uploads_dir, job_id), ignore_errors=True)
+
+    def api_key(self, job_id):
+        """API key con cui è stato inviato il job, se inviato da questo processo"""
+        return self._api_keys.get(job_id)
+
+    def files(self, job_id):
+        """
+        Apre i file di un job nell'ordine in cui sono stati caricati
+
+        Returns:
+            Lista di StoredUpload (da chiudere dopo l'uso)
+        """
+        rows = self._execute(
+            "SELECT path, name, type FROM job_files WHERE job_id = ? ORDER BY position", (job_id,)
+        ).fetchall()
+        return [StoredUpload(path, name, type) for path, name, type in rows]
+
+    @staticmethod
+    def _row_to_job(row):
+        """Converte una riga della tabella jobs in dizionario"""
+        job = dict(zip(
+            ("id", "status", "collection_name", "tenant_id", "settings", "chunks_done", "stats", "error",
+             "attempts", "worker_id", "heartbeat", "created_at", "started_at", "finished_at"),
+            row
+        ))
+        job["settings"] = json.loads(job["settings"])
+        job["stats"] = json.loads(job["stats"]) if job["stats"] else None
+        return job
+
+    def status(self, job_id):
+        """
+        Stato di un job, da interrogare periodicamente (es. dalla UI)
+
+        Returns:
+            Dizionario con le colonne del job (settings e stats decodificati) e
+            "files" (lista di {"name", "size"}), oppure None se il job non esiste
+        """
+        row = self._execute(
+            "SELECT id, status, collection_name, tenant_id, settings, chunks_done, stats, error,"
+            " attempts, worker_id, heartbeat, created_at, started_at, finished_at"
+            " FROM jobs WHERE id = ?",
+            (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        job = self._row_to_job(row)
+        job["files"] = [
+            {"name": name, "size": size}
+            for name, size in self._execute(
+                "SELECT name, size FROM job_files WHERE job_id = ? ORDER BY position", (job_id,)
+            ).fetchall()
+        ]
+        return job
+
+    def jobs(self, limit=20, tenant_id=None, collection_name=None):
+        """
+        Job più recenti, dal più nuovo
+
+        Args:
+            limit: Numero massimo di job
+            tenant_id: Solo i job di questo tenant (None = tutti)
+            collection_name: Solo i job di questa collection (None = tutte)
+
+        Returns:
+            Lista di dizionari del job (vedi status)
+        """
+        conditions, params = [], []
+        if tenant_id is not None:
+            conditions.append("tenant_id = ?")
+            params.append(tenant_id)
+        if collection_name is not None:
+            conditions.append("collection_name = ?")
+            params.append(collection_name)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self._execute(
+            f"SELECT id FROM jobs{where} ORDER BY created_at DESC LIMIT ?", (*params, limit)
+        ).fetchall()
+        return [job for job in (self.status(job_id) for job_id, in rows) if job is not None]
+
+    def close(self):
+        """Chiude la connessione al database"""
+        with self._lock:
+            self._conn.close()
+
+
+class IngestionWorker:
+    """Esegue i job della coda uno alla volta, con heartbeat e checkpoint"""
+
+    def __init__(self, queue, openai_api_key=None, openai_base_url=None, embedding_cache_path=None,
+                 backend=None, worker_id=None, poll_interval=1.0, stale_after=60, upsert_batch_size=64):
+        """
+        Args:
+            queue: IngestionQueue da cui prendere i job
+            openai_api_key: API key per i job senza una propria (None = OPENAI_API_KEY)
+            openai_base_url: URL base dell'API OpenAI (None = default di RAGSystem)
+            embedding_cache_path: Cache SQLite degli embedding (None = disattivata)
+            backend: Backend dei job che non ne specificano uno (vedi _initialize_backend)
+            worker_id: Identificativo del worker (default: host, pid e suffisso casuale)
+            poll_interval: Secondi di attesa quando la coda è vuota
+            stale_after: Secondi senza heartbeat dopo cui un job è considerato abbandonato
+            upsert_batch_size: Points per upsert, e quindi chunk tra due checkpoint
+        """
+        self.queue = queue
+        self.openai_api_key = openai_api_key or os.environ.get("OPENAI_API_KEY")
+        self.openai_base_url = openai_base_url
+        self.embedding_cache_path = embedding_cache_path
+        self.backend = backend or {"type": "qdrant"}
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.upsert_batch_size = upsert_batch_size
+        # Un RAGSystem per configurazione di embedding, tenant e backend
+        self._systems = {}
+        self._stop_event = threading.Event()
+
+    def run(self, stop_event=None):
+        """
+        Esegue i job finché stop_event non viene impostato
+
+        Args:
+            stop_event: threading.Event (o multiprocessing.Event) per fermare il worker
+        """
+        stop_event = self._stop_event = stop_event or threading.Event()
+        print(f"👷 Worker di indicizzazione {self.worker_id} avviato")
+        while not stop_event.is_set():
+            job = self.queue.claim(self.worker_id, self.stale_after)
+            if job is None:
+                stop_event.wait(self.poll_interval)
+                continue
+            self.process(job)
+        print(f"👷 Worker di indicizzazione {self.worker_id} fermato")
+
+    def process(self, job):
+        """
+        Esegue un job assegnato a questo worker, dal suo ultimo checkpoint
+
+        Args:
+            job: Dizionario del job restituito da IngestionQueue.claim
+        """
+        job_id = job["id"]
+        resume = f" (ripresa dal chunk {job['chunks_done']})" if job["chunks_done"] else ""
+        print(f"⚙️ Job {job_id[:8]}: tentativo {job['attempts']}{resume}")
+
+        stop_heartbeat = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job_id, stop_heartbeat), daemon=True)
+        heartbeat.start()
+        files = []
+        try:
+            rag_system = self._rag_system(job)
+            settings = job["settings"]
+            rag_system.create_collection_if_not_exists(
+                job["collection_name"], **settings.get("collection_options", {})
+            )
+            files = self.queue.files(job_id)
+
+            def checkpoint(chunks_done, stats):
+                if not self.queue.checkpoint(job_id, self.worker_id, chunks_done, stats):
+                    raise JobCancelled(job_id)
+                if self._stop_event.is_set():
+                    raise WorkerStopped(job_id)
+
+            chunks = iter_uploaded_documents(
+                files,
+                chunk_size=settings.get("chunk_size", 500),
+                chunk_overlap=settings.get("chunk_overlap", 50),
+                # I processi daemon non possono avviare il pool di estrazione
+                parallel=settings.get("parallel", False) and not multiprocessing.current_process().daemon,
+                token_chunking=settings.get("token_chunking", False),
+                embedding_model=rag_system.embedding_model
+            )
+            rag_system.index_documents(
+                job["collection_name"], chunks,
+                deduplicate=settings.get("deduplicate", False),
+                upsert_batch_size=self.upsert_batch_size,
+                resume_from=job["chunks_done"],
+                checkpoint_callback=checkpoint
+            )
+            if self.queue.finish(job_id, self.worker_id, rag_system.last_index_stats):
+                print(f"✅ Job {job_id[:8]} completato")
+        except JobCancelled:
+            print(f"🛑 Job {job_id[:8]} annullato")
+        except WorkerStopped:
+            # Riprenderà dal checkpoint appena registrato
+            self.queue.release(job_id, self.worker_id)
+            print(f"⏸️ Job {job_id[:8]} rimesso in coda")
+        except Exception as e:
+            status = self.queue.fail(job_id, self.worker_id, f"{type(e).__name__}: {e}")
+            if status == "queued":
+                print(f"⚠️ Job {job_id[:8]} fallito, verrà ripreso dal checkpoint: {e}")
+            else:
+                print(f"❌ Job {job_id[:8]} fallito: {e}")
+        finally:
+            stop_heartbeat.set()
+            heartbeat.join()
+            for stored_file in files:
+                stored_file.close()
+
+    def _heartbeat(self, job_id, stop_event):
+        """Mantiene vivo il job anche durante le fasi lunghe senza checkpoint"""
+        while not stop_event.wait(self.stale_after / 3):
+            if not self.queue.heartbeat(job_id, self.worker_id):
+                return
+
+    def _rag_system(self, job):
+        """Restituisce il RAGSystem per le impostazioni del job, creandolo al primo utilizzo"""
+        settings = job["settings"]
+        api_key = self.queue.api_key(job["id"]) or self.openai_api_key
+        if not api_key:
+            raise ValueError("API key di OpenAI non disponibile per il worker (imposta OPENAI_API_KEY)")
+        backend = settings.get("backend") or self.backend
+        key = (
+            api_key, settings.get("embedding_model", "text-embedding-3-small"),
+            settings.get("embedding_dimensions"), settings.get("tenant_id"),
+            json.dumps(backend, sort_keys=True)
+        )
+        if key not in self._systems:
+            rag_system = RAGSystem(
+                openai_api_key=api_key,
+                embedding_model=key[1],
+                embedding_dimensions=key[2],
+                tenant_id=key[3],
+                openai_base_url=self.openai_base_url,
+                embedding_cache_path=self.embedding_cache_path
+            )
+            _initialize_backend(rag_system, backend)
+            self._systems[key] = rag_system
+        return self._systems[key]
+
+
+def _initialize_backend(rag_system, backend):
+    """
+    Inizializza il backend vettoriale di un RAGSystem da una configurazione serializzabile
+
+    Args:
+        rag_system: RAGSystem da inizializzare
+        backend: {"type": "flat", ...opzioni di initialize_flat_index} oppure
+                 {"type": "qdrant", ...opzioni di initialize_qdrant}
+    """
+    options = {key: value for key, value in backend.items() if key != "type"}
+    if backend.get("type") == "flat":
+        rag_system.initialize_flat_index(**options)
+    else:
+        rag_system.initialize_qdrant(**options)
+
+
+def is_shared_backend(backend):
+    """Indica se il backend può essere usato da più processi (solo un server Qdrant)"""
+    return backend.get("type", "qdrant") == "qdrant" and backend.get("use_memory") is False
+
+
+def start_worker_thread(queue, **worker_options):
+    """
+    Avvia un worker in un thread daemon del processo corrente
+
+    È il modo di usare i backend locali (Qdrant locale, indice piatto), il cui
+    storage può essere aperto da un solo processo: il worker condivide client
+    e indici con le sessioni (vedi shared_qdrant_client e shared_flat_store).
+
+    Args:
+        queue: IngestionQueue
+        worker_options: Argomenti di IngestionWorker
+
+    Returns:
+        Tuple (thread, stop_event)
+    """
+    stop_event = threading.Event()
+    worker = IngestionWorker(queue, **worker_options)
+    thread = threading.Thread(target=worker.run, args=(stop_event,), name="ingestion-worker", daemon=True)
+    thread.start()
+    return thread, stop_event
+
+
+def _run_worker_process(queue_path, uploads_dir, worker_options, stop_event):
+    """Entry point dei processi worker"""
+    # Ctrl+C arriva a tutto il gruppo: lo gestisce il processo principale
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    queue = IngestionQueue(queue_path, uploads_dir)
+    try:
+        IngestionWorker(queue, **worker_options).run(stop_event)
+    finally:
+        queue.close()
+
+
+def start_worker_processes(count=2, queue_path="./ingestion_jobs.sqlite", uploads_dir="./ingestion_uploads",
+                           **worker_options):
+    """
+    Avvia worker in processi separati, che non occupano il processo web
+
+    Args:
+        count: Numero di processi
+        queue_path: Percorso del database della coda
+        uploads_dir: Cartella dei file dei job
+        worker_options: Argomenti di IngestionWorker (l'API key viene da
+                        openai_api_key o da OPENAI_API_KEY)
+
+    Returns:
+        Tuple (processi, stop_event)
+
+    Raises:
+        ValueError: se il backend non è un server Qdrant
+    """
+    if not is_shared_backend(worker_options.get("backend") or {"type": "qdrant"}):
+        raise ValueError("I worker in processi separati richiedono un server Qdrant "
+                         "(lo storage locale può essere aperto da un solo processo): usa start_worker_thread")
+    context = multiprocessing.get_context("spawn")
+    stop_event = context.Event()
+    processes = []
+    for _ in range(count):
+        process = context.Process(
+            target=_run_worker_process,
+            args=(queue_path, uploads_dir, worker_options, stop_event),
+            daemon=True
+        )
+        process.start()
+        processes.append(process)
+    return processes, stop_event
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Worker di indicizzazione in background")
+    parser.add_argument("--queue", default="./ingestion_jobs.sqlite", help="Database della coda dei job")
+    parser.add_argument("--uploads", default="./ingestion_uploads", help="Cartella dei file dei job")
+    parser.add_argument("--workers", type=int, default=1, help="Numero di processi worker")
+    parser.add_argument("--qdrant-host", default=None, help="Server Qdrant (host:porta); senza, Qdrant locale")
+    parser.add_argument("--grpc", action="store_true", help="Usa gRPC con il server Qdrant")
+    parser.add_argument("--grpc-port", type=int, default=6334)
+    parser.add_argument("--embedding-cache", default="./embedding_cache.sqlite",
+                        help="Cache SQLite degli embedding (vuoto = disattivata)")
+    parser.add_argument("--openai-base-url", default=None)
+    args = parser.parse_args()
+
+    if args.qdrant_host:
+        host, _, port = args.qdrant_host.partition(":")
+        backend = {"type": "qdrant", "use_memory": False, "host": host, "port": int(port or 6333),
+                   "prefer_grpc": args.grpc, "grpc_port": args.grpc_port, "timeout": 30}
+    else:
+        backend = {"type": "qdrant", "use_memory": True}
+    worker_options = {
+        "openai_base_url": args.openai_base_url,
+        "embedding_cache_path": args.embedding_cache or None,
+        "backend": backend,
+    }
+
+    if args.workers > 1 and not is_shared_backend(backend):
+        parser.error("--workers > 1 richiede --qdrant-host (lo storage locale può essere aperto da un solo processo)")
+
+    if is_shared_backend(backend):
+        processes, stop_event = start_worker_processes(args.workers, args.queue, args.uploads, **worker_options)
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            # I worker si fermano al checkpoint successivo e rimettono in coda il job
+            stop_event.set()
+            for process in processes:
+                process.join()
+    else:
+        queue = IngestionQueue(args.queue, args.uploads)
+        stop_event = threading.Event()
+        try:
+            IngestionWorker(queue, **worker_options).run(stop_event)
+        except KeyboardInterrupt:
+            stop_event.set()
+        finally:
+            queue.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,497 @@
+"""
+Mock OpenAI Server
+Server locale compatibile con le API OpenAI usate dal sistema RAG
+(embeddings, responses e chat completions, anche in streaming).
+Restituisce embedding deterministici e permette di simulare latenza,
+velocità di generazione ed errori, per benchmark riproducibili senza rete.
+
+Uso:
+    python mock_openai_server.py --port 8089 --profile realistic
+
+e poi punta il sistema RAG a http://127.0.0.1:8089/v1
+(RAGSystem(openai_base_url=...) oppure variabile d'ambiente OPENAI_BASE_URL).
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+
+# Profili di carico predefiniti
+PROFILES = {
+    # Nessuna latenza: misura solo il costo lato client
+    "instant": {
+        "latency_ms": 0, "jitter_ms": 0, "per_input_ms": 0.0,
+        "tokens_per_second": None, "error_rate": 0.0,
+    },
+    # Rete locale veloce
+    "fast": {
+        "latency_ms": 20, "jitter_ms": 5, "per_input_ms": 0.2,
+        "tokens_per_second": 500, "error_rate": 0.0,
+    },
+    # Valori simili all'API reale
+    "realistic": {
+        "latency_ms": 250, "jitter_ms": 100, "per_input_ms": 1.0,
+        "tokens_per_second": 60, "error_rate": 0.0,
+    },
+    # Come realistic, con il 5% di errori 429/500
+    "flaky": {
+        "latency_ms": 250, "jitter_ms": 100, "per_input_ms": 1.0,
+        "tokens_per_second": 60, "error_rate": 0.05,
+    },
+}
+
+DEFAULT_DIMENSIONS = {
+    "text-embedding-3-large": 3072,
+}
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+@lru_cache(maxsize=50_000)
+def _token_vector(token, dimensions):
+    """Vettore pseudo-casuale (deterministico) associato a un token"""
+    seed = int.from_bytes(hashlib.sha256(token.encode("utf-8")).digest()[:8], "little")
+    return np.random.default_rng(seed).standard_normal(dimensions).astype(np.float32)
+
+
+def deterministic_embedding(text, dimensions=1536):
+    """
+    Embedding deterministico di un testo
+
+    Il vettore è la somma normalizzata dei vettori dei token del testo, quindi
+    testi con parole in comune hanno embedding simili e il retrieval sui dati
+    simulati restituisce risultati sensati.
+
+    Args:
+        text: Testo da codificare
+        dimensions: Dimensione del vettore
+
+    Returns:
+        numpy.ndarray float32 di norma 1
+    """
+    tokens = _WORD_RE.findall(text.lower()) or [text]
+    vector = np.zeros(dimensions, dtype=np.float32)
+    for token in tokens:
+        vector += _token_vector(token, dimensions)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def _count_tokens(text):
+    """Stima grezza dei token (circa 4 caratteri per token)"""
+    return max(1, (len(text) + 3) // 4)
+
+
+def _input_text(value):
+    """Estrae il testo dai formati di input di responses e chat completions"""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, list):
+        return "\n".join(_input_text(item) for item in value)
+    if isinstance(value, dict):
+        if "content" in value:
+            return _input_text(value["content"])
+        if "text" in value:
+            return value["text"]
+    return ""
+
+
+def _last_user_text(value):
+    """Testo dell'ultimo messaggio utente (usato come argomento delle tool call)"""
+    if isinstance(value, list):
+        for item in reversed(value):
+            if isinstance(item, dict) and item.get("role") == "user":
+                return _input_text(item)
+    return _input_text(value)
+
+
+class MockOpenAIServer:
+    """Server HTTP che simula le API OpenAI con profili di latenza ed errori configurabili"""
+
+    def __init__(self, host="127.0.0.1", port=0, profile="fast", seed=0,
+                 response_words=40, **overrides):
+        """
+        Args:
+            host: Indirizzo di ascolto
+            port: Porta di ascolto (0 = porta libera scelta dal sistema)
+            profile: Nome del profilo di carico (vedi PROFILES)
+            seed: Seed per jitter ed errori simulati
+            response_words: Numero di parole delle risposte generate
+            **overrides: Valori che sovrascrivono quelli del profilo
+                         (latency_ms, jitter_ms, per_input_ms, tokens_per_second, error_rate)
+        """
+        if profile not in PROFILES:
+            raise ValueError(f"Profilo sconosciuto: {profile}. Disponibili: {', '.join(PROFILES)}")
+
+        self.settings = {**PROFILES[profile], **overrides}
+        self.response_words = response_words
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+        self.stats = {"embeddings": 0, "embedding_inputs": 0, "responses": 0,
+                      "chat_completions": 0, "errors": 0}
+
+        server = self
+
+        class Handler(_MockHandler):
+            mock = server
+
+        self._httpd = ThreadingHTTPServer((host, port), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        """URL base da passare ai client OpenAI"""
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        """Avvia il server in un thread in background"""
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        """Avvia il server nel thread corrente"""
+        self._httpd.serve_forever()
+
+    def stop(self):
+        """Ferma il server"""
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def count(self, name, amount=1):
+        """Incrementa un contatore delle statistiche (thread-safe)"""
+        with self._rng_lock:
+            self.stats[name] += amount
+
+    def _random(self):
+        with self._rng_lock:
+            return self._rng.random()
+
+    def simulate_latency(self, num_inputs=1):
+        """Attende la latenza del profilo (più un costo per input)"""
+        latency = self.settings["latency_ms"]
+        jitter = self.settings["jitter_ms"]
+        if jitter:
+            latency += (self._random() * 2 - 1) * jitter
+        latency += self.settings["per_input_ms"] * num_inputs
+        if latency > 0:
+            time.sleep(latency / 1000)
+
+    def simulate_error(self):
+        """Restituisce uno status di errore simulato (429 o 500) oppure None"""
+        if self.settings["error_rate"] and self._random() < self.settings["error_rate"]:
+            self.count("errors")
+            return 429 if self._random() < 0.7 else 500
+        return None
+
+    def token_delay(self):
+        """Attesa tra due token in streaming"""
+        tps = self.settings["tokens_per_second"]
+        if tps:
+            time.sleep(1 / tps)
+
+    def answer_words(self, prompt):
+        """Risposta deterministica: riprende le parole del prompt"""
+        words = _WORD_RE.findall(prompt) or ["ok"]
+        return ["Risposta", "simulata:"] + [words[i % len(words)] for i in range(self.response_words)]
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    """Gestisce le richieste HTTP del MockOpenAIServer"""
+
+    mock = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        # Silenzia il log di ogni richiesta
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start_stream(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+    def _send_event(self, payload, event=None):
+        data = ""
+        if event:
+            data += f"event: {event}\n"
+        data += f"data: {payload if isinstance(payload, str) else json.dumps(payload)}\n\n"
+        self.wfile.write(data.encode("utf-8"))
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json(200, {"object": "list", "data": [
+                {"id": "mock-model", "object": "model", "created": 0, "owned_by": "mock"}
+            ]})
+        else:
+            self._send_json(404, {"error": {"message": "Not found", "type": "invalid_request_error"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            self._send_json(400, {"error": {"message": "Invalid JSON", "type": "invalid_request_error"}})
+            return
+
+        path = self.path.split("?")[0].rstrip("/")
+        if path.endswith("/embeddings"):
+            handler = self._embeddings
+            num_inputs = len(body.get("input")) if isinstance(body.get("input"), list) else 1
+        elif path.endswith("/responses"):
+            handler, num_inputs = self._responses, 1
+        elif path.endswith("/chat/completions"):
+            handler, num_inputs = self._chat_completions, 1
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {path}", "type": "invalid_request_error"}})
+            return
+
+        self.mock.simulate_latency(num_inputs)
+        status = self.mock.simulate_error()
+        if status is not None:
+            error_type = "rate_limit_exceeded" if status == 429 else "server_error"
+            self._send_json(
+                status,
+                {"error": {"message": f"Errore simulato {status}", "type": error_type, "code": error_type}},
+                headers={"Retry-After": "0.1"} if status == 429 else None
+            )
+            return
+
+        handler(body)
+
+    # --- Embeddings ---------------------------------------------------------
+
+    def _embeddings(self, body):
+        inputs = body.get("input")
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        model = body.get("model", "text-embedding-3-small")
+        dimensions = body.get("dimensions") or DEFAULT_DIMENSIONS.get(model, 1536)
+        as_base64 = body.get("encoding_format") == "base64"
+
+        data = []
+        total_tokens = 0
+        for index, text in enumerate(inputs):
+            vector = deterministic_embedding(text, dimensions)
+            total_tokens += _count_tokens(text)
+            embedding = (base64.b64encode(vector.astype("<f4").tobytes()).decode("ascii")
+                         if as_base64 else vector.tolist())
+            data.append({"object": "embedding", "index": index, "embedding": embedding})
+
+        self.mock.count("embeddings")
+        self.mock.count("embedding_inputs", len(inputs))
+        self._send_json(200, {
+            "object": "list",
+            "data": data,
+            "model": model,
+            "usage": {"prompt_tokens": total_tokens, "total_tokens": total_tokens},
+        })
+
+    # --- Responses API ------------------------------------------------------
+
+    def _response_object(self, body, output, status, input_tokens, output_tokens):
+        return {
+            "id": f"resp_{uuid.uuid4().hex}",
+            "object": "response",
+            "created_at": int(time.time()),
+            "model": body.get("model", "mock-model"),
+            "status": status,
+            "output": output,
+            "parallel_tool_calls": True,
+            "tool_choice": body.get("tool_choice", "auto"),
+            "tools": body.get("tools", []),
+            "temperature": body.get("temperature"),
+            "usage": {
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens,
+                "input_tokens_details": {"cached_tokens": 0},
+                "output_tokens_details": {"reasoning_tokens": 0},
+            },
+        }
+
+    def _responses(self, body):
+        self.mock.count("responses")
+        prompt = _input_text(body.get("input"))
+        input_tokens = _count_tokens(prompt)
+        tools = body.get("tools") or []
+
+        # Con tool disponibili (es. ToolRewriter) risponde con una function call
+        if tools and body.get("tool_choice") != "none":
+            tool = tools[0]
+            arguments = {name: _last_user_text(body.get("input"))
+                         for name in (tool.get("parameters", {}).get("properties") or {"query": None})}
+            item = {
+                "type": "function_call",
+                "id": f"fc_{uuid.uuid4().hex}",
+                "call_id": f"call_{uuid.uuid4().hex}",
+                "name": tool.get("name"),
+                "arguments": json.dumps(arguments),
+                "status": "completed",
+            }
+            response = self._response_object(body, [item], "completed", input_tokens, 10)
+            if body.get("stream"):
+                self._start_stream()
+                self._send_event({"type": "response.completed", "response": response, "sequence_number": 0},
+                                 event="response.completed")
+            else:
+                self._send_json(200, response)
+            return
+
+        words = self.mock.answer_words(prompt)
+        text = " ".join(words)
+        message_id = f"msg_{uuid.uuid4().hex}"
+        message = {
+            "type": "message",
+            "id": message_id,
+            "status": "completed",
+            "role": "assistant",
+            "content": [{"type": "output_text", "text": text, "annotations": []}],
+        }
+
+        if not body.get("stream"):
+            self.mock.token_delay()
+            self._send_json(200, self._response_object(body, [message], "completed", input_tokens, len(words)))
+            return
+
+        self._start_stream()
+        sequence = 0
+        created = self._response_object(body, [], "in_progress", input_tokens, 0)
+        self._send_event({"type": "response.created", "response": created, "sequence_number": sequence},
+                         event="response.created")
+        for i, word in enumerate(words):
+            self.mock.token_delay()
+            sequence += 1
+            self._send_event({
+                "type": "response.output_text.delta",
+                "item_id": message_id,
+                "output_index": 0,
+                "content_index": 0,
+                "delta": word if i == 0 else " " + word,
+                "logprobs": [],
+                "sequence_number": sequence,
+            }, event="response.output_text.delta")
+        sequence += 1
+        completed = self._response_object(body, [message], "completed", input_tokens, len(words))
+        self._send_event({"type": "response.completed", "response": completed, "sequence_number": sequence},
+                         event="response.completed")
+
+    # --- Chat completions ---------------------------------------------------
+
+    def _chat_completions(self, body):
+        self.mock.count("chat_completions")
+        prompt = _input_text(body.get("messages"))
+        words = self.mock.answer_words(prompt)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        model = body.get("model", "mock-model")
+        created = int(time.time())
+        usage = {
+            "prompt_tokens": _count_tokens(prompt),
+            "completion_tokens": len(words),
+            "total_tokens": _count_tokens(prompt) + len(words),
+        }
+
+        if not body.get("stream"):
+            self.mock.token_delay()
+            self._send_json(200, {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": " ".join(words)},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            })
+            return
+
+        self._start_stream()
+        for i, word in enumerate(words):
+            self.mock.token_delay()
+            delta = {"content": word if i == 0 else " " + word}
+            if i == 0:
+                delta["role"] = "assistant"
+            self._send_event({
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": None}],
+            })
+        self._send_event({
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+            "usage": usage,
+        })
+        self._send_event("[DONE]")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server locale compatibile con le API OpenAI per benchmark")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--profile", default="fast", choices=sorted(PROFILES))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency-ms", type=float, default=None)
+    parser.add_argument("--tokens-per-second", type=float, default=None)
+    parser.add_argument("--error-rate", type=float, default=None)
+    args = parser.parse_args()
+
+    overrides = {}
+    if args.latency_ms is not None:
+        overrides["latency_ms"] = args.latency_ms
+    if args.tokens_per_second is not None:
+        overrides["tokens_per_second"] = args.tokens_per_second
+    if args.error_rate is not None:
+        overrides["error_rate"] = args.error_rate
+
+    server = MockOpenAIServer(host=args.host, port=args.port, profile=args.profile, seed=args.seed, **overrides)
+    print(f"🧪 Mock OpenAI in ascolto su {server.base_url} (profilo: {args.profile})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -13,20 +13,349 @@ if sys.platform == 'darwin':  # macOS
 
 from PyPDF2 import PdfReader
 from datapizza.clients.openai import OpenAIClient
+from datapizza.core.vectorstore import Vectorstore
 from datapizza.embedders.openai import OpenAIEmbedder
 from datapizza.modules.prompt import ChatPromptTemplate
 from datapizza.modules.rewriters import ToolRewriter
 from datapizza.pipeline import DagPipeline
+from datapizza.type import Chunk, DenseEmbedding
 from datapizza.vectorstores.qdrant import QdrantVectorstore
-from qdrant_client import QdrantClient
-from qdrant_client.models import Distance, VectorParams, PointStruct
+from qdrant_client import AsyncQdrantClient, QdrantClient
+from qdrant_client.models import (
+    Distance, VectorParams, PointStruct,
+    Filter, FieldCondition, MatchValue, MatchAny, Range, HasIdCondition, PointIdsList, IsEmptyCondition, PayloadField,
+    PayloadSchemaType, KeywordIndexParams, KeywordIndexType,
+    SetPayload, SetPayloadOperation,
+    ScalarQuantization, ScalarQuantizationConfig, ScalarType,
+    BinaryQuantization, BinaryQuantizationConfig,
+    ProductQuantization, ProductQuantizationConfig, CompressionRatio,
+    Disabled, SearchParams, QuantizationSearchParams,
+    HnswConfigDiff, OptimizersConfigDiff, VectorParamsDiff, CollectionParamsDiff,
+    SparseVectorParams, SparseVector, Modifier, Prefetch, FusionQuery, Fusion
+)
+import asyncio
+import codecs
+import hashlib
+import io
+import json
+import logging
+import shutil
+import threading
+import time
+import warnings
+import unicodedata
 import uuid
+import numpy as np
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from itertools import chain, groupby
+from contextlib import contextmanager
+from difflib import SequenceMatcher
+
+from chunk_dedup import ChunkDeduplicator
+from context_packer import pack_context
+from embedding_cache import EmbeddingCache, cache_key
+from embedding_scheduler import EmbeddingScheduler
+from flat_index import FlatIndex
+from sparse_encoder import BM25Encoder
+from token_chunker import iter_token_chunk_offsets
+
+logger = logging.getLogger(__name__)
+
+# Nome del vettore sparso BM25 nelle collection con ricerca ibrida
+SPARSE_VECTOR_NAME = "bm25"
+
+# Tenant a cui vengono assegnati i chunk indicizzati prima dell'introduzione dei
+# tenant (senza tenant_id nel payload), vedi RAGSystem._adopt_untenanted_points
+DEFAULT_TENANT_ID = "default"
+
+# Campi del payload indicizzati da Qdrant (server): le ricerche filtrate su
+# questi campi visitano solo i points che soddisfano il filtro
+PAYLOAD_INDEXES = {
+    "document_id": PayloadSchemaType.KEYWORD,
+    "filename": PayloadSchemaType.KEYWORD,
+    "page": PayloadSchemaType.INTEGER,
+    "chunk_offset": PayloadSchemaType.INTEGER,
+    # document_id dei documenti rappresentati da un chunk deduplicato
+    "sources": PayloadSchemaType.KEYWORD,
+    # is_tenant: Qdrant raggruppa su disco i points di ogni tenant
+    "tenant_id": KeywordIndexParams(type=KeywordIndexType.KEYWORD, is_tenant=True),
+}
+
+# Campi in cui un filtro su document_id cerca il documento: i chunk tenuti dalla
+# deduplicazione rappresentano anche i documenti elencati in "sources"
+DOCUMENT_FIELDS = ("document_id", "sources")
+
+# Client Qdrant condivisi dalle istanze di RAGSystem dello stesso processo
+# (vedi shared_qdrant_client): chiave -> [client, numero di istanze che lo usano]
+_shared_clients = {}
+_shared_clients_lock = threading.Lock()
+# Indici piatti condivisi allo stesso modo: (cartella, dtype) -> FlatVectorstore
+_shared_flat_stores = {}
+
+
+class CachedOpenAIEmbedder(OpenAIEmbedder):
+    """OpenAIEmbedder che consulta la cache degli embedding prima di chiamare l'API"""
+    
+    def __init__(self, *, api_key, model_name=None, base_url=None, cache=None, dimensions=None):
+        """
+        Args:
+            api_key: API key di OpenAI
+            model_name: Nome del modello di embedding
+            base_url: URL base dell'API (opzionale)
+            cache: EmbeddingCache da usare (None = nessuna cache)
+            dimensions: Dimensione ridotta dei vettori (solo modelli text-embedding-3;
+                        None = dimensione nativa del modello)
+        """
+        super().__init__(api_key=api_key, model_name=model_name, base_url=base_url)
+        self.cache = cache
+        self.dimensions = dimensions
+    
+    def _embed_api(self, text, model_name=None):
+        """Chiamata all'API, con il parametro dimensions se richiesto"""
+        if self.dimensions is None:
+            return super().embed(text, model_name=model_name)
+        texts = [text] if isinstance(text, str) else text
+        response = self._get_client().embeddings.create(
+            input=texts, model=model_name or self.model_name, dimensions=self.dimensions
+        )
+        embeddings = [embedding.embedding for embedding in response.data]
+        return embeddings[0] if isinstance(text, str) else embeddings
+    
+    async def _a_embed_api(self, text, model_name=None):
+        """Versione asincrona di _embed_api"""
+        if self.dimensions is None:
+            return await super().a_embed(text, model_name=model_name)
+        texts = [text] if isinstance(text, str) else text
+        response = await self._get_a_client().embeddings.create(
+            input=texts, model=model_name or self.model_name, dimensions=self.dimensions
+        )
+        embeddings = [embedding.embedding for embedding in response.data]
+        return embeddings[0] if isinstance(text, str) else embeddings
+    
+    def _split_cached(self, text, model_name):
+        """
+        Restituisce (testi, embedding in cache o None, indici mancanti per chiave di cache)
+        
+        I testi ripetuti nella stessa richiesta (stessa chiave di cache) vengono
+        raggruppati: all'API va una sola copia per chiave.
+        """
+        texts = [text] if isinstance(text, str) else list(text)
+        model = model_name or self.model_name
+        embeddings = self.cache.get_many(texts, model, self.dimensions)
+        missing = {}
+        for i, embedding in enumerate(embeddings):
+            if embedding is None:
+                missing.setdefault(cache_key(texts[i], model, self.dimensions), []).append(i)
+        return texts, embeddings, missing
+    
+    @staticmethod
+    def _missing_texts(texts, missing):
+        """Un testo per ogni chiave mancante, da inviare all'API"""
+        return [texts[positions[0]] for positions in missing.values()]
+    
+    def _merge_new(self, texts, embeddings, missing, new_embeddings, model_name):
+        """Salva in cache i nuovi embedding e li inserisce in tutte le posizioni mancanti"""
+        self.cache.put_many(
+            self._missing_texts(texts, missing), new_embeddings, model_name or self.model_name, self.dimensions
+        )
+        for positions, embedding in zip(missing.values(), new_embeddings):
+            for i in positions:
+                embeddings[i] = embedding
+    
+    def embed(self, text, model_name=None):
+        if self.cache is None:
+            return self._embed_api(text, model_name=model_name)
+        
+        texts, embeddings, missing = self._split_cached(text, model_name)
+        if missing:
+            new_embeddings = self._embed_api(self._missing_texts(texts, missing), model_name=model_name)
+            self._merge_new(texts, embeddings, missing, new_embeddings, model_name)
+        return embeddings[0] if isinstance(text, str) else embeddings
+    
+    async def a_embed(self, text, model_name=None):
+        if self.cache is None:
+            return await self._a_embed_api(text, model_name=model_name)
+        
+        texts, embeddings, missing = self._split_cached(text, model_name)
+        if missing:
+            new_embeddings = await self._a_embed_api(self._missing_texts(texts, missing), model_name=model_name)
+            self._merge_new(texts, embeddings, missing, new_embeddings, model_name)
+        return embeddings[0] if isinstance(text, str) else embeddings
+
+
+class FlatVectorstore(Vectorstore):
+    """Vectorstore su FlatIndex (una cartella per collection), alternativo allo storage locale di Qdrant"""
+    
+    def __init__(self, storage_path="./flat_index", dtype="float32"):
+        """
+        Args:
+            storage_path: Cartella che contiene gli indici delle collection
+            dtype: "float32" oppure "float16" per i nuovi indici
+        """
+        self.storage_path = storage_path
+        self.dtype = dtype
+        self._indexes = {}
+        self._lock = threading.Lock()
+        os.makedirs(storage_path, exist_ok=True)
+    
+    def _collection_path(self, collection_name):
+        """Cartella dell'indice di una collection"""
+        if not collection_name or os.sep in collection_name or collection_name.startswith("."):
+            raise ValueError(f"Nome di collection non valido: {collection_name!r}")
+        return os.path.join(self.storage_path, collection_name)
+    
+    def collection_exists(self, collection_name):
+        return os.path.exists(os.path.join(self._collection_path(collection_name), "meta.json"))
+    
+    def get_index(self, collection_name):
+        """
+        Restituisce il FlatIndex di una collection esistente (aperto una sola volta)
+        
+        Returns:
+            FlatIndex
+        """
+        with self._lock:
+            index = self._indexes.get(collection_name)
+            if index is None:
+                if not self.collection_exists(collection_name):
+                    raise ValueError(f"Collection '{collection_name}' non trovata")
+                index = FlatIndex(self._collection_path(collection_name))
+                self._indexes[collection_name] = index
+            return index
+    
+    def create_collection(self, collection_name, vector_size, metadata=None):
+        """Crea (o ricrea da zero) l'indice di una collection"""
+        self.delete_collection(collection_name)
+        with self._lock:
+            index = FlatIndex(
+                self._collection_path(collection_name), dimensions=vector_size,
+                dtype=self.dtype, metadata=metadata
+            )
+            self._indexes[collection_name] = index
+            return index
+    
+    def delete_collection(self, collection_name):
+        """Cancella l'indice di una collection, se esiste"""
+        with self._lock:
+            self._indexes.pop(collection_name, None)
+            path = self._collection_path(collection_name)
+            if os.path.exists(path):
+                shutil.rmtree(path)
+    
+    @staticmethod
+    def _to_chunks(results):
+        """Converte tuple (id, payload) in Chunk, come QdrantVectorstore"""
+        return [Chunk(id=point_id, text=payload["text"], metadata=payload) for point_id, payload in results]
+    
+    def add(self, chunk, collection_name=None):
+        chunks = chunk if isinstance(chunk, list) else [chunk]
+        self.get_index(collection_name).upsert(
+            [item.id for item in chunks],
+            [item.embeddings[0].vector for item in chunks],
+            [{**item.metadata, "text": item.text} for item in chunks]
+        )
+    
+    async def a_add(self, chunk, collection_name=None):
+        await asyncio.to_thread(self.add, chunk, collection_name)
+    
+    def update(self, collection_name, payload, points, **kwargs):
+        self.get_index(collection_name).set_payload(points, payload)
+    
+    def remove(self, collection_name, ids, **kwargs):
+        self.get_index(collection_name).delete(ids)
+    
+    def search(self, collection_name, query_vector, k=10, vector_name=None, with_vectors=False,
+               filters=None, **kwargs):
+        # vector_name e i parametri di ricerca di Qdrant non si applicano: la ricerca è sempre esatta
+        results = self.get_index(collection_name).search(
+            query_vector, k, with_vectors=bool(with_vectors), filters=filters
+        )
+        chunks = self._to_chunks((result[0], result[2]) for result in results)
+        if with_vectors:
+            for chunk, result in zip(chunks, results):
+                chunk.embeddings = [DenseEmbedding(name="default", vector=result[3].tolist())]
+        return chunks
+    
+    async def a_search(self, collection_name, query_vector, k=10, vector_name=None, **kwargs):
+        # NumPy rilascia il GIL durante il prodotto matrice-vettore
+        return await asyncio.to_thread(self.search, collection_name, query_vector, k, vector_name, **kwargs)
+    
+    def retrieve(self, collection_name, ids, **kwargs):
+        return self._to_chunks(self.get_index(collection_name).retrieve(ids))
+
+
+class QueryMetrics:
+    """Tempi delle fasi di una query RAG e statistiche della generazione"""
+    
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.spans = {}  # nome fase -> millisecondi (sommati se la fase si ripete)
+        self.time_to_first_token_ms = None
+        self.total_ms = None
+        # Frammenti di testo ricevuti in streaming (i token sono in completion_tokens)
+        self.chunks_streamed = 0
+        self.prompt_tokens = None
+        self.completion_tokens = None
+        self.num_sources = None
+        self.context_tokens = None
+    
+    @contextmanager
+    def span(self, name):
+        """Misura la durata di una fase (es. "rewrite", "embed", "retrieve", "prompt", "generate")"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            self.spans[name] = self.spans.get(name, 0.0) + elapsed
+    
+    def record_delta(self):
+        """Registra un frammento di testo ricevuto in streaming"""
+        if self.time_to_first_token_ms is None:
+            self.time_to_first_token_ms = (time.perf_counter() - self.started_at) * 1000
+        self.chunks_streamed += 1
+    
+    def record_usage(self, response):
+        """Legge il consumo di token dalla risposta del client, se disponibile"""
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return
+        if getattr(usage, "prompt_tokens", 0):
+            self.prompt_tokens = usage.prompt_tokens
+        if getattr(usage, "completion_tokens", 0):
+            self.completion_tokens = usage.completion_tokens
+    
+    def finish(self, num_sources=None):
+        """Chiude la misura e scrive una riga di log strutturata (JSON)"""
+        self.total_ms = (time.perf_counter() - self.started_at) * 1000
+        self.num_sources = num_sources
+        logger.info(json.dumps({"event": "rag_query", **self.to_dict()}))
+    
+    def to_dict(self):
+        """
+        Returns:
+            Dizionario serializzabile con tempi (ms) e contatori
+        """
+        return {
+            "spans_ms": {name: round(ms, 1) for name, ms in self.spans.items()},
+            "time_to_first_token_ms": round(self.time_to_first_token_ms, 1) if self.time_to_first_token_ms is not None else None,
+            "total_ms": round(self.total_ms, 1) if self.total_ms is not None else None,
+            "chunks_streamed": self.chunks_streamed,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "num_sources": self.num_sources,
+            "context_tokens": self.context_tokens,
+        }
 
 
 class RAGSystem:
     """Classe principale per gestire il sistema RAG"""
     
-    def __init__(self, openai_api_key, model_name="gpt-4o-mini", embedding_model="text-embedding-3-small"):
+    def __init__(self, openai_api_key, model_name="gpt-4o-mini", embedding_model="text-embedding-3-small",
+                 embedding_cache_path=None, embedding_cache_max_mb=512, openai_base_url=None,
+                 embedding_dimensions=None, tenant_id=None):
         """
         Inizializza il sistema RAG
         
@@ -34,388 +363,2435 @@ class RAGSystem:
             openai_api_key: API key di OpenAI
             model_name: Nome del modello LLM da usare
             embedding_model: Nome del modello di embedding da usare
+            embedding_cache_path: Percorso della cache SQLite degli embedding,
+                                  condivisa da indicizzazione e query (None = disattivata)
+            embedding_cache_max_mb: Dimensione massima della cache in MB (default: 512)
+            openai_base_url: URL base dell'API OpenAI (None = OPENAI_BASE_URL o API ufficiale);
+                             es. il server di mock_openai_server.py per i benchmark offline
+            embedding_dimensions: Dimensione dei vettori di embedding (None = nativa del
+                                  modello); i modelli text-embedding-3 accettano valori
+                                  ridotti (es. 256 o 512) per indici più piccoli e veloci
+            tenant_id: Tenant (es. cliente o area di lavoro) a cui appartengono i documenti
+                       indicizzati e su cui sono limitate le ricerche (None = nessun
+                       isolamento); più tenant condividono la stessa collection.
+                       I chunk indicizzati senza tenant vengono assegnati a DEFAULT_TENANT_ID
         """
         self.openai_api_key = openai_api_key
         self.model_name = model_name
         self.embedding_model = embedding_model
+        self.embedding_dimensions = embedding_dimensions
+        self.openai_base_url = openai_base_url or os.environ.get("OPENAI_BASE_URL")
+        self.tenant_id = tenant_id
         self.qdrant_client = None
+        # Backend alternativo a Qdrant (vedi initialize_flat_index)
+        self.flat_store = None
         self.use_memory = True
         self.qdrant_host = "localhost"
         self.qdrant_port = 6333
+        # Opzioni di connessione al server (gRPC, pool, timeout; vedi initialize_qdrant)
+        self.qdrant_connection = {}
+        # Client asincrono del server, riusato da tutte le query asincrone
+        self._a_qdrant_client = None
+        self.temperature = 0.0
+        self.system_prompt = "Riscrivi le query dell'utente per migliorare l'accuratezza del recupero."
+        self.user_prompt_template = "Domanda dell'utente: {{user_prompt}}\n"
+        self.retrieval_prompt_template = "Contenuto recuperato:\n{% for chunk in chunks %}{{ chunk.text }}\n{% endfor %}"
+        self.last_index_stats = None
+        # Budget di token del contenuto recuperato nel prompt (vedi _pack_context)
+        self.max_context_tokens = 4000
+        # Opzioni di ricerca di default, sovrascrivibili per singola query (vedi build_search_params);
+        # "hybrid" usa anche BM25 sulle collection create con hybrid=True, recuperando
+        # hybrid_candidates * k candidati per ciascuna ricerca prima della fusione;
+        # "mmr_lambda" (None = disattivato) diversifica i k chunk scelti fra
+        # mmr_candidates * k candidati (vedi mmr_select)
+        self.search_options = {
+            "oversampling": 2.0, "rescore": True,
+            "hybrid": True, "hybrid_candidates": 4,
+            "mmr_lambda": None, "mmr_candidates": 4,
+        }
+        self.sparse_encoder = BM25Encoder()
+        # Registro dei componenti riutilizzati tra le query (vedi get_components)
+        self._components = {}
+        self._components_lock = threading.RLock()
+        self._vectorstore = None
+        # Collection in cui i points senza tenant sono già stati assegnati (vedi _adopt_untenanted_points)
+        self._adopted_collections = set()
+        self._executor = None
+        self.embedding_cache = None
+        if embedding_cache_path:
+            self.embedding_cache = EmbeddingCache(embedding_cache_path, max_size_mb=embedding_cache_max_mb)
+    
+    def create_embedder(self):
+        """
+        Crea l'embedder usato sia per l'indicizzazione sia per le query
+        
+        Returns:
+            CachedOpenAIEmbedder (usa la cache degli embedding se configurata)
+        """
+        return CachedOpenAIEmbedder(
+            api_key=self.openai_api_key,
+            model_name=self.embedding_model,
+            base_url=self.openai_base_url,
+            cache=self.embedding_cache,
+            dimensions=self.requested_dimensions
+        )
+    
+    @property
+    def vector_size(self):
+        """Dimensione dei vettori prodotti dalla configurazione di embedding attuale"""
+        return get_vector_size(self.embedding_model, self.embedding_dimensions)
+    
+    @property
+    def requested_dimensions(self):
+        """Valore del parametro dimensions per l'API (None se coincide con la dimensione nativa)"""
+        if self.embedding_dimensions and self.embedding_dimensions != get_vector_size(self.embedding_model):
+            return self.embedding_dimensions
+        return None
+    
+    def embedding_metadata(self):
+        """
+        Metadati di embedding salvati con la collection
+        
+        Returns:
+            Dizionario {"embedding_model", "embedding_dimensions"}
+        """
+        return {"embedding_model": self.embedding_model, "embedding_dimensions": self.vector_size}
+    
+    def check_collection_embedding(self, collection_name):
+        """
+        Verifica che la collection sia stata indicizzata con la configurazione di embedding attuale
+        
+        Args:
+            collection_name: Nome della collection
+            
+        Raises:
+            ValueError: se dimensione dei vettori o modello di embedding non corrispondono
+        """
+        size, metadata = self._collection_embedding(collection_name)
+        if size != self.vector_size:
+            raise ValueError(
+                f"La collection '{collection_name}' contiene vettori di dimensione {size}, ma "
+                f"l'embedding configurato ({self.embedding_model}) produce vettori di dimensione "
+                f"{self.vector_size}. Re-indicizza i documenti o cambia le impostazioni di embedding."
+            )
+        stored_model = metadata.get("embedding_model")
+        if stored_model and stored_model != self.embedding_model:
+            raise ValueError(
+                f"La collection '{collection_name}' è stata indicizzata con {stored_model}, "
+                f"ma è configurato {self.embedding_model}. Re-indicizza i documenti o cambia modello."
+            )
         
-    def initialize_qdrant(self, use_memory=True, host="localhost", port=6333):
+    def _collection_embedding(self, collection_name):
+        """Restituisce (dimensione dei vettori, metadati) di una collection esistente"""
+        if self.flat_store:
+            index = self.flat_store.get_index(collection_name)
+            return index.dimensions, index.metadata
+        config = self.qdrant_client.get_collection(collection_name).config
+        vectors = config.params.vectors
+        size = vectors["default"].size if isinstance(vectors, dict) and "default" in vectors else None
+        return size, config.metadata or {}
+    
+    def _collection_exists(self, collection_name):
+        """True se la collection esiste nel backend configurato"""
+        if self.flat_store:
+            return self.flat_store.collection_exists(collection_name)
+        return bool(self.qdrant_client) and self.qdrant_client.collection_exists(collection_name)
+    
+    def _require_store(self):
+        """Verifica che un backend vettoriale sia stato inizializzato"""
+        if not self.qdrant_client and not self.flat_store:
+            raise ValueError("Qdrant client non inizializzato. Chiama initialize_qdrant() prima.")
+    
+    def initialize_qdrant(self, use_memory=True, host="localhost", port=6333, storage_path="./qdrant_storage",
+                          prefer_grpc=False, grpc_port=6334, pool_size=None, timeout=None):
         """
         Inizializza il client Qdrant con PERSISTENZA su DISCO
         
         Args:
-            use_memory: Se True, usa storage locale persistente (./qdrant_storage)
+            use_memory: Se True, usa storage locale persistente (storage_path)
                        Se False, connetti a server Qdrant esterno
             host: Host di Qdrant (se use_memory=False)
-            port: Porta di Qdrant (se use_memory=False)
+            port: Porta REST di Qdrant (se use_memory=False)
+            storage_path: Cartella dello storage locale; ":memory:" per una
+                          collection solo in RAM (es. benchmark e prove)
+            prefer_grpc: Se True, usa gRPC con il server: vettori in protobuf binario
+                         invece che in JSON e connessioni HTTP/2 persistenti (upsert e
+                         ricerche molto più rapidi con embedding grandi)
+            grpc_port: Porta gRPC del server (default Qdrant: 6334)
+            pool_size: Connessioni del pool (gRPC: canali, default 3; REST: connessioni
+                       massime, default 100)
+            timeout: Timeout (secondi) delle richieste al server (None = default del client)
             
         Returns:
             QdrantClient instance
         """
+        if self.qdrant_client:
+            release_qdrant_client(self.qdrant_client)
         self.use_memory = use_memory
         self.qdrant_host = host
         self.qdrant_port = port
+        self.qdrant_connection = {} if use_memory else {
+            "prefer_grpc": prefer_grpc, "grpc_port": grpc_port, "pool_size": pool_size, "timeout": timeout
+        }
+        self._a_qdrant_client = None
+        self.flat_store = None
+        # Il vectorstore e i retriever registrati usano il client precedente
+        self.invalidate_components()
         
-        if use_memory:
+        # Il client è condiviso con le altre istanze del processo (es. altre sessioni)
+        self.qdrant_client = shared_qdrant_client(use_memory, host, port, storage_path, **self.qdrant_connection)
+        if use_memory and storage_path == ":memory:":
+            print("🧪 Qdrant inizializzato in memoria (non persistente)")
+        elif use_memory:
             # VERSIONE PRODUZIONE: Usa storage locale PERSISTENTE
-            # I dati saranno salvati in ./qdrant_storage e persistono tra i riavvii
-            import os
-            storage_path = "./qdrant_storage"
-            if not os.path.exists(storage_path):
-                os.makedirs(storage_path)
-            self.qdrant_client = QdrantClient(path=storage_path)
+            # I dati saranno salvati in storage_path e persistono tra i riavvii
             print(f"💾 Qdrant inizializzato con storage PERSISTENTE in: {storage_path}")
         else:
             # Connessione a server Qdrant esterno
-            self.qdrant_client = QdrantClient(host=host, port=port)
-            print(f"🌐 Qdrant connesso al server {host}:{port}")
+            transport = f"gRPC :{grpc_port}" if prefer_grpc else "REST"
+            print(f"🌐 Qdrant connesso al server {host}:{port} ({transport})")
         return self.qdrant_client
     
-    def create_collection_if_not_exists(self, collection_name, vector_size=1536):
+    def initialize_flat_index(self, storage_path="./flat_index", dtype="float32"):
+        """
+        Usa come backend un indice piatto su file al posto dello storage locale di Qdrant
+        
+        I vettori stanno in una matrice .npy in memory-map e la ricerca (esatta) è
+        un prodotto matrice-vettore: con centinaia di migliaia di chunk risponde in
+        pochi millisecondi e si apre subito, senza caricare la collection in memoria.
+        Quantizzazione e parametri HNSW non si applicano.
+        
+        Args:
+            storage_path: Cartella degli indici (una sottocartella per collection)
+            dtype: "float32" oppure "float16" (metà memoria e disco, precisione ridotta)
+            
+        Returns:
+            FlatVectorstore instance
+        """
+        if self.qdrant_client:
+            # Rilascia il client (e, se nessun'altra istanza lo usa, il lock dello storage locale)
+            release_qdrant_client(self.qdrant_client)
+        self.use_memory = True
+        self.qdrant_client = None
+        self._a_qdrant_client = None
+        self.invalidate_components()
+        self.flat_store = shared_flat_store(storage_path, dtype)
+        print(f"📦 Indice piatto ({dtype}, memory-map) in: {storage_path}")
+        return self.flat_store
+    
+    def create_collection_if_not_exists(self, collection_name, vector_size=None, recreate=False,
+                                        quantization=None, hnsw_m=None, hnsw_ef_construct=None,
+                                        on_disk=None, on_disk_payload=None,
+                                        indexing_threshold=None, memmap_threshold=None, hybrid=False,
+                                        multitenant=False):
         """
         Crea una collection se non esiste
         
+        Una collection esistente viene mantenuta (indicizzazione incrementale),
+        a meno che recreate=True. Se dimensione dei vettori, modello di embedding o
+        vettore sparso (hybrid) non corrispondono viene ricreata solo se è vuota;
+        altrimenti solleva ValueError, per non cancellare i documenti indicizzati
+        (anche da altri tenant) con impostazioni diverse.
+        Modello e dimensione vengono salvati nei metadati della
+        collection, così le query possono verificarli (vedi check_collection_embedding).
+        Se cambiano solo quantizzazione, parametri HNSW, storage su disco o soglie
+        dell'optimizer, la collection viene aggiornata senza re-indicizzare:
+        Qdrant ricostruisce indici e segmenti in background.
+        
+        I parametri di tuning lasciati a None mantengono il default di Qdrant
+        (o il valore già impostato sulla collection). In modalità locale Qdrant
+        non costruisce indici HNSW e li ignora.
+        
         Args:
             collection_name: Nome della collection
-            vector_size: Dimensione dei vettori (1536 per small/ada, 3072 per large)
+            vector_size: Dimensione dei vettori (None = quella della configurazione di embedding)
+            recreate: Se True, cancella e ricrea la collection anche se esiste
+            quantization: None, "scalar" (int8, 4x meno RAM), "binary" (32x) o
+                          "product" (16x); i vettori originali restano disponibili
+                          per il rescoring (vedi build_quantization_config)
+            hnsw_m: Archi per nodo del grafo HNSW (default Qdrant: 16); valori più
+                    alti aumentano recall e memoria
+            hnsw_ef_construct: Ampiezza della ricerca durante la costruzione del
+                               grafo (default Qdrant: 100)
+            on_disk: Se True, i vettori originali restano su disco (memmap) e in RAM
+                     va solo l'indice (con la quantizzazione, i vettori quantizzati)
+            on_disk_payload: Se True, il payload (testo dei chunk) resta su disco
+            indexing_threshold: KB di vettori oltre cui un segmento viene indicizzato
+                                con HNSW (default Qdrant: 10000; 0 = mai, utile
+                                durante un'ingestione massiva)
+            memmap_threshold: KB di vettori oltre cui un segmento passa su disco (memmap)
+            hybrid: Se True, la collection ha anche un vettore sparso BM25 (IDF calcolato
+                    da Qdrant) per la ricerca ibrida; una collection esistente senza
+                    vettore sparso non può essere convertita (solo Qdrant)
+            multitenant: Se True, la collection è condivisa da più tenant (vedi tenant_id):
+                         Qdrant costruisce un grafo HNSW per ogni tenant invece di uno
+                         globale (payload_m=16, m=0), così il costo di una ricerca dipende
+                         dai dati del tenant; le ricerche senza tenant diventano esaustive
+            
+        Returns:
+            True se la collection è stata (ri)creata, False se esisteva già
+            
+        Raises:
+            ValueError: se la collection esistente è incompatibile, contiene points
+                        (di qualunque tenant) e recreate=False
         """
-        if not self.qdrant_client:
-            raise ValueError("Qdrant client non inizializzato. Chiama initialize_qdrant() prima.")
+        self._require_store()
+        if vector_size is None:
+            vector_size = self.vector_size
+        if self.flat_store:
+            if hybrid:
+                print("⚠️ La ricerca ibrida richiede Qdrant: con l'indice piatto la ricerca resta solo semantica")
+            return self._create_flat_collection(collection_name, vector_size, recreate)
+        quantization_config = build_quantization_config(quantization)
+        if multitenant and hnsw_m is None:
+            hnsw_m = 0
+        hnsw_config, optimizers_config = build_index_configs(
+            hnsw_m, hnsw_ef_construct, indexing_threshold, memmap_threshold,
+            payload_m=16 if multitenant else None
+        )
+        metadata = self.embedding_metadata()
         
-        try:
-            # Prova a ottenere la collection esistente
-            existing_collection = self.qdrant_client.get_collection(collection_name)
-            # Se esiste, cancellala per ricrearla con la struttura corretta
+        if self.qdrant_client.collection_exists(collection_name):
+            if not recreate:
+                collection_config = self.qdrant_client.get_collection(collection_name).config
+                vectors = collection_config.params.vectors
+                existing_size = vectors["default"].size if isinstance(vectors, dict) and "default" in vectors else None
+                existing_model = (collection_config.metadata or {}).get("embedding_model")
+                if existing_model and existing_model != self.embedding_model:
+                    self._check_recreate_allowed(
+                        collection_name, f"è indicizzata con {existing_model} invece di {self.embedding_model}"
+                    )
+                elif hybrid and SPARSE_VECTOR_NAME not in (collection_config.params.sparse_vectors or {}):
+                    # Qdrant non permette di aggiungere un vettore a una collection esistente
+                    self._check_recreate_allowed(
+                        collection_name, "non ha il vettore sparso BM25 della ricerca ibrida"
+                    )
+                elif existing_size == vector_size:
+                    if not existing_model:
+                        # Collection creata prima dei metadati: li aggiunge
+                        self.qdrant_client.update_collection(collection_name=collection_name, metadata=metadata)
+                    # In modalità locale Qdrant non applica la quantizzazione (ricerca sempre esatta)
+                    if not self.use_memory and collection_config.quantization_config != quantization_config:
+                        self.qdrant_client.update_collection(
+                            collection_name=collection_name,
+                            quantization_config=quantization_config or Disabled.DISABLED
+                        )
+                        print(f"Collection '{collection_name}': quantizzazione aggiornata a {quantization or 'nessuna'}")
+                    if not self.use_memory:
+                        updates = storage_config_updates(
+                            collection_config, hnsw_config, optimizers_config, on_disk, on_disk_payload
+                        )
+                        if updates:
+                            self.qdrant_client.update_collection(collection_name=collection_name, **updates)
+                            print(f"Collection '{collection_name}': aggiornati {', '.join(updates)}")
+                    self._create_payload_indexes(collection_name)
+                    self._adopt_untenanted_points(collection_name)
+                    return False
+                else:
+                    self._check_recreate_allowed(
+                        collection_name, f"ha vettori di dimensione {existing_size} invece di {vector_size}"
+                    )
+            
             self.qdrant_client.delete_collection(collection_name)
             print(f"Collection '{collection_name}' cancellata, verrà ricreata con la struttura corretta")
-        except:
-            # La collection non esiste, va bene
-            pass
         
         # Crea la collection con un nome esplicito per il vettore
         self.qdrant_client.create_collection(
             collection_name=collection_name,
             vectors_config={
-                "default": VectorParams(size=vector_size, distance=Distance.COSINE)
-            }
+                "default": VectorParams(size=vector_size, distance=Distance.COSINE, on_disk=on_disk)
+            },
+            quantization_config=quantization_config,
+            sparse_vectors_config={
+                SPARSE_VECTOR_NAME: SparseVectorParams(modifier=Modifier.IDF)
+            } if hybrid else None,
+            hnsw_config=hnsw_config,
+            optimizers_config=optimizers_config,
+            on_disk_payload=on_disk_payload,
+            metadata=metadata
         )
+        self._create_payload_indexes(collection_name)
+        # I componenti registrati potrebbero riferirsi alla collection precedente
+        self.invalidate_components()
+        return True
     
-    def index_documents(self, collection_name, chunks, progress_callback=None):
+    def _create_payload_indexes(self, collection_name):
         """
-        Indicizza i documenti nel vectorstore
+        Crea gli indici del payload mancanti (vedi PAYLOAD_INDEXES)
+        
+        Con gli indici Qdrant pianifica le ricerche filtrate (es. su un solo
+        documento) visitando solo i points che soddisfano il filtro invece di
+        scartarli durante la visita del grafo HNSW. In modalità locale Qdrant
+        non usa indici del payload e i filtri vengono valutati su ogni point.
         
         Args:
             collection_name: Nome della collection
-            chunks: Lista di chunk di testo da indicizzare
-            progress_callback: Funzione callback per aggiornare il progresso (opzionale)
-            
-        Returns:
-            Numero di chunk indicizzati
         """
-        if not self.qdrant_client:
-            raise ValueError("Qdrant client non inizializzato. Chiama initialize_qdrant() prima.")
+        if self.use_memory:
+            return
+        existing = self.qdrant_client.get_collection(collection_name).payload_schema or {}
+        for field_name, field_schema in PAYLOAD_INDEXES.items():
+            if field_name not in existing:
+                self.qdrant_client.create_payload_index(
+                    collection_name=collection_name, field_name=field_name, field_schema=field_schema
+                )
+                print(f"Collection '{collection_name}': indice del payload su '{field_name}'")
+    
+    def _adopt_untenanted_points(self, collection_name):
+        """
+        Assegna a DEFAULT_TENANT_ID i points indicizzati senza tenant_id
         
-        # Inizializza embedder
-        embedder = OpenAIEmbedder(
-            api_key=self.openai_api_key,
-            model_name=self.embedding_model
-        )
+        I chunk indicizzati prima dell'introduzione dei tenant non hanno il campo
+        nel payload e le ricerche limitate a un tenant non li troverebbero più. La
+        verifica viene fatta una volta per collection (di nuovo dopo
+        invalidate_components) e solo se è impostato un tenant_id.
         
-        points = []
+        Args:
+            collection_name: Nome della collection
+        """
+        if self.tenant_id is None or collection_name in self._adopted_collections:
+            return
+        if not self._collection_exists(collection_name):
+            return
+        tenant_payload = {"tenant_id": DEFAULT_TENANT_ID}
+        if self.flat_store:
+            index = self.flat_store.get_index(collection_name)
+            point_ids = index.missing_field_ids("tenant_id")
+            if point_ids:
+                index.set_payload(list(point_ids), tenant_payload)
+            adopted = len(point_ids)
+        else:
+            untenanted = Filter(must=[IsEmptyCondition(is_empty=PayloadField(key="tenant_id"))])
+            adopted = self.qdrant_client.count(
+                collection_name=collection_name, count_filter=untenanted, exact=True
+            ).count
+            if adopted:
+                self.qdrant_client.set_payload(
+                    collection_name=collection_name, payload=tenant_payload, points=untenanted
+                )
+        self._adopted_collections.add(collection_name)
+        if adopted:
+            print(f"🏷️ Collection '{collection_name}': {adopted} chunks senza area di lavoro "
+                  f"assegnati a '{DEFAULT_TENANT_ID}'")
+    
+    def is_hybrid_collection(self, collection_name):
+        """
+        True se la collection ha il vettore sparso BM25 (vedi create_collection_if_not_exists)
         
-        for i, chunk in enumerate(chunks):
-            # Genera embedding
-            embedding_result = embedder.run(text=chunk)
-            
-            # L'embedder restituisce direttamente una lista o un dict con 'embedding'
-            if isinstance(embedding_result, list):
-                embedding = embedding_result
-            elif isinstance(embedding_result, dict):
-                embedding = embedding_result.get("embedding", embedding_result.get("vector", []))
-            else:
-                raise ValueError(f"Formato embedding non valido: {type(embedding_result)}")
-            
-            # Crea point per Qdrant
-            point = PointStruct(
-                id=str(uuid.uuid4()),
-                vector={"default": embedding},  # Specifica il nome del vettore
-                payload={"text": chunk}
-            )
-            points.append(point)
+        Args:
+            collection_name: Nome della collection
             
-            # Callback per progress bar
-            if progress_callback:
-                progress_callback(i + 1, len(chunks))
-        
-        # Carica i points in Qdrant
-        self.qdrant_client.upsert(
-            collection_name=collection_name,
-            points=points
-        )
+        Returns:
+            True o False, None se la collection non esiste (o non c'è un backend)
+        """
+        if not self._collection_exists(collection_name):
+            return None
+        if self.flat_store:
+            return False
+        sparse_vectors = self.qdrant_client.get_collection(collection_name).config.params.sparse_vectors
+        return SPARSE_VECTOR_NAME in (sparse_vectors or {})
+    
+    def count_points(self, collection_name):
+        """
+        Numero di chunk indicizzati in una collection
         
-        return len(points)
+        Args:
+            collection_name: Nome della collection
+            
+        Returns:
+            Numero di points (0 se la collection non esiste); con un tenant_id
+            solo quelli del tenant
+        """
+        if not self._collection_exists(collection_name):
+            return 0
+        self._adopt_untenanted_points(collection_name)
+        filters = self._scoped_filters()
+        if self.flat_store:
+            index = self.flat_store.get_index(collection_name)
+            return len(index.filter_rows(filters)) if filters else len(index)
+        if filters:
+            return self.qdrant_client.count(
+                collection_name=collection_name, count_filter=build_payload_filter(filters), exact=True
+            ).count
+        return self.qdrant_client.get_collection(collection_name).points_count or 0
     
-    def create_pipeline(self, collection_name, k=3, temperature=0.0, 
-                       system_prompt="Riscrivi le query dell'utente per migliorare l'accuratezza del recupero.",
-                       user_prompt_template="Domanda dell'utente: {{user_prompt}}\n",
-                       retrieval_prompt_template="Contenuto recuperato:\n{% for chunk in chunks %}{{ chunk.text }}\n{% endfor %}"):
+    def list_documents(self, collection_name, field="filename", limit=1000):
         """
-        Crea la pipeline RAG completa
+        Valori distinti di un campo del payload, es. i file indicizzati (per i filtri)
         
         Args:
-            collection_name: Nome della collection Qdrant
-            k: Numero di documenti da recuperare (default: 3)
-            temperature: Temperature per la generazione (default: 0.0 per risposte deterministiche)
-            system_prompt: Prompt di sistema per il rewriter
-            user_prompt_template: Template per la domanda utente
-            retrieval_prompt_template: Template per il contesto recuperato
+            collection_name: Nome della collection
+            field: Campo del payload (default: "filename")
+            limit: Numero massimo di valori
             
         Returns:
-            DagPipeline configurata
+            Lista ordinata dei valori (vuota se la collection non esiste); con
+            un tenant_id solo quelli dei documenti del tenant. Per "document_id"
+            comprende i documenti rappresentati solo da chunk deduplicati.
         """
-        # Inizializza componenti
-        openai_client = OpenAIClient(
-            model=self.model_name,
-            api_key=self.openai_api_key,
-            temperature=temperature
-            # Nota: max_tokens viene passato nella chiamata, non nel costruttore
-        )
+        if not self._collection_exists(collection_name):
+            return []
+        self._adopt_untenanted_points(collection_name)
+        filters = self._scoped_filters()
+        fields = DOCUMENT_FIELDS if field == "document_id" else (field,)
+        values = set()
+        for key in fields:
+            if self.flat_store:
+                values |= self.flat_store.get_index(collection_name).field_values(key, filters)
+                continue
+            # facet usa l'indice del payload del campo (vedi PAYLOAD_INDEXES)
+            hits = self.qdrant_client.facet(
+                collection_name=collection_name, key=key, limit=limit,
+                facet_filter=build_payload_filter(filters)
+            ).hits
+            values.update(hit.value for hit in hits)
+        return sorted(values)[:limit]
+    
+    def _create_flat_collection(self, collection_name, vector_size, recreate=False):
+        """Versione di create_collection_if_not_exists per l'indice piatto"""
+        metadata = self.embedding_metadata()
+        if self.flat_store.collection_exists(collection_name) and not recreate:
+            existing_size, existing_metadata = self._collection_embedding(collection_name)
+            existing_model = existing_metadata.get("embedding_model")
+            if existing_model and existing_model != self.embedding_model:
+                self._check_recreate_allowed(
+                    collection_name, f"è indicizzata con {existing_model} invece di {self.embedding_model}"
+                )
+            elif existing_size == vector_size:
+                if not existing_model:
+                    self.flat_store.get_index(collection_name).update_metadata(metadata)
+                self._adopt_untenanted_points(collection_name)
+                return False
+            else:
+                self._check_recreate_allowed(
+                    collection_name, f"ha vettori di dimensione {existing_size} invece di {vector_size}"
+                )
+        self.flat_store.create_collection(collection_name, vector_size, metadata=metadata)
+        self.invalidate_components()
+        return True
+    
+    def _check_recreate_allowed(self, collection_name, reason):
+        """
+        Verifica che una collection incompatibile possa essere ricreata senza perdere dati
         
-        embedder = OpenAIEmbedder(
-            api_key=self.openai_api_key,
-            model_name=self.embedding_model
-        )
+        La collection è condivisa se contiene points di tenant diversi da quello
+        corrente: il messaggio lo segnala, perché ricrearla cancellerebbe anche i
+        loro documenti.
         
-        # Inizializza vectorstore con gli stessi parametri usati per l'indicizzazione
-        if self.use_memory:
-            # IMPORTANTE: Riutilizziamo lo stesso client Qdrant già creato
-            # Non possiamo creare un nuovo client perché Qdrant blocca accessi multipli allo stesso storage
-            vectorstore = QdrantVectorstore(host="localhost", port=6333)
-            vectorstore.client = self.qdrant_client  # Usa il client già esistente!
+        Args:
+            collection_name: Nome della collection
+            reason: Descrizione dell'incompatibilità (es. "ha vettori di dimensione 256 invece di 1536")
+            
+        Raises:
+            ValueError: se la collection contiene points
+        """
+        # Tutti i points, non solo quelli del tenant corrente
+        if self.flat_store:
+            index = self.flat_store.get_index(collection_name)
+            total = len(index)
+            own = len(index.point_ids(self._scoped_filters())) if self.tenant_id is not None else None
         else:
-            vectorstore = QdrantVectorstore(host=self.qdrant_host, port=self.qdrant_port)
-        
-        # Crea pipeline
-        dag_pipeline = DagPipeline()
-        dag_pipeline.add_module(
-            "rewriter", 
-            ToolRewriter(
-                client=openai_client, 
-                system_prompt=system_prompt
-            )
-        )
-        dag_pipeline.add_module("embedder", embedder)
-        dag_pipeline.add_module(
-            "retriever", 
-            vectorstore.as_retriever(
-                collection_name=collection_name, 
-                k=k,
-                vector_name="default"  # Specifica il nome del vettore
-            )
-        )
-        dag_pipeline.add_module(
-            "prompt", 
-            ChatPromptTemplate(
-                user_prompt_template=user_prompt_template,
-                retrieval_prompt_template=retrieval_prompt_template
+            total = self.qdrant_client.count(collection_name=collection_name, exact=True).count
+            own = self.qdrant_client.count(
+                collection_name=collection_name,
+                count_filter=build_payload_filter(self._scoped_filters()),
+                exact=True
+            ).count if self.tenant_id is not None and total else None
+        if total:
+            shared = ""
+            if own is not None and total > own:
+                shared = f" (condivisa tra le aree di lavoro: {total - own} chunks non sono di '{self.tenant_id}')"
+            raise ValueError(
+                f"La collection '{collection_name}'{shared} {reason}: ricrearla cancellerebbe i "
+                f"{total} chunks indicizzati. Ripristina le impostazioni usate per indicizzarla, "
+                f"usa un'altra collection oppure ricreala esplicitamente (recreate=True)."
             )
-        )
-        dag_pipeline.add_module("generator", openai_client)
-        
-        # Connetti i moduli
-        dag_pipeline.connect("rewriter", "embedder", target_key="text")
-        dag_pipeline.connect("embedder", "retriever", target_key="query_vector")
-        dag_pipeline.connect("retriever", "prompt", target_key="chunks")
-        dag_pipeline.connect("prompt", "generator", target_key="memory")
-        
-        return dag_pipeline
+        print(f"Collection '{collection_name}' (vuota) {reason}, verrà ricreata")
     
-    def query(self, pipeline, user_query, collection_name, k=3):
+    def quantization_report(self, collection_name, sample_size=100, k=10, search_options=None):
         """
-        Esegue una query sulla pipeline RAG
+        Confronta memoria e recall della collection quantizzata con la ricerca esatta
+        
+        Come query vengono usati sample_size vettori della collection stessa: per
+        ognuno si confrontano i primi k risultati della ricerca esatta (vettori
+        float32) con quelli della ricerca quantizzata, senza e con rescoring.
         
         Args:
-            pipeline: DagPipeline configurata
-            user_query: Query dell'utente
             collection_name: Nome della collection
-            k: Numero di documenti da recuperare
+            sample_size: Numero di vettori da usare come query (default: 100)
+            k: Numero di risultati confrontati per query (default: 10)
+            search_options: Opzioni di ricerca da valutare (default: self.search_options)
             
         Returns:
-            Tuple (response, sources) dove:
-                - response: La risposta generata
-                - sources: Lista dei chunk recuperati
+            Dizionario con dimensioni in memoria, rapporto di compressione e recall@k
         """
-        result = pipeline.run({
-            "rewriter": {"user_prompt": user_query},
-            "prompt": {"user_prompt": user_query},
-            "retriever": {"collection_name": collection_name, "k": k},
-            "generator": {"input": user_query}
-        })
+        if not self.qdrant_client:
+            raise ValueError("Il report di quantizzazione richiede Qdrant. Chiama initialize_qdrant() prima.")
         
-        # Estrai risposta e fonti
-        raw_response = result['generator']
-        
-        # Il generatore può restituire diversi formati
-        if isinstance(raw_response, str):
-            # È già una stringa
-            response = raw_response
-        elif hasattr(raw_response, 'content'):
-            # È un oggetto ClientResponse con content
-            if isinstance(raw_response.content, list) and len(raw_response.content) > 0:
-                # content è una lista di TextBlock
-                text_blocks = []
-                for block in raw_response.content:
-                    if hasattr(block, 'content'):
-                        text_blocks.append(block.content)
-                    elif hasattr(block, 'text'):
-                        text_blocks.append(block.text)
-                response = '\n'.join(text_blocks)
-            elif isinstance(raw_response.content, str):
-                response = raw_response.content
-            else:
-                response = str(raw_response.content)
-        elif hasattr(raw_response, 'text'):
-            # Ha un attributo text
-            response = raw_response.text
-        elif hasattr(raw_response, 'message'):
-            # Ha un attributo message
-            if hasattr(raw_response.message, 'content'):
-                response = raw_response.message.content
-            else:
-                response = str(raw_response.message)
+        info = self.qdrant_client.get_collection(collection_name)
+        dimensions = info.config.params.vectors["default"].size
+        quantization = quantization_name(info.config.quantization_config)
+        num_points = info.points_count or 0
+        
+        float_bytes = num_points * dimensions * 4
+        quantized_bytes = int(float_bytes / QUANTIZATION_COMPRESSION[quantization])
+        
+        options = {**self.search_options, **(search_options or {})}
+        points, _ = self.qdrant_client.scroll(
+            collection_name=collection_name, limit=sample_size, with_vectors=["default"], with_payload=False
+        )
+        
+        def top_ids(vector, params):
+            hits = self.qdrant_client.query_points(
+                collection_name=collection_name, query=vector, using="default",
+                limit=k, search_params=params, with_payload=False
+            )
+            return {hit.id for hit in hits.points}
+        
+        if self.use_memory:
+            print("⚠️ Qdrant in modalità locale esegue sempre ricerche esatte: "
+                  "la recall è significativa solo con un server Qdrant")
+            exact = raw = rescored = None
         else:
-            # Fallback: converti a stringa
-            response = str(raw_response)
-        
-        retrieved_chunks = result.get('retriever', [])
-        
-        # I chunk possono essere oggetti Chunk o dizionari
-        sources = []
-        for chunk in retrieved_chunks:
-            if hasattr(chunk, 'text'):
-                # È un oggetto Chunk con attributo text
-                sources.append(chunk.text)
-            elif isinstance(chunk, dict) and 'text' in chunk:
-                # È un dizionario con chiave 'text'
-                sources.append(chunk['text'])
-            elif hasattr(chunk, 'payload') and isinstance(chunk.payload, dict):
-                # È un oggetto con payload che contiene text
-                sources.append(chunk.payload.get('text', ''))
+            exact = SearchParams(exact=True, quantization=QuantizationSearchParams(ignore=True))
+            raw = build_search_params({**options, "rescore": False, "oversampling": None})
+            rescored = build_search_params(options)
+        recall_raw = recall_rescored = 0.0
+        for point in points:
+            vector = point.vector["default"]
+            truth = top_ids(vector, exact)
+            if truth:
+                recall_raw += len(truth & top_ids(vector, raw)) / len(truth)
+                recall_rescored += len(truth & top_ids(vector, rescored)) / len(truth)
         
-        return response, sources
+        report = {
+            "collection": collection_name,
+            "points": num_points,
+            "dimensions": dimensions,
+            "quantization": quantization or "none",
+            "float32_mb": round(float_bytes / 1024 ** 2, 2),
+            "quantized_mb": round(quantized_bytes / 1024 ** 2, 2),
+            "compression": QUANTIZATION_COMPRESSION[quantization],
+            "recall_at_k": k,
+            "recall_without_rescore": round(recall_raw / len(points), 4) if points else None,
+            "recall_with_rescore": round(recall_rescored / len(points), 4) if points else None,
+        }
+        print(f"📐 Quantizzazione '{collection_name}' ({report['quantization']}): "
+              f"{report['float32_mb']} MB -> {report['quantized_mb']} MB in RAM (x{report['compression']}), "
+              f"recall@{k} {report['recall_without_rescore']} senza rescoring, "
+              f"{report['recall_with_rescore']} con rescoring")
+        return report
     
-    def query_stream(self, pipeline, user_query, collection_name, k=3):
+    def index_documents(self, collection_name, chunks, progress_callback=None,
+                        batch_size=100, max_tokens_per_request=100_000,
+                        max_concurrency=4, requests_per_minute=3000, tokens_per_minute=1_000_000,
+                        upsert_batch_size=256, wait=True, incremental=True, deduplicate=False,
+                        resume_from=0, checkpoint_callback=None):
         """
-        Esegue una query sulla pipeline RAG con streaming della risposta
+        Indicizza i documenti nel vectorstore
+        
+        Ogni chunk riceve un ID deterministico (uuid5 di documento + hash del testo).
+        In modalità incrementale i chunk già presenti nella collection vengono
+        saltati, e per ogni documento indicizzato vengono rimossi i chunk che non
+        ne fanno più parte: il costo cresce con la modifica, non con il corpus.
+        
+        Gli embedding vengono richiesti a batch: ogni chiamata all'API contiene
+        fino a batch_size chunk e al massimo max_tokens_per_request token stimati.
+        I batch vengono inviati in parallelo da un EmbeddingScheduler che rispetta
+        i limiti al minuto del provider; l'ordine dei chunk viene mantenuto.
+        I points vengono scritti in Qdrant a blocchi di upsert_batch_size man mano
+        che arrivano gli embedding: la memoria resta costante e, in caso di errore,
+        i blocchi già scritti restano nella collection.
         
         Args:
-            pipeline: DagPipeline configurata
-            user_query: Query dell'utente
             collection_name: Nome della collection
-            k: Numero di documenti da recuperare
+            chunks: Lista di chunk da indicizzare: stringhe oppure dizionari con
+                    chiave "text", "document_id" opzionale e altri metadati per il payload
+            progress_callback: Funzione callback per aggiornare il progresso (opzionale),
+                               chiamata una volta per ogni batch
+            batch_size: Numero massimo di chunk per richiesta di embedding (default: 100)
+            max_tokens_per_request: Limite di token stimati per richiesta (default: 100000)
+            max_concurrency: Numero massimo di richieste di embedding in parallelo (default: 4)
+            requests_per_minute: Budget di richieste al minuto (default: 3000)
+            tokens_per_minute: Budget di token al minuto (default: 1000000)
+            upsert_batch_size: Numero di points per ogni upsert in Qdrant (default: 256)
+            wait: Se False, non attende che Qdrant applichi ogni upsert prima di
+                  proseguire (modalità pipeline, utile con un server Qdrant)
+            incremental: Se True, salta i chunk già indicizzati e rimuove quelli
+                         obsoleti dei documenti indicizzati (default: True)
+            deduplicate: Se True (o un ChunkDeduplicator), scarta prima dell'embedding i
+                         chunk duplicati o quasi duplicati; il chunk tenuto registra nel
+                         payload i documenti che rappresenta ("sources") e le copie rimosse
+            resume_from: Numero di chunk (dopo la deduplicazione) già scritti da
+                         un'indicizzazione interrotta degli stessi documenti: vengono
+                         riletti per calcolarne gli ID, ma non re-indicizzati
+            checkpoint_callback: Funzione chiamata dopo ogni upsert con il numero di
+                                 chunk completati (da passare come resume_from per
+                                 riprendere) e le statistiche; può interrompere
+                                 l'indicizzazione sollevando un'eccezione
             
-        Yields:
-            Tuple (chunk_text, sources) dove:
-                - chunk_text: Chunk di testo della risposta (streaming)
-                - sources: Lista dei chunk recuperati (solo nel primo yield)
+        Returns:
+            Numero di chunk nuovi o modificati scritti nella collection
         """
-        # Prima esegui retrieval e rewriting
-        from datapizza.clients.openai import OpenAIClient
-        from datapizza.embedders.openai import OpenAIEmbedder
-        from datapizza.modules.rewriters import ToolRewriter
+        self._require_store()
+        self._adopt_untenanted_points(collection_name)
+        total = len(chunks) if hasattr(chunks, "__len__") else None
+        stats = {"indexed": 0, "skipped": 0, "deleted": 0, "duplicates": 0}
+        document_point_ids = {}
+        content_point_ids = {}
         
-        # Inizializza componenti per le operazioni preliminari
-        openai_client = OpenAIClient(
-            model=self.model_name,
-            api_key=self.openai_api_key
-        )
+        deduplicator = ChunkDeduplicator() if deduplicate is True else deduplicate or None
+        if deduplicator:
+            def on_duplicate(chunk):
+                # Il documento resta tra quelli re-indicizzati anche se tutti i suoi chunk sono duplicati
+                stats["duplicates"] += 1
+                if chunk.get("document_id") is not None:
+                    document_point_ids.setdefault(chunk["document_id"], set())
+            
+            chunks = deduplicator.filter(chunks, on_duplicate=on_duplicate)
         
-        embedder = OpenAIEmbedder(
-            api_key=self.openai_api_key,
-            model_name=self.embedding_model
-        )
+        def prepare_records():
+            # Assegna a ogni chunk un ID deterministico
+            occurrences = {}
+            for position, chunk in enumerate(chunks):
+                record = {"text": chunk} if isinstance(chunk, str) else dict(chunk)
+                if self.tenant_id is not None:
+                    record["tenant_id"] = self.tenant_id
+                document_id = record.get("document_id")
+                digest = hashlib.sha256(record["text"].encode("utf-8")).hexdigest()
+                occurrence = occurrences.get((document_id, digest), 0)
+                occurrences[(document_id, digest)] = occurrence + 1
+                record["id"] = chunk_point_id(document_id, digest, occurrence, self.tenant_id)
+                if document_id is not None:
+                    document_point_ids.setdefault(document_id, set()).add(record["id"])
+                if "content_hash" in record:
+                    content_point_ids[record["content_hash"]] = record["id"]
+                if position < resume_from:
+                    # Già scritto prima dell'interruzione
+                    stats["skipped"] += 1
+                    continue
+                record["_position"] = position
+                yield record
         
-        rewriter = ToolRewriter(
-            client=openai_client,
-            system_prompt="Riscrivi le query dell'utente per migliorare l'accuratezza del recupero."
-        )
+        def skip_existing(records, group_size=256):
+            # Interroga Qdrant a gruppi per sapere quali chunk sono già presenti
+            group = []
+            for record in records:
+                group.append(record)
+                if len(group) >= group_size:
+                    yield from self._filter_existing_points(collection_name, group, stats)
+                    group = []
+            if group:
+                yield from self._filter_existing_points(collection_name, group, stats)
         
-        # Rewrite query
-        rewritten = rewriter.run(user_prompt=user_query)
-        rewritten_text = rewritten.get("text", user_query) if isinstance(rewritten, dict) else user_query
+        records = prepare_records()
+        if incremental:
+            records = skip_existing(records)
         
-        # Generate embedding
-        embedding_result = embedder.run(text=rewritten_text)
-        if isinstance(embedding_result, list):
-            query_vector = embedding_result
-        elif isinstance(embedding_result, dict):
-            query_vector = embedding_result.get("embedding", embedding_result.get("vector", []))
-        else:
-            query_vector = []
+        # Nelle collection ibride ogni point ha anche il vettore sparso BM25
+        hybrid = bool(self.is_hybrid_collection(collection_name))
         
-        # Retrieve documents
-        if self.use_memory:
-            vectorstore_retriever = QdrantVectorstore(host="localhost", port=6333)
-            vectorstore_retriever.client = self.qdrant_client
-        else:
-            vectorstore_retriever = QdrantVectorstore(host=self.qdrant_host, port=self.qdrant_port)
+        # Inizializza embedder (con cache: i chunk già visti non vengono ricalcolati)
+        embedder = self.create_embedder()
         
-        retriever = vectorstore_retriever.as_retriever(
-            collection_name=collection_name,
-            k=k,
-            vector_name="default"
+        scheduler = EmbeddingScheduler(
+            lambda batch: embedder.embed([record["text"] for record in batch]),
+            max_concurrency=max_concurrency,
+            requests_per_minute=requests_per_minute,
+            tokens_per_minute=tokens_per_minute,
+            token_counter=chunk_tokens
         )
         
-        retrieved_chunks = retriever.run(query_vector=query_vector, collection_name=collection_name, k=k)
+        points = []
+        # Posizione nella sequenza dei chunk dell'ultimo point preparato
+        last_position = resume_from - 1
         
-        # Extract sources
-        sources = []
-        for chunk in retrieved_chunks:
-            if hasattr(chunk, 'text'):
-                sources.append(chunk.text)
-            elif isinstance(chunk, dict) and 'text' in chunk:
-                sources.append(chunk['text'])
-            elif hasattr(chunk, 'payload') and isinstance(chunk.payload, dict):
-                sources.append(chunk.payload.get('text', ''))
+        def flush(points):
+            # Scrive il blocco e registra il checkpoint: sono completati i chunk fino
+            # all'ultimo scritto (quelli saltati prima di lui erano già presenti)
+            self._upsert_points(collection_name, points, wait)
+            stats["indexed"] += len(points)
+            if checkpoint_callback:
+                checkpoint_callback(last_position + 1, dict(stats))
         
-        # Build context
-        context = f"Domanda dell'utente: {user_query}\n\nContenuto recuperato:\n"
-        for chunk_text in sources:
-            context += f"{chunk_text}\n"
+        # Genera gli embedding (una richiesta per batch, più richieste in volo)
+        batches = iter_embedding_batches(records, batch_size, max_tokens_per_request)
+        for batch, embeddings in scheduler.map(batches):
+            for record, embedding in zip(batch, embeddings):
+                vector = {"default": embedding}  # Specifica il nome del vettore
+                if hybrid:
+                    indices, values = self.sparse_encoder.encode_document(record["text"])
+                    if indices:
+                        vector[SPARSE_VECTOR_NAME] = SparseVector(indices=indices, values=values)
+                
+                # Crea point per Qdrant
+                last_position = record.pop("_position")
+                point = PointStruct(
+                    id=record["id"],
+                    vector=vector,
+                    payload={key: value for key, value in record.items() if key != "id"}
+                )
+                points.append(point)
+                
+                # Carica i points in Qdrant appena il blocco è pieno
+                if len(points) >= upsert_batch_size:
+                    flush(points)
+                    points = []
+            
+            # Callback per progress bar (una volta per batch)
+            if progress_callback:
+                progress_callback(stats["skipped"] + stats["duplicates"] + stats["indexed"] + len(points), total)
         
-        # Stream response
-        first_chunk = True
-        for chunk in openai_client.stream_invoke(context):
-            if chunk.delta:
-                if first_chunk:
-                    # Nel primo chunk, invia anche le fonti
-                    yield chunk.delta, sources
-                    first_chunk = False
-                else:
-                    yield chunk.delta, None
-
-
-# Funzioni helper per il processing dei documenti
-
-def extract_text_from_pdf(pdf_file):
-    """
-    Estrae il testo da un file PDF
-    
-    Args:
-        pdf_file: File PDF (file-like object)
+        # Carica gli ultimi points rimasti
+        if points:
+            flush(points)
         
-    Returns:
-        Testo estratto dal PDF
-    """
-    pdf_reader = PdfReader(pdf_file)
-    text = ""
+        # Aggiorna le fonti dei chunk che rappresentano duplicati trovati dopo il loro upsert
+        if deduplicator:
+            self._update_duplicate_sources(collection_name, deduplicator, content_point_ids, wait)
+            # Il chunk tenuto è valido anche per i documenti di cui ha scartato i duplicati
+            for entry in deduplicator.updated_chunks():
+                if entry["content_hash"] in content_point_ids:
+                    for source in entry["sources"]:
+                        document_point_ids.setdefault(source, set()).add(content_point_ids[entry["content_hash"]])
+        
+        # Rimuove i chunk che non fanno più parte dei documenti re-indicizzati
+        if incremental:
+            for document_id, point_ids in document_point_ids.items():
+                stats["deleted"] += self._delete_stale_points(collection_name, document_id, point_ids)
+        
+        if progress_callback:
+            progress_callback(stats["skipped"] + stats["duplicates"] + stats["indexed"], total)
+        
+        self.last_index_stats = stats
+        print(f"📥 Indicizzazione '{collection_name}': {stats['indexed']} nuovi/modificati, "
+              f"{stats['skipped']} invariati, {stats['duplicates']} duplicati scartati, "
+              f"{stats['deleted']} obsoleti rimossi")
+        
+        return stats["indexed"]
+    
+    def _upsert_points(self, collection_name, points, wait=True):
+        """Scrive un blocco di points nel backend configurato"""
+        if self.flat_store:
+            self.flat_store.get_index(collection_name).upsert(
+                [point.id for point in points],
+                [point.vector["default"] for point in points],
+                [point.payload for point in points]
+            )
+            return
+        self.qdrant_client.upsert(collection_name=collection_name, points=points, wait=wait)
+    
+    def _update_duplicate_sources(self, collection_name, deduplicator, content_point_ids, wait=True,
+                                  group_size=256):
+        """
+        Scrive nel payload dei chunk tenuti le fonti dei duplicati scartati
+        
+        Args:
+            collection_name: Nome della collection
+            deduplicator: ChunkDeduplicator usato per l'indicizzazione
+            content_point_ids: Mappa content_hash -> ID del point
+            wait: Se True, attende l'applicazione degli aggiornamenti
+            group_size: Numero di aggiornamenti per richiesta
+        """
+        if self.flat_store:
+            index = self.flat_store.get_index(collection_name)
+            for entry in deduplicator.updated_chunks():
+                if entry["content_hash"] in content_point_ids:
+                    index.set_payload(
+                        [content_point_ids[entry["content_hash"]]],
+                        {"sources": entry["sources"], "duplicates": entry["duplicates"]}
+                    )
+            return
+        operations = [
+            SetPayloadOperation(set_payload=SetPayload(
+                payload={"sources": entry["sources"], "duplicates": entry["duplicates"]},
+                points=[content_point_ids[entry["content_hash"]]]
+            ))
+            for entry in deduplicator.updated_chunks()
+            if entry["content_hash"] in content_point_ids
+        ]
+        for start in range(0, len(operations), group_size):
+            self.qdrant_client.batch_update_points(
+                collection_name=collection_name,
+                update_operations=operations[start:start + group_size],
+                wait=wait
+            )
+    
+    def _filter_existing_points(self, collection_name, records, stats):
+        """
+        Restituisce solo i record il cui ID non è ancora presente nella collection
+        
+        Args:
+            collection_name: Nome della collection
+            records: Lista di record con chiave "id"
+            stats: Dizionario delle statistiche, aggiorna il contatore "skipped"
+            
+        Returns:
+            Lista dei record da indicizzare
+        """
+        ids = [record["id"] for record in records]
+        if self.flat_store:
+            existing_ids = self.flat_store.get_index(collection_name).existing_ids(ids)
+        else:
+            existing = self.qdrant_client.retrieve(
+                collection_name=collection_name,
+                ids=ids,
+                with_payload=False,
+                with_vectors=False
+            )
+            existing_ids = {str(point.id) for point in existing}
+        stats["skipped"] += len(existing_ids)
+        return [record for record in records if record["id"] not in existing_ids]
+    
+    def _delete_stale_points(self, collection_name, document_id, point_ids, group_size=256):
+        """
+        Cancella i points di un documento che non sono tra quelli appena indicizzati
+        
+        Un chunk deduplicato che rappresenta anche altri documenti ("sources") non
+        viene cancellato: il documento viene tolto dalle sue fonti e, se ne era il
+        proprietario, il chunk passa alla prima fonte rimasta, senza filename, page
+        e chunk_offset, che si riferivano al documento re-indicizzato.
+        
+        Args:
+            collection_name: Nome della collection
+            document_id: ID del documento
+            point_ids: Insieme degli ID validi per il documento
+            group_size: Numero di points letti o aggiornati per richiesta
+            
+        Returns:
+            Numero di points cancellati
+        """
+        # Solo i points del documento (o che lo rappresentano) nel tenant corrente
+        document_filter = self._scoped_filters({"document_id": document_id})
+        if self.flat_store:
+            index = self.flat_store.get_index(collection_name)
+            stale = index.retrieve(list(index.point_ids(document_filter) - set(point_ids)))
+        else:
+            stale_filter = Filter(
+                must=build_payload_filter(document_filter).must,
+                must_not=[HasIdCondition(has_id=list(point_ids))]
+            )
+            stale, offset = [], None
+            while True:
+                records, offset = self.qdrant_client.scroll(
+                    collection_name=collection_name,
+                    scroll_filter=stale_filter,
+                    limit=group_size,
+                    offset=offset,
+                    with_payload=["document_id", "sources"],
+                    with_vectors=False
+                )
+                stale.extend((str(record.id), record.payload) for record in records)
+                if offset is None:
+                    break
+        
+        deleted, updates = [], []
+        for point_id, payload in stale:
+            remaining = [source for source in payload.get("sources") or [] if source != document_id]
+            if payload.get("document_id") != document_id:
+                updates.append((point_id, {"sources": remaining}))
+            elif remaining:
+                updates.append((point_id, {
+                    "document_id": remaining[0], "sources": remaining,
+                    "filename": None, "page": None, "chunk_offset": None
+                }))
+            else:
+                deleted.append(point_id)
+        
+        if self.flat_store:
+            for point_id, payload in updates:
+                index.set_payload([point_id], payload)
+            return index.delete(deleted)
+        operations = [
+            SetPayloadOperation(set_payload=SetPayload(payload=payload, points=[point_id]))
+            for point_id, payload in updates
+        ]
+        for start in range(0, len(operations), group_size):
+            self.qdrant_client.batch_update_points(
+                collection_name=collection_name,
+                update_operations=operations[start:start + group_size]
+            )
+        if deleted:
+            self.qdrant_client.delete(collection_name=collection_name, points_selector=PointIdsList(points=deleted))
+        return len(deleted)
+    
+    def update_settings(self, openai_api_key=None, model_name=None, embedding_model=None,
+                        temperature=None, system_prompt=None, user_prompt_template=None,
+                        retrieval_prompt_template=None, embedding_dimensions=None,
+                        max_context_tokens=None, tenant_id=None):
+        """
+        Aggiorna le impostazioni del sistema (es. dalla sidebar) e invalida i componenti se cambiano
+        
+        Args:
+            openai_api_key: API key di OpenAI
+            model_name: Nome del modello LLM
+            embedding_model: Nome del modello di embedding
+            temperature: Temperature di default per la generazione
+            system_prompt: Prompt di sistema per il rewriter
+            user_prompt_template: Template per la domanda utente
+            retrieval_prompt_template: Template per il contesto recuperato
+            embedding_dimensions: Dimensione dei vettori di embedding
+            max_context_tokens: Budget di token del contenuto recuperato nel prompt
+            tenant_id: Tenant su cui operano indicizzazione e ricerche
+            
+        Returns:
+            True se almeno un'impostazione è cambiata
+        """
+        settings = {
+            "openai_api_key": openai_api_key,
+            "model_name": model_name,
+            "embedding_model": embedding_model,
+            "temperature": temperature,
+            "system_prompt": system_prompt,
+            "user_prompt_template": user_prompt_template,
+            "retrieval_prompt_template": retrieval_prompt_template,
+            "embedding_dimensions": embedding_dimensions,
+            "max_context_tokens": max_context_tokens,
+            "tenant_id": tenant_id,
+        }
+        changed = [
+            name for name, value in settings.items()
+            if value is not None and getattr(self, name) != value
+        ]
+        for name in changed:
+            setattr(self, name, settings[name])
+        
+        # La temperature fa già parte della chiave del registro, mentre budget del
+        # contesto e tenant si applicano a ogni query: non serve invalidare
+        if any(name not in ("temperature", "max_context_tokens", "tenant_id") for name in changed):
+            self.invalidate_components()
+        return bool(changed)
+    
+    def invalidate_components(self):
+        """Svuota il registro dei componenti: verranno ricreati alla prossima query"""
+        with self._components_lock:
+            self._components.clear()
+            self._vectorstore = None
+            self._adopted_collections.clear()
+    
+    def _get_vectorstore(self):
+        """
+        Restituisce il vectorstore condiviso, collegato al client Qdrant già creato
+        
+        Returns:
+            QdrantVectorstore, oppure FlatVectorstore se è configurato l'indice piatto
+        """
+        self._require_store()
+        if self.flat_store:
+            return self.flat_store
+        
+        if self._vectorstore is None:
+            # IMPORTANTE: Riutilizziamo lo stesso client Qdrant già creato
+            # Non possiamo creare un nuovo client perché Qdrant blocca accessi multipli allo stesso storage,
+            # e con un server evitiamo una nuova connessione per ogni domanda
+            vectorstore = QdrantVectorstore(host=self.qdrant_host, port=self.qdrant_port)
+            vectorstore.client = self.qdrant_client  # Usa il client già esistente!
+            if not self.use_memory:
+                # Anche le query asincrone usano un solo client, con le stesse opzioni di connessione
+                vectorstore.a_client = self._get_async_qdrant_client()
+            self._vectorstore = vectorstore
+        return self._vectorstore
+    
+    def _get_async_qdrant_client(self):
+        """
+        Restituisce il client asincrono del server Qdrant, creandolo al primo utilizzo
+        
+        Sopravvive alla ricreazione dei componenti: il pool di connessioni resta
+        aperto tra le query. Come gli altri client asincroni va usato da un solo
+        event loop.
+        """
+        if self._a_qdrant_client is None:
+            self._a_qdrant_client = AsyncQdrantClient(
+                host=self.qdrant_host, port=self.qdrant_port, **self.qdrant_connection
+            )
+        return self._a_qdrant_client
+    
+    def get_components(self, collection_name, k=3, temperature=None):
+        """
+        Restituisce i componenti della pipeline per una configurazione, creandoli una sola volta
+        
+        I componenti (client OpenAI, embedder, rewriter, retriever, prompt e pipeline)
+        sono registrati per (modello, modello e dimensione di embedding, temperature, collection, k)
+        e riutilizzati da tutte le query successive con la stessa configurazione.
+        
+        Args:
+            collection_name: Nome della collection Qdrant
+            k: Numero di documenti da recuperare (default: 3)
+            temperature: Temperature per la generazione (None = impostazione del sistema)
+            
+        Returns:
+            Dizionario con chiavi "client", "embedder", "rewriter", "retriever",
+            "prompt", "pipeline" e "hybrid" (la collection ha il vettore sparso BM25)
+        """
+        if temperature is None:
+            temperature = self.temperature
+        self._adopt_untenanted_points(collection_name)
+        key = (self.model_name, self.embedding_model, self.embedding_dimensions, temperature, collection_name, k)
+        
+        with self._components_lock:
+            components = self._components.get(key)
+            if components is not None:
+                return components
+            
+            # Verifica una sola volta per configurazione che la collection usi lo stesso embedding
+            if self._collection_exists(collection_name):
+                self.check_collection_embedding(collection_name)
+            
+            # Inizializza componenti
+            openai_client = OpenAIClient(
+                model=self.model_name,
+                api_key=self.openai_api_key,
+                temperature=temperature,
+                base_url=self.openai_base_url
+                # Nota: max_tokens viene passato nella chiamata, non nel costruttore
+            )
+            embedder = self.create_embedder()
+            rewriter = ToolRewriter(
+                client=openai_client,
+                system_prompt=self.system_prompt
+            )
+            retriever = self._get_vectorstore().as_retriever(
+                collection_name=collection_name,
+                k=k,
+                vector_name="default"  # Specifica il nome del vettore
+            )
+            prompt = ChatPromptTemplate(
+                user_prompt_template=self.user_prompt_template,
+                retrieval_prompt_template=self.retrieval_prompt_template
+            )
+            
+            # Crea pipeline
+            dag_pipeline = DagPipeline()
+            dag_pipeline.add_module("rewriter", rewriter)
+            dag_pipeline.add_module("embedder", embedder)
+            dag_pipeline.add_module("retriever", retriever)
+            dag_pipeline.add_module("prompt", prompt)
+            dag_pipeline.add_module("generator", openai_client)
+            
+            # Connetti i moduli
+            dag_pipeline.connect("rewriter", "embedder", target_key="text")
+            dag_pipeline.connect("embedder", "retriever", target_key="query_vector")
+            dag_pipeline.connect("retriever", "prompt", target_key="chunks")
+            dag_pipeline.connect("prompt", "generator", target_key="memory")
+            
+            components = {
+                "client": openai_client,
+                "embedder": embedder,
+                "rewriter": rewriter,
+                "retriever": retriever,
+                "prompt": prompt,
+                "pipeline": dag_pipeline,
+                "hybrid": bool(self.is_hybrid_collection(collection_name)),
+            }
+            self._components[key] = components
+            return components
+    
+    def create_pipeline(self, collection_name, k=3, temperature=0.0, 
+                       system_prompt="Riscrivi le query dell'utente per migliorare l'accuratezza del recupero.",
+                       user_prompt_template="Domanda dell'utente: {{user_prompt}}\n",
+                       retrieval_prompt_template="Contenuto recuperato:\n{% for chunk in chunks %}{{ chunk.text }}\n{% endfor %}"):
+        """
+        Crea la pipeline RAG completa
+        
+        La pipeline viene presa dal registro dei componenti: chiamate ripetute con
+        la stessa configurazione restituiscono la stessa istanza. Non serve per
+        query() e query_stream(), che eseguono le fasi con gli stessi componenti.
+        
+        Args:
+            collection_name: Nome della collection Qdrant
+            k: Numero di documenti da recuperare (default: 3)
+            temperature: Temperature per la generazione (default: 0.0 per risposte deterministiche)
+            system_prompt: Prompt di sistema per il rewriter
+            user_prompt_template: Template per la domanda utente
+            retrieval_prompt_template: Template per il contesto recuperato
+            
+        Returns:
+            DagPipeline configurata
+        """
+        self.update_settings(
+            temperature=temperature,
+            system_prompt=system_prompt,
+            user_prompt_template=user_prompt_template,
+            retrieval_prompt_template=retrieval_prompt_template
+        )
+        return self.get_components(collection_name, k=k, temperature=temperature)["pipeline"]
+    
+    def _get_executor(self):
+        """Thread pool condiviso per le fasi eseguite in parallelo (es. rewriting speculativo)"""
+        with self._components_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="rag")
+            return self._executor
+    
+    def _rewrite_query(self, rewriter, user_query, metrics):
+        """
+        Riscrive la query dell'utente con il ToolRewriter
+        
+        Returns:
+            Query riscritta (la query originale se il rewriter non restituisce testo)
+        """
+        with metrics.span("rewrite"):
+            rewritten = rewriter.run(user_prompt=user_query)
+        if isinstance(rewritten, str) and rewritten.strip():
+            return rewritten
+        if isinstance(rewritten, dict):
+            return rewritten.get("text", user_query)
+        return user_query
+    
+    def _embed_query(self, embedder, text, metrics):
+        """Genera l'embedding di una query"""
+        with metrics.span("embed"):
+            embedding_result = embedder.run(text=text)
+        if isinstance(embedding_result, list):
+            return embedding_result
+        elif isinstance(embedding_result, dict):
+            return embedding_result.get("embedding", embedding_result.get("vector", []))
+        return []
+    
+    def _search(self, components, text, collection_name, k, metrics, search_options=None):
+        """Embedding della query e ricerca dei chunk più simili (diversificati con MMR se richiesto)"""
+        query_vector = self._embed_query(components["embedder"], text, metrics)
+        mmr_lambda, fetch_k = self._mmr_settings(k, search_options)
+        with_vectors = mmr_lambda is not None
+        with metrics.span("retrieve"):
+            if self._use_hybrid(components, search_options):
+                request = self._hybrid_request(
+                    collection_name, query_vector, text, fetch_k, search_options, with_vectors
+                )
+                chunks = self._get_vectorstore()._point_to_chunk(self.qdrant_client.query_points(**request).points)
+            else:
+                chunks = components["retriever"].run(
+                    query_vector=query_vector, collection_name=collection_name, k=fetch_k,
+                    **self._search_kwargs(search_options, with_vectors)
+                )
+        return self._diversify(query_vector, chunks, k, mmr_lambda, metrics)
+    
+    def _mmr_settings(self, k, search_options=None):
+        """
+        Restituisce (lambda MMR o None, numero di candidati da recuperare)
+        
+        Args:
+            k: Numero di chunk da restituire
+            search_options: Opzioni della singola query, unite a self.search_options
+        """
+        options = {**self.search_options, **(search_options or {})}
+        mmr_lambda = options.get("mmr_lambda")
+        if mmr_lambda is None:
+            return None, k
+        return mmr_lambda, k * max(1, options.get("mmr_candidates") or 1)
+    
+    def _diversify(self, query_vector, chunks, k, mmr_lambda, metrics):
+        """Applica MMR ai candidati, se attivo"""
+        if mmr_lambda is None:
+            return chunks
+        with metrics.span("mmr"):
+            return mmr_select(query_vector, chunks, k, mmr_lambda)
+    
+    def _pack_context(self, retrieved_chunks, metrics):
+        """
+        Prepara il contenuto recuperato per il prompt entro self.max_context_tokens
+        
+        I chunk sovrapposti dello stesso documento vengono riuniti in un solo brano
+        (il testo in comune non viene inviato due volte) e, se il budget non basta,
+        i brani meno rilevanti vengono scartati (vedi context_packer.pack_context).
+        
+        Args:
+            retrieved_chunks: Chunk recuperati, ordinati per rilevanza
+            metrics: QueryMetrics in cui registrare i token del contesto
+            
+        Returns:
+            Lista dei testi da inserire nel prompt (le fonti della risposta)
+        """
+        spans = pack_context(chunk_records(retrieved_chunks), self.max_context_tokens, self.model_name)
+        metrics.context_tokens = sum(span["tokens"] for span in spans)
+        return [span["text"] for span in spans]
+    
+    def _use_hybrid(self, components, search_options=None):
+        """True se la query va eseguita in modalità ibrida (BM25 + semantica)"""
+        if not components["hybrid"]:
+            return False
+        return bool({**self.search_options, **(search_options or {})}.get("hybrid"))
+    
+    def _hybrid_request(self, collection_name, query_vector, text, k, search_options=None, with_vectors=False):
+        """
+        Argomenti di query_points per la ricerca ibrida
+        
+        Qdrant esegue in un'unica richiesta la ricerca semantica e quella BM25
+        (hybrid_candidates * k candidati ciascuna) e fonde le due classifiche con
+        la Reciprocal Rank Fusion: identificativi, codici e nomi rari trovati da
+        BM25 entrano nei primi k anche senza aumentare k.
+        
+        Args:
+            collection_name: Nome della collection
+            query_vector: Embedding della query
+            text: Testo della query (per il vettore sparso)
+            k: Numero di chunk da restituire
+            search_options: Opzioni della singola query, unite a self.search_options
+            with_vectors: Se True, restituisce anche gli embedding dei chunk (per MMR)
+            
+        Returns:
+            Dizionario di argomenti per query_points
+        """
+        options = {**self.search_options, **(search_options or {})}
+        limit = k * max(1, options.get("hybrid_candidates") or 1)
+        # Il filtro va applicato a entrambe le ricerche, non solo alla fusione
+        query_filter = build_payload_filter(self._scoped_filters(options.get("filter")))
+        prefetch = [Prefetch(
+            query=query_vector, using="default", limit=limit, filter=query_filter,
+            params=None if self.use_memory else build_search_params(options)
+        )]
+        indices, values = self.sparse_encoder.encode_query(text)
+        if indices:
+            prefetch.append(Prefetch(
+                query=SparseVector(indices=indices, values=values), using=SPARSE_VECTOR_NAME,
+                limit=limit, filter=query_filter
+            ))
+        return {
+            "collection_name": collection_name,
+            "prefetch": prefetch,
+            "query": FusionQuery(fusion=Fusion.RRF),
+            "query_filter": query_filter,
+            "limit": k,
+            "with_payload": True,
+            "with_vectors": ["default"] if with_vectors else False,
+        }
+    
+    def _search_kwargs(self, search_options=None, with_vectors=False):
+        """
+        Argomenti aggiuntivi per la ricerca in Qdrant
+        
+        Args:
+            search_options: Opzioni della singola query, unite a self.search_options
+            with_vectors: Se True, chiede anche gli embedding dei chunk (per MMR)
+            
+        Returns:
+            Dizionario con vector_name, search_params e filtro per il retriever
+        """
+        options = {**self.search_options, **(search_options or {})}
+        # vector_name esplicito: evita una get_collection a ogni ricerca
+        kwargs = {"vector_name": "default"}
+        if with_vectors:
+            kwargs["with_vectors"] = ["default"]
+        if not self.use_memory:
+            # In modalità locale la ricerca è sempre esatta e i parametri verrebbero ignorati
+            kwargs["search_params"] = build_search_params(options)
+        filters = self._scoped_filters(options.get("filter"))
+        if filters:
+            if self.flat_store:
+                kwargs["filters"] = filters
+            else:
+                kwargs["query_filter"] = build_payload_filter(filters)
+        return kwargs
+    
+    def _scoped_filters(self, filters=None):
+        """
+        Limita dei filtri sul payload ai points del tenant corrente
+        
+        Una condizione su "document_id" vale anche per i chunk deduplicati che
+        rappresentano il documento (vedi DOCUMENT_FIELDS).
+        
+        Args:
+            filters: Filtri della query (dizionario o Filter di Qdrant), oppure None
+            
+        Returns:
+            Filtri con la condizione sul tenant_id (invariati se tenant_id è None)
+        """
+        if isinstance(filters, dict) and "document_id" in filters:
+            filters = {
+                DOCUMENT_FIELDS if key == "document_id" else key: condition
+                for key, condition in filters.items()
+            }
+        if self.tenant_id is None:
+            return filters
+        if isinstance(filters, Filter):
+            return Filter(must=[FieldCondition(key="tenant_id", match=MatchValue(value=self.tenant_id)), filters])
+        # La condizione del tenant prevale su un eventuale tenant_id nei filtri
+        return {**(filters or {}), "tenant_id": self.tenant_id}
+    
+    def _retrieve(self, components, user_query, collection_name, k, metrics,
+                  speculative=False, rewrite_timeout=2.0, search_options=None):
+        """
+        Esegue rewriting, embedding e retrieval
+        
+        In modalità speculativa la ricerca sulla query originale parte subito,
+        mentre il rewriter è ancora in esecuzione. Se il rewriting va in timeout,
+        fallisce o produce una query quasi identica, si usano i risultati della
+        query originale; altrimenti i due insiemi di risultati vengono fusi.
+        
+        Args:
+            components: Componenti dal registro (vedi get_components)
+            user_query: Query dell'utente
+            collection_name: Nome della collection
+            k: Numero di documenti da recuperare
+            metrics: QueryMetrics in cui registrare i tempi delle fasi
+            speculative: Se True, esegue il retrieval in parallelo al rewriting
+            rewrite_timeout: Attesa massima (secondi) del rewriting in modalità speculativa
+            search_options: Opzioni di ricerca della query (vedi build_search_params)
+            
+        Returns:
+            Tuple (retrieved_chunks, retrieval_query)
+        """
+        if not speculative:
+            rewritten_text = self._rewrite_query(components["rewriter"], user_query, metrics)
+            return self._search(components, rewritten_text, collection_name, k, metrics, search_options), rewritten_text
+        
+        rewrite_future = self._get_executor().submit(
+            self._rewrite_query, components["rewriter"], user_query, metrics
+        )
+        raw_chunks = self._search(components, user_query, collection_name, k, metrics, search_options)
+        
+        try:
+            with metrics.span("rewrite_wait"):
+                rewritten_text = rewrite_future.result(timeout=rewrite_timeout)
+        except FutureTimeoutError:
+            print(f"⏱️ Rewriting oltre {rewrite_timeout}s: uso i risultati della query originale")
+            return raw_chunks, user_query
+        except Exception as e:
+            print(f"⚠️ Rewriting fallito ({e}): uso i risultati della query originale")
+            return raw_chunks, user_query
+        
+        if queries_are_similar(user_query, rewritten_text):
+            return raw_chunks, user_query
+        
+        rewritten_chunks = self._search(components, rewritten_text, collection_name, k, metrics, search_options)
+        return merge_ranked_chunks([rewritten_chunks, raw_chunks], k), rewritten_text
+    
+    def query(self, user_query, collection_name, k=3, temperature=None,
+              speculative_retrieval=False, rewrite_timeout=2.0, include_metrics=False,
+              search_options=None, hnsw_ef=None, exact=False, filters=None, pipeline=None):
+        """
+        Esegue una query sulla pipeline RAG
+        
+        Le fasi della DagPipeline (rewriter, embedder, retriever, prompt, generator)
+        vengono eseguite una per una con i componenti del registro, così da poterne
+        misurare i tempi.
+        
+        Args:
+            user_query: Query dell'utente
+            collection_name: Nome della collection
+            k: Numero di documenti da recuperare
+            temperature: Temperature per la generazione (None = impostazione del sistema)
+            speculative_retrieval: Se True, avvia il retrieval sulla query originale
+                                   in parallelo al rewriting (vedi _retrieve)
+            rewrite_timeout: Attesa massima (secondi) del rewriting in modalità speculativa
+            include_metrics: Se True, restituisce anche i tempi delle fasi (QueryMetrics)
+            search_options: Opzioni di ricerca per questa query, unite a self.search_options
+                            (es. {"oversampling": 3.0}; vedi build_search_params)
+            hnsw_ef: Ampiezza della ricerca HNSW per questa query (None = default);
+                     ignorato da Qdrant in modalità locale
+            exact: Se True, ricerca esatta (senza indice HNSW né quantizzazione)
+            filters: Filtri sul payload, es. {"filename": "contratto.pdf"} o
+                     {"page": {"gte": 3}} (vedi build_payload_filter)
+            pipeline: Deprecato e ignorato: le fasi vengono eseguite con i componenti
+                      del registro (vedi get_components)
+            
+        Returns:
+            Tuple (response, sources) dove:
+                - response: La risposta generata
+                - sources: Lista dei chunk recuperati
+            oppure (response, sources, metrics) se include_metrics=True
+        """
+        if pipeline is not None:
+            warnings.warn(
+                "Il parametro pipeline di query() è deprecato e ignorato: "
+                "le fasi vengono eseguite con i componenti del registro",
+                DeprecationWarning, stacklevel=2
+            )
+        metrics = QueryMetrics()
+        components = self.get_components(collection_name, k=k, temperature=temperature)
+        retrieved_chunks, retrieval_query = self._retrieve(
+            components, user_query, collection_name, k, metrics,
+            speculative=speculative_retrieval, rewrite_timeout=rewrite_timeout,
+            search_options=query_search_options(search_options, hnsw_ef, exact, filters)
+        )
+        with metrics.span("prompt"):
+            sources = self._pack_context(retrieved_chunks, metrics)
+            memory = components["prompt"].run(
+                user_prompt=user_query,
+                chunks=[Chunk(id=str(index), text=text) for index, text in enumerate(sources)],
+                retrieval_query=retrieval_query
+            )
+        with metrics.span("generate"):
+            raw_response = components["client"].invoke(input=user_query, memory=memory)
+        metrics.record_usage(raw_response)
+        
+        response = response_to_text(raw_response)
+        metrics.finish(num_sources=len(sources))
+        
+        if include_metrics:
+            return response, sources, metrics
+        return response, sources
+    
+    def query_stream(self, user_query, collection_name, k=3, temperature=None,
+                     speculative_retrieval=False, rewrite_timeout=2.0, include_metrics=False,
+                     search_options=None, hnsw_ef=None, exact=False, filters=None, pipeline=None):
+        """
+        Esegue una query sulla pipeline RAG con streaming della risposta
+        
+        I componenti (client, embedder, rewriter, retriever) vengono presi dal
+        registro, quindi non vengono ricreati a ogni domanda.
+        
+        Args:
+            user_query: Query dell'utente
+            collection_name: Nome della collection
+            k: Numero di documenti da recuperare
+            temperature: Temperature per la generazione (None = impostazione del sistema)
+            speculative_retrieval: Se True, avvia il retrieval sulla query originale
+                                   in parallelo al rewriting (vedi _retrieve)
+            rewrite_timeout: Attesa massima (secondi) del rewriting in modalità speculativa
+            include_metrics: Se True, ogni yield contiene anche le metriche (vedi sotto)
+            search_options: Opzioni di ricerca per questa query, unite a self.search_options
+                            (es. {"oversampling": 3.0}; vedi build_search_params)
+            hnsw_ef: Ampiezza della ricerca HNSW per questa query (None = default);
+                     ignorato da Qdrant in modalità locale
+            exact: Se True, ricerca esatta (senza indice HNSW né quantizzazione)
+            filters: Filtri sul payload, es. {"filename": "contratto.pdf"} o
+                     {"page": {"gte": 3}} (vedi build_payload_filter)
+            pipeline: Deprecato e ignorato: le fasi vengono eseguite con i componenti
+                      del registro (vedi get_components)
+            
+        Yields:
+            Tuple (chunk_text, sources) dove:
+                - chunk_text: Chunk di testo della risposta (streaming)
+                - sources: Lista dei chunk recuperati (solo nel primo yield)
+            Con include_metrics=True le tuple sono (chunk_text, sources, metrics):
+            metrics è None tranne che nell'ultimo yield ("", None, QueryMetrics)
+        """
+        if pipeline is not None:
+            warnings.warn(
+                "Il parametro pipeline di query_stream() è deprecato e ignorato: "
+                "le fasi vengono eseguite con i componenti del registro",
+                DeprecationWarning, stacklevel=2
+            )
+        metrics = QueryMetrics()
+        components = self.get_components(collection_name, k=k, temperature=temperature)
+        openai_client = components["client"]
+        
+        # Rewrite query, embedding e retrieval
+        retrieved_chunks, _ = self._retrieve(
+            components, user_query, collection_name, k, metrics,
+            speculative=speculative_retrieval, rewrite_timeout=rewrite_timeout,
+            search_options=query_search_options(search_options, hnsw_ef, exact, filters)
+        )
+        
+        # Extract sources e build context
+        with metrics.span("prompt"):
+            sources = self._pack_context(retrieved_chunks, metrics)
+            context = build_stream_context(user_query, sources)
+        
+        # Stream response: "generate" misura solo l'attesa dei chunk, non il
+        # tempo che il chiamante impiega tra un yield e il successivo
+        first_chunk = True
+        stream = iter(openai_client.stream_invoke(context))
+        while True:
+            with metrics.span("generate"):
+                chunk = next(stream, None)
+            if chunk is None:
+                break
+            if chunk.delta:
+                metrics.record_delta()
+                if first_chunk:
+                    # Nel primo chunk, invia anche le fonti
+                    yield (chunk.delta, sources, None) if include_metrics else (chunk.delta, sources)
+                    first_chunk = False
+                else:
+                    yield (chunk.delta, None, None) if include_metrics else (chunk.delta, None)
+            else:
+                metrics.record_usage(chunk)
+        
+        metrics.finish(num_sources=len(sources))
+        if include_metrics:
+            yield "", None, metrics
+    
+    async def _a_rewrite_query(self, rewriter, user_query, metrics):
+        """Versione asincrona di _rewrite_query"""
+        with metrics.span("rewrite"):
+            rewritten = await rewriter.a_run(user_prompt=user_query)
+        if isinstance(rewritten, str) and rewritten.strip():
+            return rewritten
+        if isinstance(rewritten, dict):
+            return rewritten.get("text", user_query)
+        return user_query
+    
+    async def _a_search(self, components, text, collection_name, k, metrics, search_options=None):
+        """Versione asincrona di _search"""
+        with metrics.span("embed"):
+            embedding_result = await components["embedder"].a_run(text=text)
+        if isinstance(embedding_result, dict):
+            query_vector = embedding_result.get("embedding", embedding_result.get("vector", []))
+        else:
+            query_vector = embedding_result or []
+        
+        mmr_lambda, fetch_k = self._mmr_settings(k, search_options)
+        with_vectors = mmr_lambda is not None
+        if self._use_hybrid(components, search_options):
+            request = self._hybrid_request(
+                collection_name, query_vector, text, fetch_k, search_options, with_vectors
+            )
+            vectorstore = self._get_vectorstore()
+            with metrics.span("retrieve"):
+                if self.use_memory:
+                    response = await asyncio.to_thread(self.qdrant_client.query_points, **request)
+                else:
+                    response = await vectorstore._get_a_client().query_points(**request)
+            chunks = vectorstore._point_to_chunk(response.points)
+            return self._diversify(query_vector, chunks, k, mmr_lambda, metrics)
+        
+        retriever = components["retriever"]
+        search_kwargs = self._search_kwargs(search_options, with_vectors)
+        with metrics.span("retrieve"):
+            if self.use_memory:
+                # Lo storage locale è accessibile solo dal client sincrono già aperto:
+                # la ricerca viene eseguita in un thread per non bloccare l'event loop
+                chunks = await asyncio.to_thread(
+                    retriever.run, query_vector=query_vector, collection_name=collection_name, k=fetch_k,
+                    **search_kwargs
+                )
+            else:
+                chunks = await retriever.a_run(
+                    query_vector=query_vector, collection_name=collection_name, k=fetch_k, **search_kwargs
+                )
+        return self._diversify(query_vector, chunks, k, mmr_lambda, metrics)
+    
+    async def _a_retrieve(self, components, user_query, collection_name, k, metrics,
+                          speculative=False, rewrite_timeout=2.0, search_options=None):
+        """Versione asincrona di _retrieve"""
+        if not speculative:
+            rewritten_text = await self._a_rewrite_query(components["rewriter"], user_query, metrics)
+            return await self._a_search(components, rewritten_text, collection_name, k, metrics, search_options), rewritten_text
+        
+        rewrite_task = asyncio.create_task(
+            self._a_rewrite_query(components["rewriter"], user_query, metrics)
+        )
+        raw_chunks = await self._a_search(components, user_query, collection_name, k, metrics, search_options)
+        
+        try:
+            with metrics.span("rewrite_wait"):
+                rewritten_text = await asyncio.wait_for(rewrite_task, timeout=rewrite_timeout)
+        except asyncio.TimeoutError:
+            print(f"⏱️ Rewriting oltre {rewrite_timeout}s: uso i risultati della query originale")
+            return raw_chunks, user_query
+        except Exception as e:
+            print(f"⚠️ Rewriting fallito ({e}): uso i risultati della query originale")
+            return raw_chunks, user_query
+        
+        if queries_are_similar(user_query, rewritten_text):
+            return raw_chunks, user_query
+        
+        rewritten_chunks = await self._a_search(components, rewritten_text, collection_name, k, metrics, search_options)
+        return merge_ranked_chunks([rewritten_chunks, raw_chunks], k), rewritten_text
+    
+    async def aquery(self, user_query, collection_name, k=3, temperature=None,
+                     speculative_retrieval=False, rewrite_timeout=2.0, include_metrics=False,
+                     search_options=None, hnsw_ef=None, exact=False, filters=None):
+        """
+        Versione asincrona di query, basata sui client asincroni di OpenAI e Qdrant
+        
+        Un solo event loop può gestire molte domande contemporanee senza un thread
+        per utente. I client asincroni vengono creati al primo utilizzo e riutilizzati:
+        usare sempre lo stesso event loop per lo stesso RAGSystem.
+        
+        Args:
+            user_query: Query dell'utente
+            collection_name: Nome della collection
+            k: Numero di documenti da recuperare
+            temperature: Temperature per la generazione (None = impostazione del sistema)
+            speculative_retrieval: Se True, avvia il retrieval in parallelo al rewriting
+            rewrite_timeout: Attesa massima (secondi) del rewriting in modalità speculativa
+            include_metrics: Se True, restituisce anche i tempi delle fasi
+            search_options: Opzioni di ricerca per questa query, unite a self.search_options
+                            (es. {"oversampling": 3.0}; vedi build_search_params)
+            hnsw_ef: Ampiezza della ricerca HNSW per questa query (None = default);
+                     ignorato da Qdrant in modalità locale
+            exact: Se True, ricerca esatta (senza indice HNSW né quantizzazione)
+            filters: Filtri sul payload, es. {"filename": "contratto.pdf"} o
+                     {"page": {"gte": 3}} (vedi build_payload_filter)
+            
+        Returns:
+            Tuple (response, sources) o (response, sources, metrics), come query()
+        """
+        metrics = QueryMetrics()
+        components = self.get_components(collection_name, k=k, temperature=temperature)
+        retrieved_chunks, retrieval_query = await self._a_retrieve(
+            components, user_query, collection_name, k, metrics,
+            speculative=speculative_retrieval, rewrite_timeout=rewrite_timeout,
+            search_options=query_search_options(search_options, hnsw_ef, exact, filters)
+        )
+        with metrics.span("prompt"):
+            sources = self._pack_context(retrieved_chunks, metrics)
+            memory = components["prompt"].run(
+                user_prompt=user_query,
+                chunks=[Chunk(id=str(index), text=text) for index, text in enumerate(sources)],
+                retrieval_query=retrieval_query
+            )
+        with metrics.span("generate"):
+            raw_response = await components["client"].a_invoke(input=user_query, memory=memory)
+        metrics.record_usage(raw_response)
+        
+        response = response_to_text(raw_response)
+        metrics.finish(num_sources=len(sources))
+        
+        if include_metrics:
+            return response, sources, metrics
+        return response, sources
+    
+    async def aquery_stream(self, user_query, collection_name, k=3, temperature=None,
+                            speculative_retrieval=False, rewrite_timeout=2.0, include_metrics=False,
+                            search_options=None, hnsw_ef=None, exact=False, filters=None):
+        """
+        Versione asincrona di query_stream
+        
+        Args:
+            user_query: Query dell'utente
+            collection_name: Nome della collection
+            k: Numero di documenti da recuperare
+            temperature: Temperature per la generazione (None = impostazione del sistema)
+            speculative_retrieval: Se True, avvia il retrieval in parallelo al rewriting
+            rewrite_timeout: Attesa massima (secondi) del rewriting in modalità speculativa
+            include_metrics: Se True, le tuple contengono anche le metriche
+            search_options: Opzioni di ricerca per questa query, unite a self.search_options
+                            (es. {"oversampling": 3.0}; vedi build_search_params)
+            hnsw_ef: Ampiezza della ricerca HNSW per questa query (None = default);
+                     ignorato da Qdrant in modalità locale
+            exact: Se True, ricerca esatta (senza indice HNSW né quantizzazione)
+            filters: Filtri sul payload, es. {"filename": "contratto.pdf"} o
+                     {"page": {"gte": 3}} (vedi build_payload_filter)
+            
+        Yields:
+            Tuple (chunk_text, sources) o (chunk_text, sources, metrics), come query_stream()
+        """
+        metrics = QueryMetrics()
+        components = self.get_components(collection_name, k=k, temperature=temperature)
+        retrieved_chunks, _ = await self._a_retrieve(
+            components, user_query, collection_name, k, metrics,
+            speculative=speculative_retrieval, rewrite_timeout=rewrite_timeout,
+            search_options=query_search_options(search_options, hnsw_ef, exact, filters)
+        )
+        with metrics.span("prompt"):
+            sources = self._pack_context(retrieved_chunks, metrics)
+            context = build_stream_context(user_query, sources)
+        
+        # Come in query_stream, "generate" misura solo l'attesa dei chunk
+        first_chunk = True
+        stream = components["client"].a_stream_invoke(context).__aiter__()
+        while True:
+            with metrics.span("generate"):
+                chunk = await anext(stream, None)
+            if chunk is None:
+                break
+            if chunk.delta:
+                metrics.record_delta()
+                if first_chunk:
+                    # Nel primo chunk, invia anche le fonti
+                    yield (chunk.delta, sources, None) if include_metrics else (chunk.delta, sources)
+                    first_chunk = False
+                else:
+                    yield (chunk.delta, None, None) if include_metrics else (chunk.delta, None)
+            else:
+                metrics.record_usage(chunk)
+        
+        metrics.finish(num_sources=len(sources))
+        if include_metrics:
+            yield "", None, metrics
+
+
+# Funzioni helper per la quantizzazione e la ricerca
+
+# Riduzione della RAM dei vettori rispetto a float32 per ogni tipo di quantizzazione
+QUANTIZATION_COMPRESSION = {None: 1, "scalar": 4, "binary": 32, "product": 16}
+
+
+def shared_qdrant_client(use_memory=True, host="localhost", port=6333, storage_path="./qdrant_storage",
+                         **connection):
+    """
+    Restituisce il client Qdrant condiviso per una configurazione, creandolo al primo utilizzo
+    
+    Lo storage locale di Qdrant può essere aperto da un solo client per processo e,
+    con un server, un solo client riusa lo stesso pool di connessioni: le istanze di
+    RAGSystem del processo (es. una per sessione Streamlit) usano quindi lo stesso
+    client. Ogni chiamata va bilanciata da release_qdrant_client.
+    
+    Args:
+        use_memory: Se True, storage locale in storage_path; se False, server esterno
+        host: Host di Qdrant (se use_memory=False)
+        port: Porta di Qdrant (se use_memory=False)
+        storage_path: Cartella dello storage locale; ":memory:" crea sempre un client
+                      nuovo, non condiviso
+        **connection: Opzioni di connessione al server (prefer_grpc, grpc_port,
+                      pool_size, timeout): configurazioni diverse hanno client diversi
+        
+    Returns:
+        QdrantClient instance
+    """
+    if use_memory and storage_path == ":memory:":
+        return QdrantClient(location=":memory:")
+    if use_memory:
+        key = ("path", os.path.abspath(storage_path))
+    else:
+        key = ("server", host, port, tuple(sorted(connection.items())))
+    with _shared_clients_lock:
+        entry = _shared_clients.get(key)
+        if entry is None:
+            if use_memory:
+                os.makedirs(storage_path, exist_ok=True)
+                client = QdrantClient(path=storage_path)
+            else:
+                client = QdrantClient(host=host, port=port, **connection)
+            entry = _shared_clients[key] = [client, 0]
+        entry[1] += 1
+        return entry[0]
+
+
+def shared_flat_store(storage_path="./flat_index", dtype="float32"):
+    """
+    Restituisce il FlatVectorstore condiviso di una cartella, creandolo al primo utilizzo
+    
+    Gli indici piatti tengono in memoria le mappe degli ID: due istanze sulla
+    stessa cartella non vedrebbero le scritture l'una dell'altra.
+    
+    Args:
+        storage_path: Cartella degli indici
+        dtype: "float32" oppure "float16" (per le nuove collection)
+        
+    Returns:
+        FlatVectorstore instance
+    """
+    key = (os.path.abspath(storage_path), dtype)
+    with _shared_clients_lock:
+        if key not in _shared_flat_stores:
+            _shared_flat_stores[key] = FlatVectorstore(storage_path, dtype=dtype)
+        return _shared_flat_stores[key]
+
+
+def release_qdrant_client(client):
+    """
+    Rilascia un client ottenuto con shared_qdrant_client: viene chiuso quando
+    nessuna istanza lo usa più
+    
+    Args:
+        client: QdrantClient da rilasciare
+    """
+    with _shared_clients_lock:
+        for key, entry in _shared_clients.items():
+            if entry[0] is client:
+                entry[1] -= 1
+                if entry[1] > 0:
+                    return
+                del _shared_clients[key]
+                break
+    client.close()
+
+
+def build_quantization_config(quantization, always_ram=True):
+    """
+    Crea la configurazione di quantizzazione di Qdrant
+    
+    Args:
+        quantization: None, "scalar" (int8), "binary" o "product" (compressione x16)
+        always_ram: Se True, i vettori quantizzati restano sempre in RAM
+        
+    Returns:
+        Configurazione per create_collection, oppure None
+    """
+    if quantization is None:
+        return None
+    if quantization == "scalar":
+        return ScalarQuantization(
+            scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=0.99, always_ram=always_ram)
+        )
+    if quantization == "binary":
+        return BinaryQuantization(binary=BinaryQuantizationConfig(always_ram=always_ram))
+    if quantization == "product":
+        return ProductQuantization(
+            product=ProductQuantizationConfig(compression=CompressionRatio.X16, always_ram=always_ram)
+        )
+    raise ValueError(f"Quantizzazione non supportata: {quantization}. Usa None, 'scalar', 'binary' o 'product'")
+
+
+def quantization_name(quantization_config):
+    """
+    Nome della quantizzazione di una configurazione Qdrant
+    
+    Args:
+        quantization_config: Configurazione letta dalla collection
+        
+    Returns:
+        "scalar", "binary", "product" oppure None
+    """
+    if isinstance(quantization_config, ScalarQuantization):
+        return "scalar"
+    if isinstance(quantization_config, BinaryQuantization):
+        return "binary"
+    if isinstance(quantization_config, ProductQuantization):
+        return "product"
+    return None
+
+
+def build_search_params(options):
+    """
+    Crea i parametri di ricerca di Qdrant a partire dalle opzioni della query
+    
+    Args:
+        options: Dizionario con:
+                 - oversampling: candidati extra letti dai vettori quantizzati
+                   (es. 2.0 = 2 * k) prima del rescoring
+                 - rescore: se True, riordina i candidati con i vettori originali
+                 - hnsw_ef: ampiezza della ricerca nel grafo HNSW (più alta =
+                   recall maggiore, query più lente; default Qdrant: ef_construct)
+                 - exact: se True, ricerca esatta senza indice né quantizzazione
+                 ("hybrid" e "hybrid_candidates" riguardano la ricerca ibrida,
+                 vedi RAGSystem._hybrid_request; "mmr_lambda" e "mmr_candidates"
+                 la diversificazione dei risultati, vedi mmr_select; "filter" i
+                 filtri sul payload, vedi build_payload_filter)
+                 Le opzioni di quantizzazione sono ignorate se la collection non è quantizzata.
+        
+    Returns:
+        SearchParams, oppure None se non ci sono opzioni
+    """
+    if not options:
+        return None
+    exact = bool(options.get("exact"))
+    if exact:
+        # La ricerca esatta confronta i vettori originali: niente quantizzazione
+        quantization = QuantizationSearchParams(ignore=True)
+    else:
+        quantization = QuantizationSearchParams(
+            rescore=options.get("rescore"),
+            oversampling=options.get("oversampling")
+        )
+    return SearchParams(hnsw_ef=options.get("hnsw_ef"), exact=exact, quantization=quantization)
+
+
+def query_search_options(search_options=None, hnsw_ef=None, exact=False, filters=None):
+    """
+    Unisce le opzioni di ricerca di una query con hnsw_ef, exact e filtri espliciti
+    
+    Args:
+        search_options: Dizionario di opzioni della query (vedi build_search_params)
+        hnsw_ef: Ampiezza della ricerca HNSW per questa query (None = invariata)
+        exact: Se True, ricerca esatta per questa query
+        filters: Filtri sul payload per questa query (vedi build_payload_filter)
+        
+    Returns:
+        Dizionario delle opzioni, oppure None se non ci sono opzioni
+    """
+    options = dict(search_options or {})
+    if hnsw_ef is not None:
+        options["hnsw_ef"] = hnsw_ef
+    if exact:
+        options["exact"] = True
+    if filters:
+        options["filter"] = filters
+    return options or None
+
+
+def build_payload_filter(filters):
+    """
+    Crea un filtro di Qdrant a partire da un dizionario campo -> condizione
+    
+    Le condizioni sono in AND; una tupla di campi come chiave è soddisfatta se lo
+    è almeno uno dei campi (es. {("document_id", "sources"): "a.pdf"}). Ogni
+    condizione può essere:
+        - un valore: il campo deve essere uguale (es. {"filename": "contratto.pdf"})
+        - una lista di valori: il campo deve essere uno di essi
+          (es. {"document_id": ["a.pdf", "b.pdf"]})
+        - un dizionario di limiti "gt", "gte", "lt", "lte" per i campi numerici
+          (es. {"page": {"gte": 3, "lte": 5}})
+    Gli stessi dizionari funzionano con l'indice piatto (vedi flat_index.match_value).
+    
+    Args:
+        filters: Dizionario delle condizioni, un Filter di Qdrant (usato così com'è) o None
+        
+    Returns:
+        Filter, oppure None se non ci sono condizioni
+    """
+    if not filters:
+        return None
+    if isinstance(filters, Filter):
+        return filters
+    conditions = []
+    for key, condition in filters.items():
+        fields = [
+            _field_condition(field, condition) for field in (key if isinstance(key, tuple) else (key,))
+        ]
+        conditions.append(fields[0] if len(fields) == 1 else Filter(should=fields))
+    return Filter(must=conditions)
+
+
+def _field_condition(field, condition):
+    """Condizione di Qdrant su un campo (vedi build_payload_filter)"""
+    if isinstance(condition, dict):
+        return FieldCondition(key=field, range=Range(**condition))
+    if isinstance(condition, (list, tuple, set, frozenset)):
+        return FieldCondition(key=field, match=MatchAny(any=list(condition)))
+    return FieldCondition(key=field, match=MatchValue(value=condition))
+
+
+def build_index_configs(hnsw_m=None, hnsw_ef_construct=None, indexing_threshold=None, memmap_threshold=None,
+                        payload_m=None):
+    """
+    Crea le configurazioni HNSW e dell'optimizer di una collection
+    
+    Args:
+        hnsw_m: Archi per nodo del grafo HNSW (0 = nessun grafo globale)
+        hnsw_ef_construct: Ampiezza della ricerca durante la costruzione del grafo
+        indexing_threshold: KB oltre cui un segmento viene indicizzato
+        memmap_threshold: KB oltre cui un segmento passa su disco
+        payload_m: Archi per nodo dei grafi costruiti per ogni valore dei campi
+                   indicizzati come tenant (vedi PAYLOAD_INDEXES)
+        
+    Returns:
+        Tuple (HnswConfigDiff o None, OptimizersConfigDiff o None)
+    """
+    hnsw_config = None
+    if hnsw_m is not None or hnsw_ef_construct is not None or payload_m is not None:
+        hnsw_config = HnswConfigDiff(m=hnsw_m, ef_construct=hnsw_ef_construct, payload_m=payload_m)
+    optimizers_config = None
+    if indexing_threshold is not None or memmap_threshold is not None:
+        optimizers_config = OptimizersConfigDiff(
+            indexing_threshold=indexing_threshold, memmap_threshold=memmap_threshold
+        )
+    return hnsw_config, optimizers_config
+
+
+def storage_config_updates(collection_config, hnsw_config=None, optimizers_config=None,
+                           on_disk=None, on_disk_payload=None):
+    """
+    Calcola gli aggiornamenti di indice e storage da applicare a una collection esistente
+    
+    Args:
+        collection_config: Configurazione letta con get_collection
+        hnsw_config: HnswConfigDiff richiesto (vedi build_index_configs)
+        optimizers_config: OptimizersConfigDiff richiesto
+        on_disk: Vettori originali su disco (None = invariato)
+        on_disk_payload: Payload su disco (None = invariato)
+        
+    Returns:
+        Argomenti per update_collection, solo per i valori che cambiano
+    """
+    def changed(requested, current):
+        return {
+            name: value for name, value in requested.model_dump(exclude_none=True).items()
+            if getattr(current, name, None) != value
+        }
+    
+    updates = {}
+    if hnsw_config is not None and changed(hnsw_config, collection_config.hnsw_config):
+        updates["hnsw_config"] = hnsw_config
+    if optimizers_config is not None and changed(optimizers_config, collection_config.optimizer_config):
+        updates["optimizers_config"] = optimizers_config
+    vectors = collection_config.params.vectors
+    if on_disk is not None and bool(vectors["default"].on_disk) != on_disk:
+        updates["vectors_config"] = {"default": VectorParamsDiff(on_disk=on_disk)}
+    if on_disk_payload is not None and bool(collection_config.params.on_disk_payload) != on_disk_payload:
+        updates["collection_params"] = CollectionParamsDiff(on_disk_payload=on_disk_payload)
+    return updates
+
+
+# Funzioni helper per le query
+
+def response_to_text(raw_response):
+    """
+    Estrae il testo della risposta dal generatore
+    
+    Args:
+        raw_response: Risposta del generatore (stringa, ClientResponse o simili)
+        
+    Returns:
+        Testo della risposta
+    """
+    # Il generatore può restituire diversi formati
+    if isinstance(raw_response, str):
+        # È già una stringa
+        return raw_response
+    elif hasattr(raw_response, 'content'):
+        # È un oggetto ClientResponse con content
+        if isinstance(raw_response.content, list) and len(raw_response.content) > 0:
+            # content è una lista di TextBlock
+            text_blocks = []
+            for block in raw_response.content:
+                if hasattr(block, 'content'):
+                    text_blocks.append(block.content)
+                elif hasattr(block, 'text'):
+                    text_blocks.append(block.text)
+            return '\n'.join(text_blocks)
+        elif isinstance(raw_response.content, str):
+            return raw_response.content
+        else:
+            return str(raw_response.content)
+    elif hasattr(raw_response, 'text'):
+        # Ha un attributo text
+        return raw_response.text
+    elif hasattr(raw_response, 'message'):
+        # Ha un attributo message
+        if hasattr(raw_response.message, 'content'):
+            return raw_response.message.content
+        else:
+            return str(raw_response.message)
+    else:
+        # Fallback: converti a stringa
+        return str(raw_response)
+
+
+def extract_sources(retrieved_chunks):
+    """
+    Estrae il testo dei chunk recuperati
+    
+    Args:
+        retrieved_chunks: Chunk restituiti dal retriever
+        
+    Returns:
+        Lista dei testi dei chunk
+    """
+    # I chunk possono essere oggetti Chunk o dizionari
+    sources = []
+    for chunk in retrieved_chunks:
+        if hasattr(chunk, 'text'):
+            # È un oggetto Chunk con attributo text
+            sources.append(chunk.text)
+        elif isinstance(chunk, dict) and 'text' in chunk:
+            # È un dizionario con chiave 'text'
+            sources.append(chunk['text'])
+        elif hasattr(chunk, 'payload') and isinstance(chunk.payload, dict):
+            # È un oggetto con payload che contiene text
+            sources.append(chunk.payload.get('text', ''))
+    return sources
+
+
+def chunk_records(retrieved_chunks):
+    """
+    Testo, documento di provenienza e posizione dei chunk recuperati
+    
+    Args:
+        retrieved_chunks: Chunk restituiti dal retriever
+        
+    Returns:
+        Lista di dizionari {"text", "document_id", "offset"} nello stesso ordine
+        (offset è None per i chunk indicizzati senza "chunk_offset")
+    """
+    records = []
+    for chunk in retrieved_chunks:
+        texts = extract_sources([chunk])
+        if not texts:
+            continue
+        metadata = getattr(chunk, 'metadata', None) or (chunk if isinstance(chunk, dict) else {})
+        records.append({
+            "text": texts[0],
+            "document_id": metadata.get("document_id"),
+            "offset": metadata.get("chunk_offset")
+        })
+    return records
+
+
+def build_stream_context(user_query, sources):
+    """
+    Costruisce il prompt per la generazione in streaming
+    
+    Args:
+        user_query: Query dell'utente
+        sources: Testi dei chunk recuperati (vedi RAGSystem._pack_context)
+        
+    Returns:
+        Prompt con domanda e contenuto recuperato
+    """
+    # Un solo join invece di concatenazioni ripetute
+    return "".join(
+        [f"Domanda dell'utente: {user_query}\n\nContenuto recuperato:\n"]
+        + [f"{chunk_text}\n" for chunk_text in sources]
+    )
+
+
+def queries_are_similar(query_a, query_b, threshold=0.9):
+    """
+    Indica se due query sono praticamente identiche
+    
+    Args:
+        query_a: Prima query
+        query_b: Seconda query
+        threshold: Soglia di similarità (0-1) oltre la quale sono considerate uguali
+        
+    Returns:
+        True se le query normalizzate hanno similarità >= threshold
+    """
+    a = " ".join(query_a.lower().split())
+    b = " ".join(query_b.lower().split())
+    return a == b or SequenceMatcher(None, a, b).ratio() >= threshold
+
+
+def merge_ranked_chunks(result_lists, k):
+    """
+    Fonde più liste ordinate di chunk con Reciprocal Rank Fusion
+    
+    Args:
+        result_lists: Liste di chunk ordinate per rilevanza (la prima ha la priorità a parità di punteggio)
+        k: Numero di chunk da restituire
+        
+    Returns:
+        I k chunk con il punteggio fuso più alto, senza duplicati
+    """
+    scores = {}
+    chunks_by_key = {}
+    for results in result_lists:
+        for rank, chunk in enumerate(results):
+            key = getattr(chunk, 'id', None) or extract_sources([chunk])[0]
+            scores[key] = scores.get(key, 0.0) + 1.0 / (60 + rank + 1)
+            chunks_by_key.setdefault(key, chunk)
+    ordered = sorted(scores, key=lambda key: scores[key], reverse=True)
+    return [chunks_by_key[key] for key in ordered[:k]]
+
+
+def chunk_vector(chunk):
+    """Embedding denso di un chunk recuperato con with_vectors, oppure None"""
+    for embedding in getattr(chunk, "embeddings", None) or []:
+        vector = getattr(embedding, "vector", None)
+        if vector is not None:
+            return vector
+    return None
+
+
+def mmr_select(query_vector, chunks, k, lambda_mult=0.5):
+    """
+    Sceglie k chunk rilevanti ma diversi tra loro con Maximal Marginal Relevance
+    
+    A ogni passo viene scelto il candidato che massimizza
+    lambda * sim(query, chunk) - (1 - lambda) * max sim(chunk, già scelti).
+    Le similarità sono calcolate una volta sola con due prodotti matriciali;
+    ogni passo aggiorna solo il vettore delle similarità massime.
+    
+    Args:
+        query_vector: Embedding della query
+        chunks: Candidati ordinati per rilevanza, con embedding (with_vectors)
+        k: Numero di chunk da restituire
+        lambda_mult: 1 = solo rilevanza, 0 = solo diversità (default: 0.5)
+        
+    Returns:
+        I k chunk scelti, nell'ordine di selezione
+    """
+    vectors = [chunk_vector(chunk) for chunk in chunks]
+    if len(chunks) <= 1 or k <= 0 or any(vector is None for vector in vectors):
+        # Senza embedding dei candidati non si può diversificare
+        return chunks[:k]
+    
+    matrix = np.asarray(vectors, dtype=np.float32)
+    matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    query = np.asarray(query_vector, dtype=np.float32)
+    query /= max(np.linalg.norm(query), 1e-12)
+    
+    relevance = matrix @ query
+    similarity = matrix @ matrix.T
+    
+    selected = [int(np.argmax(relevance))]
+    max_similarity = similarity[selected[0]].copy()
+    available = np.ones(len(chunks), dtype=bool)
+    available[selected[0]] = False
+    for _ in range(min(k, len(chunks)) - 1):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_similarity
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(max_similarity, similarity[best], out=max_similarity)
+    return [chunks[index] for index in selected]
+
+
+# Funzioni helper per il processing dei documenti
+
+def iter_pdf_pages(pdf_file):
+    """
+    Estrae il testo di un file PDF una pagina alla volta
+    
+    Args:
+        pdf_file: File PDF (file-like object)
+        
+    Yields:
+        Testo di ogni pagina, nell'ordine del documento
+    """
+    pdf_reader = PdfReader(pdf_file)
     for page in pdf_reader.pages:
-        text += page.extract_text()
-    return text
+        yield page.extract_text() or ""
+
+
+def iter_text_file(text_file, block_size=1024 * 1024, encoding="utf-8"):
+    """
+    Legge un file di testo a blocchi, senza caricarlo tutto in memoria
+    
+    Args:
+        text_file: File di testo aperto in modalità binaria (file-like object)
+        block_size: Numero di byte letti per blocco (default: 1 MB)
+        encoding: Codifica del file (default: utf-8)
+        
+    Yields:
+        Blocchi di testo decodificato
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    while True:
+        block = text_file.read(block_size)
+        if not block:
+            break
+        text = decoder.decode(block)
+        if text:
+            yield text
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+def extract_text_from_pdf(pdf_file):
+    """
+    Estrae il testo da un file PDF
+    
+    Args:
+        pdf_file: File PDF (file-like object)
+        
+    Returns:
+        Testo estratto dal PDF
+    """
+    return "".join(iter_pdf_pages(pdf_file))
+
+
+# Namespace fisso per gli ID deterministici dei points
+POINT_ID_NAMESPACE = uuid.UUID("6f1c2d3e-8a4b-5c6d-9e0f-1a2b3c4d5e6f")
+
+
+def chunk_point_id(document_id, text_hash, occurrence=0, tenant_id=None):
+    """
+    Calcola l'ID deterministico del point di un chunk
+    
+    Args:
+        document_id: ID del documento (None per chunk senza documento)
+        text_hash: Hash SHA-256 del testo del chunk
+        occurrence: Numero di occorrenze precedenti dello stesso testo nel documento
+        tenant_id: Tenant del documento: lo stesso file di due tenant ha points distinti
+        
+    Returns:
+        UUID (stringa) derivato con uuid5
+    """
+    key = f"{document_id if document_id is not None else ''}:{text_hash}:{occurrence}"
+    if tenant_id is not None:
+        key = f"{tenant_id}/{key}"
+    return str(uuid.uuid5(POINT_ID_NAMESPACE, key))
+
+
+def estimate_tokens(text):
+    """
+    Stima il numero di token di un testo (circa 4 caratteri per token)
+    
+    Args:
+        text: Testo da stimare
+        
+    Returns:
+        Numero stimato di token (almeno 1)
+    """
+    return max(1, (len(text) + 3) // 4)
+
+
+def chunk_tokens(chunk):
+    """
+    Numero di token di un chunk: quello calcolato dal chunker a token
+    ("num_tokens") se disponibile, altrimenti la stima
+    
+    Args:
+        chunk: Stringa o dizionario con chiave "text"
+        
+    Returns:
+        Numero di token
+    """
+    if isinstance(chunk, str):
+        return estimate_tokens(chunk)
+    return chunk.get("num_tokens") or estimate_tokens(chunk["text"])
+
+
+def iter_embedding_batches(chunks, batch_size=100, max_tokens_per_request=100_000):
+    """
+    Raggruppa i chunk in batch da inviare in una singola richiesta di embedding
+    
+    Un batch viene chiuso quando raggiunge batch_size chunk oppure quando il
+    chunk successivo farebbe superare max_tokens_per_request token (esatti per
+    i chunk prodotti dal chunker a token, stimati per gli altri).
+    Un singolo chunk più grande del limite viene comunque inviato da solo.
+    
+    Args:
+        chunks: Lista (o iterabile) di chunk: stringhe o dizionari con chiave "text"
+        batch_size: Numero massimo di chunk per batch
+        max_tokens_per_request: Numero massimo di token stimati per batch
+        
+    Yields:
+        Liste di chunk, nell'ordine originale
+    """
+    if batch_size < 1:
+        raise ValueError("batch_size deve essere almeno 1")
+    
+    batch = []
+    batch_tokens = 0
+    for chunk in chunks:
+        tokens = chunk_tokens(chunk)
+        if batch and (len(batch) >= batch_size or batch_tokens + tokens > max_tokens_per_request):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(chunk)
+        batch_tokens += tokens
+    
+    if batch:
+        yield batch
+
+
+def iter_text_chunks(pieces, chunk_size=500, overlap=50):
+    """
+    Divide in chunk con overlap un testo che arriva a pezzi (es. pagina per pagina)
+    
+    I chunk attraversano i confini tra i pezzi e sono identici a quelli di
+    chunk_text sul testo concatenato, ma in memoria resta solo l'ultimo chunk
+    parziale (con l'overlap da riportare sul successivo).
+    
+    Args:
+        pieces: Iterabile di stringhe consecutive del testo
+        chunk_size: Dimensione di ogni chunk
+        overlap: Numero di caratteri di sovrapposizione tra i chunk
+        
+    Yields:
+        Chunk di testo
+    """
+    for chunk, _ in iter_text_chunk_offsets(pieces, chunk_size=chunk_size, overlap=overlap):
+        yield chunk
+
+
+def iter_text_chunk_offsets(pieces, chunk_size=500, overlap=50):
+    """
+    Come iter_text_chunks, ma restituisce anche la posizione di ogni chunk
+    
+    Yields:
+        Tuple (chunk, offset) dove offset è la posizione (in caratteri) del
+        primo carattere del chunk nel testo concatenato
+    """
+    step = chunk_size - overlap
+    if step < 1:
+        raise ValueError("overlap deve essere minore di chunk_size")
+    
+    buffer = ""
+    # Offset nel testo concatenato del primo carattere del buffer
+    buffer_offset = 0
+    for piece in pieces:
+        if not piece:
+            continue
+        buffer += piece
+        start = 0
+        while start + chunk_size <= len(buffer):
+            chunk = buffer[start:start + chunk_size]
+            if chunk.strip():
+                yield chunk, buffer_offset + start
+            start += step
+        # Mantiene solo il testo non ancora coperto da un chunk completo
+        buffer = buffer[start:]
+        buffer_offset += start
+    
+    # Ultimi chunk (più corti di chunk_size)
+    start = 0
+    while start < len(buffer):
+        chunk = buffer[start:start + chunk_size]
+        if chunk.strip():
+            yield chunk, buffer_offset + start
+        start += step
 
 
 def chunk_text(text, chunk_size=500, overlap=50):
@@ -430,69 +2806,277 @@ def chunk_text(text, chunk_size=500, overlap=50):
     Returns:
         Lista di chunk di testo
     """
-    chunks = []
-    start = 0
-    text_length = len(text)
+    return list(iter_text_chunks([text], chunk_size=chunk_size, overlap=overlap))
+
+
+def clean_text(text):
+    """
+    Pulisce il testo da caratteri non-ASCII problematici (emoji, etc)
     
-    while start < text_length:
-        end = start + chunk_size
-        chunk = text[start:end]
-        if chunk.strip():
-            chunks.append(chunk)
-        start = end - overlap
+    Args:
+        text: Testo da pulire
+        
+    Returns:
+        Testo con i soli caratteri ASCII (gli accenti vengono rimossi)
+    """
+    # Mantieni solo caratteri ASCII o sostituisci con equivalenti
+    text = unicodedata.normalize('NFKD', text)
+    return text.encode('ascii', 'ignore').decode('ascii')
+
+
+def is_pdf_file(uploaded_file):
+    """Indica se un file caricato è un PDF"""
+    return uploaded_file.type == "application/pdf" or uploaded_file.name.endswith('.pdf')
+
+
+def iter_document_text(uploaded_file):
+    """
+    Estrae il testo di un file caricato (PDF o TXT) un pezzo alla volta
+    
+    Args:
+        uploaded_file: File caricato
+        
+    Yields:
+        Testo ripulito di ogni pagina (PDF) o blocco (TXT)
+    """
+    if is_pdf_file(uploaded_file):
+        pieces = iter_pdf_pages(uploaded_file)
+    else:
+        pieces = iter_text_file(uploaded_file)
+    for piece in pieces:
+        yield clean_text(piece)
+
+
+def _extract_pdf_page_range(pdf_bytes, start, end):
+    """
+    Estrae il testo delle pagine [start, end) di un PDF (eseguita nei processi worker)
     
-    return chunks
+    Args:
+        pdf_bytes: Contenuto del file PDF
+        start: Indice della prima pagina
+        end: Indice successivo all'ultima pagina
+        
+    Returns:
+        Lista con il testo ripulito di ogni pagina
+    """
+    pdf_reader = PdfReader(io.BytesIO(pdf_bytes))
+    return [clean_text(pdf_reader.pages[i].extract_text() or "") for i in range(start, end)]
 
 
-def process_uploaded_files(uploaded_files, chunk_size=500, chunk_overlap=50):
+def iter_parallel_document_text(uploaded_files, max_workers=None, pages_per_task=32):
     """
-    Processa una lista di file caricati (PDF o TXT)
+    Estrae il testo di più file in parallelo con un pool di processi
+    
+    Ogni PDF viene diviso in intervalli di pages_per_task pagine, distribuiti sui
+    processi insieme agli altri file; i risultati vengono riassemblati nell'ordine
+    originale. Al massimo 2 * max_workers intervalli sono in lavorazione o in
+    attesa di essere consumati, così la memoria resta limitata.
+    
+    Args:
+        uploaded_files: Lista (o iterabile) di file caricati
+        max_workers: Numero di processi (default: numero di core)
+        pages_per_task: Numero di pagine per ogni task (default: 32)
+        
+    Yields:
+        Tuple (indice_file, uploaded_file, testo) nell'ordine dei file e delle pagine
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    
+    def iter_tasks():
+        # Un task per ogni intervallo di pagine dei PDF; i TXT vengono letti subito
+        for index, uploaded_file in enumerate(uploaded_files):
+            if is_pdf_file(uploaded_file):
+                pdf_bytes = uploaded_file.getvalue() if hasattr(uploaded_file, "getvalue") else uploaded_file.read()
+                num_pages = len(PdfReader(io.BytesIO(pdf_bytes)).pages)
+                for start in range(0, num_pages, pages_per_task):
+                    yield index, uploaded_file, (pdf_bytes, start, min(start + pages_per_task, num_pages))
+            else:
+                yield index, uploaded_file, [clean_text(piece) for piece in iter_text_file(uploaded_file)]
+    
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        for index, uploaded_file, task in iter_tasks():
+            if isinstance(task, tuple):
+                task = pool.submit(_extract_pdf_page_range, *task)
+            pending.append((index, uploaded_file, task))
+            
+            # Consuma i risultati in ordine quando la finestra è piena
+            while len(pending) > 2 * max_workers:
+                yield from _pop_pages(pending)
+        
+        while pending:
+            yield from _pop_pages(pending)
+
+
+def _iter_parallel_documents(uploaded_files, max_workers=None):
+    """Raggruppa per file le pagine estratte in parallelo: (uploaded_file, pagine)"""
+    pages = iter_parallel_document_text(uploaded_files, max_workers=max_workers)
+    for _, group in groupby(pages, key=lambda page: page[0]):
+        _, uploaded_file, first_page = next(group)
+        yield uploaded_file, chain([first_page], (page for _, _, page in group))
+
+
+def _pop_pages(pending):
+    """Restituisce le pagine del primo task in coda (attendendone il risultato)"""
+    index, uploaded_file, task = pending.popleft()
+    pages = task if isinstance(task, list) else task.result()
+    for page in pages:
+        yield index, uploaded_file, page
+
+
+def iter_uploaded_documents(uploaded_files, chunk_size=500, chunk_overlap=50,
+                            parallel=False, max_workers=None,
+                            token_chunking=False, embedding_model="text-embedding-3-small"):
+    """
+    Versione in streaming di process_uploaded_documents
+    
+    Il testo viene estratto pagina per pagina e i chunk vengono prodotti man mano:
+    passando il generatore a RAGSystem.index_documents gli embedding partono
+    mentre l'estrazione è ancora in corso e il documento non è mai tutto in memoria.
     
     Args:
         uploaded_files: Lista di file caricati
         chunk_size: Dimensione di ogni chunk (default: 500)
         chunk_overlap: Numero di caratteri sovrapposti tra chunks (default: 50)
+        parallel: Se True, estrae i PDF in parallelo su un pool di processi
+                  (file e intervalli di pagine), con gli stessi chunk in output
+        max_workers: Numero di processi in modalità parallela (default: numero di core)
+        token_chunking: Se True, chunk_size e chunk_overlap sono in token del modello
+                        di embedding e i chunk terminano su confini di paragrafo o frase
+                        (vedi token_chunker.iter_token_chunks)
+        embedding_model: Modello di embedding di cui usare il tokenizer
         
-    Returns:
-        Lista di tutti i chunk estratti dai file
+    Yields:
+        Dizionari {"text", "document_id", "filename", "chunk_offset"} (più "page"
+        per i PDF e "num_tokens" con token_chunking); chunk_offset è la posizione
+        del chunk nel testo estratto del documento, page la pagina (da 1) in cui inizia
     """
-    import unicodedata
-    
-    all_chunks = []
+    if parallel:
+        documents = _iter_parallel_documents(uploaded_files, max_workers)
+    else:
+        documents = ((uploaded_file, iter_document_text(uploaded_file)) for uploaded_file in uploaded_files)
     
-    for uploaded_file in uploaded_files:
-        # Estrai testo
-        if uploaded_file.type == "application/pdf" or uploaded_file.name.endswith('.pdf'):
-            text = extract_text_from_pdf(uploaded_file)
+    for uploaded_file, pieces in documents:
+        # Offset di inizio di ogni pagina, registrati man mano che le pagine vengono lette
+        page_starts = [] if is_pdf_file(uploaded_file) else None
+        if page_starts is not None:
+            pieces = _track_page_starts(pieces, page_starts)
+        
+        if token_chunking:
+            chunks = iter_token_chunk_offsets(pieces, chunk_size, chunk_overlap, embedding_model)
         else:
-            text = uploaded_file.read().decode("utf-8")
+            chunks = ((chunk, None, offset) for chunk, offset in iter_text_chunk_offsets(pieces, chunk_size, chunk_overlap))
         
-        # Pulisci il testo da caratteri non-ASCII problematici (emoji, etc)
-        # Mantieni solo caratteri ASCII o sostituisci con equivalenti
-        text = unicodedata.normalize('NFKD', text)
-        text = text.encode('ascii', 'ignore').decode('ascii')
+        for chunk, num_tokens, offset in chunks:
+            record = {
+                "text": chunk,
+                "document_id": uploaded_file.name,
+                "filename": uploaded_file.name,
+                "chunk_offset": offset
+            }
+            if page_starts is not None:
+                # Un chunk viene prodotto solo dopo la lettura della pagina in cui inizia
+                record["page"] = bisect_right(page_starts, offset)
+            if num_tokens is not None:
+                record["num_tokens"] = num_tokens
+            yield record
+
+
+def _track_page_starts(pages, page_starts):
+    """Restituisce le pagine registrando in page_starts l'offset di inizio di ognuna"""
+    offset = 0
+    for page in pages:
+        page_starts.append(offset)
+        offset += len(page)
+        yield page
+
+
+def process_uploaded_documents(uploaded_files, chunk_size=500, chunk_overlap=50,
+                               parallel=False, max_workers=None,
+                               token_chunking=False, embedding_model="text-embedding-3-small"):
+    """
+    Processa una lista di file caricati (PDF o TXT) mantenendo il documento di origine
+    
+    Args:
+        uploaded_files: Lista di file caricati
+        chunk_size: Dimensione di ogni chunk (default: 500)
+        chunk_overlap: Numero di caratteri sovrapposti tra chunks (default: 50)
+        parallel: Se True, estrae i PDF in parallelo su un pool di processi
+        max_workers: Numero di processi in modalità parallela (default: numero di core)
+        token_chunking: Se True, chunk_size e chunk_overlap sono in token (vedi iter_uploaded_documents)
+        embedding_model: Modello di embedding di cui usare il tokenizer
         
-        # Chunking
-        chunks = chunk_text(text, chunk_size=chunk_size, overlap=chunk_overlap)
-        all_chunks.extend(chunks)
+    Returns:
+        Lista di dizionari {"text", "document_id", "filename", "chunk_offset"} (vedi
+        iter_uploaded_documents); il nome del file fa da document_id, così un file ricaricato sostituisce la versione precedente
+    """
+    return list(iter_uploaded_documents(
+        uploaded_files, chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+        parallel=parallel, max_workers=max_workers,
+        token_chunking=token_chunking, embedding_model=embedding_model
+    ))
+
+
+def process_uploaded_files(uploaded_files, chunk_size=500, chunk_overlap=50,
+                           parallel=False, max_workers=None,
+                           token_chunking=False, embedding_model="text-embedding-3-small"):
+    """
+    Processa una lista di file caricati (PDF o TXT)
     
-    return all_chunks
+    Args:
+        uploaded_files: Lista di file caricati
+        chunk_size: Dimensione di ogni chunk (default: 500)
+        chunk_overlap: Numero di caratteri sovrapposti tra chunks (default: 50)
+        parallel: Se True, estrae i PDF in parallelo su un pool di processi
+        max_workers: Numero di processi in modalità parallela (default: numero di core)
+        token_chunking: Se True, chunk_size e chunk_overlap sono in token (vedi iter_uploaded_documents)
+        embedding_model: Modello di embedding di cui usare il tokenizer
+        
+    Returns:
+        Lista di tutti i chunk estratti dai file
+    """
+    documents = process_uploaded_documents(
+        uploaded_files, chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+        parallel=parallel, max_workers=max_workers,
+        token_chunking=token_chunking, embedding_model=embedding_model
+    )
+    return [chunk["text"] for chunk in documents]
 
 
-def get_vector_size(embedding_model):
+# Dimensione nativa dei vettori dei modelli di embedding OpenAI
+EMBEDDING_MODEL_DIMENSIONS = {
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+    "text-embedding-ada-002": 1536,
+}
+
+# Modelli che accettano il parametro dimensions (vettori ridotti)
+REDUCIBLE_EMBEDDING_MODELS = ("text-embedding-3-small", "text-embedding-3-large")
+
+
+def get_vector_size(embedding_model, dimensions=None):
     """
     Restituisce la dimensione dei vettori per un dato modello di embedding
     
     Args:
         embedding_model: Nome del modello di embedding
+        dimensions: Dimensione ridotta richiesta (None = dimensione nativa)
         
     Returns:
         Dimensione dei vettori
     """
+    if dimensions:
+        native = EMBEDDING_MODEL_DIMENSIONS.get(embedding_model)
+        if embedding_model not in REDUCIBLE_EMBEDDING_MODELS and dimensions != native:
+            raise ValueError(f"Il modello {embedding_model} non supporta dimensioni ridotte")
+        if native and dimensions > native:
+            raise ValueError(f"Il modello {embedding_model} produce al massimo {native} dimensioni")
+        return dimensions
+    if embedding_model in EMBEDDING_MODEL_DIMENSIONS:
+        return EMBEDDING_MODEL_DIMENSIONS[embedding_model]
     if "small" in embedding_model or "ada" in embedding_model:
         return 1536
     elif "large" in embedding_model:
         return 3072
     else:
         return 1536  # default
-
@@ -12,10 +12,13 @@ if sys.platform == 'darwin':  # macOS
     os.environ['REQUESTS_CA_BUNDLE'] = '/opt/homebrew/etc/openssl@3/cert.pem'
 
 import streamlit as st
+from ingestion_queue import IngestionQueue, start_worker_thread
 from rag_logic import (
     RAGSystem,
-    process_uploaded_files,
-    get_vector_size
+    DEFAULT_TENANT_ID,
+    iter_uploaded_documents,
+    get_vector_size,
+    REDUCIBLE_EMBEDDING_MODELS
 )
 
 # Configurazione della pagina
@@ -52,8 +55,6 @@ if "messages" not in st.session_state:
     st.session_state.messages = []
 if "rag_system" not in st.session_state:
     st.session_state.rag_system = None
-if "pipeline" not in st.session_state:
-    st.session_state.pipeline = None
 
 # Sidebar per configurazione
 with st.sidebar:
@@ -69,6 +70,15 @@ with st.sidebar:
     # Pulisci l'API key da spazi o caratteri nascosti
     if openai_api_key:
         openai_api_key = openai_api_key.strip()
+    
+    # Tenant: documenti e ricerche di ogni area di lavoro restano separati,
+    # nella stessa collection e con lo stesso client Qdrant
+    tenant_id = st.text_input(
+        "Area di lavoro",
+        value=DEFAULT_TENANT_ID,
+        help="Ogni area vede solo i documenti caricati al suo interno (es. un cliente o un team); "
+             f"i documenti indicizzati prima delle aree di lavoro appartengono a '{DEFAULT_TENANT_ID}'"
+    ).strip() or DEFAULT_TENANT_ID
 
     
     st.markdown("---")
@@ -87,6 +97,57 @@ with st.sidebar:
         help="Seleziona il modello di embedding da utilizzare"
     )
     
+    # I modelli text-embedding-3 possono restituire vettori più corti
+    native_dimensions = get_vector_size(embedding_model)
+    if embedding_model in REDUCIBLE_EMBEDDING_MODELS:
+        dimension_options = [native_dimensions] + [d for d in (1024, 512, 256) if d < native_dimensions]
+    else:
+        dimension_options = [native_dimensions]
+    embedding_dimensions = st.selectbox(
+        "Dimensione embedding",
+        dimension_options,
+        help="Vettori più corti riducono indice e tempi di ricerca, con una piccola perdita di qualità. "
+             "Cambiarla richiede di ricreare la collection ('Ricrea la collection') e re-indicizzare i documenti"
+    )
+    
+    quantization_options = {
+        "Nessuna": None,
+        "Scalare int8 (RAM / 4)": "scalar",
+        "Binaria (RAM / 32)": "binary",
+        "Product (RAM / 16)": "product",
+    }
+    quantization = quantization_options[st.selectbox(
+        "Quantizzazione vettori",
+        list(quantization_options),
+        help="Comprime i vettori in RAM; in ricerca i candidati vengono riordinati con i vettori originali "
+             "(efficace con un server Qdrant)"
+    )]
+    
+    vector_backends = {
+        "Qdrant locale": "qdrant",
+        "Qdrant server": "server",
+        "Indice piatto NumPy (memory-map)": "flat",
+    }
+    vector_backend = vector_backends[st.selectbox(
+        "Backend vettoriale",
+        list(vector_backends),
+        help="L'indice piatto tiene i vettori in un file .npy in memory-map: si apre subito e "
+             "cerca con un solo prodotto matrice-vettore anche su centinaia di migliaia di chunks"
+    )]
+    
+    qdrant_server = None
+    if vector_backend == "server":
+        qdrant_server = {
+            "host": st.text_input("Host Qdrant", value="localhost"),
+            "port": int(st.number_input("Porta REST", value=6333, step=1)),
+            "prefer_grpc": st.checkbox(
+                "Usa gRPC",
+                value=True,
+                help="Vettori in formato binario e connessioni persistenti: upsert e ricerche più rapidi"
+            ),
+            "grpc_port": int(st.number_input("Porta gRPC", value=6334, step=1)),
+        }
+    
     k_documents = st.slider(
         "Numero documenti da recuperare (k)",
         min_value=1,
@@ -95,27 +156,99 @@ with st.sidebar:
         help="Quanti documenti recuperare dal vectorstore"
     )
     
+    speculative_retrieval = st.checkbox(
+        "⚡ Retrieval speculativo",
+        value=True,
+        help="Avvia la ricerca sulla domanda originale mentre la query viene riscritta (risposta più rapida)"
+    )
+    
+    # Per una collection esistente il default segue la sua struttura (il vettore sparso
+    # non si aggiunge a una collection già creata)
+    existing_hybrid = None
+    if st.session_state.rag_system is not None:
+        try:
+            existing_hybrid = st.session_state.rag_system.is_hybrid_collection(st.session_state.collection_name)
+        except Exception:
+            pass
+    hybrid_search = st.checkbox(
+        "🔎 Ricerca ibrida (BM25 + semantica)",
+        value=True if existing_hybrid is None else existing_hybrid,
+        help="Affianca alla ricerca semantica una ricerca per parole chiave (BM25): trova codici, "
+             "identificativi e nomi rari senza aumentare k. Vale per le nuove collection: una collection "
+             "esistente mantiene la sua struttura finché non viene ricreata (solo Qdrant)"
+    )
+    
+    mmr_diversity = st.slider(
+        "Diversità delle fonti (MMR)",
+        min_value=0.0,
+        max_value=1.0,
+        value=0.0,
+        step=0.1,
+        help="Evita di recuperare più chunks quasi identici (es. chunks vicini dello stesso documento): "
+             "0 = solo rilevanza, valori più alti = fonti più diverse"
+    )
+    
     st.markdown("---")
     
     # Parametri di Chunking
     st.markdown("### 📏 Parametri Chunking")
     
-    chunk_size = st.slider(
-        "Dimensione chunks",
-        min_value=200,
-        max_value=2000,
-        value=500,
-        step=100,
-        help="Numero di caratteri per ogni chunk"
+    token_chunking = st.radio(
+        "Unità dei chunks",
+        options=["Caratteri", "Token"],
+        horizontal=True,
+        help="Con 'Token' i chunks hanno un numero preciso di token del modello di embedding "
+             "e terminano su fine paragrafo o frase"
+    ) == "Token"
+    
+    if token_chunking:
+        chunk_size = st.slider(
+            "Dimensione chunks (token)",
+            min_value=64,
+            max_value=2048,
+            value=256,
+            step=32,
+            help="Numero massimo di token per ogni chunk"
+        )
+        
+        chunk_overlap = st.slider(
+            "Overlap tra chunks (token)",
+            min_value=0,
+            max_value=256,
+            value=32,
+            step=8,
+            help="Numero di token sovrapposti tra chunks consecutivi"
+        )
+    else:
+        chunk_size = st.slider(
+            "Dimensione chunks",
+            min_value=200,
+            max_value=2000,
+            value=500,
+            step=100,
+            help="Numero di caratteri per ogni chunk"
+        )
+        
+        chunk_overlap = st.slider(
+            "Overlap tra chunks",
+            min_value=0,
+            max_value=500,
+            value=50,
+            step=25,
+            help="Numero di caratteri sovrapposti tra chunks consecutivi (default datapizza: 50)"
+        )
+    
+    deduplicate_chunks = st.checkbox(
+        "🧹 Rimuovi chunks duplicati",
+        value=True,
+        help="Scarta prima dell'embedding i chunks identici o quasi identici (intestazioni, piè di pagina, "
+             "disclaimer ripetuti); il chunk tenuto ricorda tutti i documenti che lo contengono"
     )
     
-    chunk_overlap = st.slider(
-        "Overlap tra chunks",
-        min_value=0,
-        max_value=500,
-        value=50,
-        step=25,
-        help="Numero di caratteri sovrapposti tra chunks consecutivi (default datapizza: 50)"
+    parallel_extraction = st.checkbox(
+        "🧵 Estrazione PDF in parallelo",
+        value=True,
+        help="Distribuisce file e gruppi di pagine dei PDF su più processi (sfrutta tutti i core)"
     )
     
     st.markdown("---")
@@ -132,6 +265,16 @@ with st.sidebar:
         help="Creatività delle risposte (0=deterministica e fedele ai documenti, 1=creativa, consigliato: 0)"
     )
     
+    max_context_tokens = st.slider(
+        "Budget token del contesto",
+        min_value=500,
+        max_value=16000,
+        value=4000,
+        step=500,
+        help="Token massimi del contenuto recuperato nel prompt: i chunks sovrapposti dello stesso "
+             "documento vengono uniti e, superato il budget, si scartano le fonti meno rilevanti"
+    )
+    
     # Parametri avanzati (valori predefiniti)
     system_prompt = "Riscrivi le query dell'utente per migliorare l'accuratezza del recupero."
     user_prompt_template = "Domanda dell'utente: {{user_prompt}}\n"
@@ -139,10 +282,159 @@ with st.sidebar:
     
     st.markdown("---")
     
+    show_metrics = st.checkbox(
+        "⏱️ Mostra tempi della risposta",
+        value=False,
+        help="Mostra nelle fonti i tempi di rewriting, embedding, retrieval e generazione"
+    )
+    
+    st.markdown("---")
+    
     if st.button("🗑️ Reset Chat"):
         st.session_state.messages = []
         st.rerun()
 
+def apply_sidebar_settings(rag_system):
+    """Applica le impostazioni della sidebar: se cambiano, i componenti registrati
+    (client, embedder, rewriter, retriever) vengono ricreati alla prossima query"""
+    rag_system.update_settings(
+        openai_api_key=openai_api_key or None,
+        model_name=model_name,
+        embedding_model=embedding_model,
+        embedding_dimensions=embedding_dimensions,
+        temperature=temperature,
+        max_context_tokens=max_context_tokens,
+        tenant_id=tenant_id,
+        system_prompt=system_prompt,
+        user_prompt_template=user_prompt_template,
+        retrieval_prompt_template=retrieval_prompt_template
+    )
+
+if st.session_state.rag_system is not None:
+    apply_sidebar_settings(st.session_state.rag_system)
+
+def ensure_vector_backend(rag_system, backend, server=None):
+    """Inizializza (o cambia) il backend vettoriale scelto nella sidebar"""
+    if backend == "flat":
+        if rag_system.flat_store is None:
+            rag_system.initialize_flat_index(storage_path="./flat_index")
+    elif backend == "server":
+        current = (rag_system.qdrant_host, rag_system.qdrant_port,
+                   rag_system.qdrant_connection.get("prefer_grpc"), rag_system.qdrant_connection.get("grpc_port"))
+        requested = (server["host"], server["port"], server["prefer_grpc"], server["grpc_port"])
+        if rag_system.qdrant_client is None or rag_system.use_memory or current != requested:
+            # Il client (con il suo pool di connessioni) è condiviso da tutte le sessioni
+            rag_system.initialize_qdrant(use_memory=False, timeout=30, **server)
+    elif rag_system.qdrant_client is None or not rag_system.use_memory:
+        rag_system.initialize_qdrant(
+            use_memory=True  # usa_memory=True ora significa persistenza locale
+        )
+
+def vector_backend_config(backend, server=None):
+    """Configurazione serializzabile del backend scelto, per i job di indicizzazione in background"""
+    if backend == "flat":
+        return {"type": "flat", "storage_path": "./flat_index"}
+    if backend == "server":
+        return {"type": "qdrant", "use_memory": False, "timeout": 30, **server}
+    return {"type": "qdrant", "use_memory": True}
+
+def get_rag_system():
+    """Sistema RAG della sessione (creato alla prima chiamata) con il backend scelto nella sidebar"""
+    if st.session_state.rag_system is None:
+        st.session_state.rag_system = RAGSystem(
+            openai_api_key=openai_api_key,
+            model_name=model_name,
+            embedding_model=embedding_model,
+            embedding_cache_path="./embedding_cache.sqlite",
+            embedding_dimensions=embedding_dimensions,
+            tenant_id=tenant_id
+        )
+        apply_sidebar_settings(st.session_state.rag_system)
+    ensure_vector_backend(st.session_state.rag_system, vector_backend, qdrant_server)
+    return st.session_state.rag_system
+
+def collection_hybrid(rag_system, collection_name):
+    """Ricerca ibrida con cui indicizzare: una collection esistente mantiene la sua struttura"""
+    existing = rag_system.is_hybrid_collection(collection_name)
+    if existing is None or existing == hybrid_search or rag_system.flat_store:
+        return hybrid_search
+    if hybrid_search:
+        st.info("ℹ️ La collection non ha la ricerca ibrida: i documenti vengono indicizzati senza BM25. "
+                "Per attivarla usa 'Ricrea la collection' e re-indicizza i documenti.")
+    return existing
+
+@st.cache_resource
+def get_ingestion_queue():
+    """Coda dei job di indicizzazione, condivisa da tutte le sessioni, con il suo worker"""
+    queue = IngestionQueue("./ingestion_jobs.sqlite", uploads_dir="./ingestion_uploads")
+    # Con worker esterni (python ingestion_queue.py, solo con un server Qdrant) l'app si limita a inviare i job
+    if not os.environ.get("RAG_EXTERNAL_INGESTION_WORKERS"):
+        # Un solo worker per processo: condivide client Qdrant e indici piatti con le sessioni
+        start_worker_thread(queue, embedding_cache_path="./embedding_cache.sqlite")
+    return queue
+
+def render_ingestion_jobs(jobs):
+    """Mostra stato e avanzamento dei job di indicizzazione"""
+    labels = {
+        "queued": "⏳ In coda",
+        "running": "⚙️ In corso",
+        "done": "✅ Completato",
+        "failed": "❌ Fallito",
+        "cancelled": "🛑 Annullato",
+    }
+    queue = get_ingestion_queue()
+    for job in jobs:
+        names = ", ".join(file["name"] for file in job["files"])
+        details = f"{job['chunks_done']} chunks indicizzati"
+        if job["status"] == "done" and job["stats"]:
+            details += (f" ({job['stats']['skipped']} già presenti, "
+                        f"{job['stats']['duplicates']} duplicati scartati, {job['stats']['deleted']} obsoleti rimossi)")
+        elif job["status"] == "queued" and job["attempts"]:
+            details += " · nuovo tentativo dopo un errore"
+        st.markdown(f"**{labels[job['status']]}** · {names} · {details}")
+        if job["error"] and job["status"] in ("queued", "failed"):
+            st.caption(f"Errore: {job['error']}")
+        if job["status"] in ("queued", "running"):
+            if st.button("Annulla", key=f"cancel_{job['id']}"):
+                queue.cancel(job["id"])
+                st.rerun()
+        elif job["status"] == "failed":
+            if st.button("Riprova", key=f"retry_{job['id']}"):
+                queue.retry(job["id"], openai_api_key=openai_api_key or None)
+                st.rerun()
+
+@st.fragment(run_every=2)
+def poll_ingestion_jobs(tenant_id, collection_name):
+    """Aggiorna lo stato dei job attivi ogni 2 secondi, senza rieseguire l'intera pagina"""
+    jobs = get_ingestion_queue().jobs(limit=5, tenant_id=tenant_id, collection_name=collection_name)
+    render_ingestion_jobs(jobs)
+    if not any(job["status"] in ("queued", "running") for job in jobs):
+        # Job conclusi: la pagina intera aggiorna documenti disponibili e filtri
+        st.rerun()
+
+def render_metrics(metrics):
+    """Mostra i tempi delle fasi di una risposta"""
+    spans = metrics.get("spans_ms", {})
+    labels = {
+        "rewrite": "Rewriting",
+        "rewrite_wait": "Attesa rewriting",
+        "embed": "Embedding",
+        "retrieve": "Retrieval",
+        "mmr": "MMR",
+        "prompt": "Prompt",
+        "generate": "Generazione",
+    }
+    parts = [f"{labels.get(name, name)}: {ms:.0f} ms" for name, ms in spans.items()]
+    if metrics.get("time_to_first_token_ms") is not None:
+        parts.append(f"Primo token: {metrics['time_to_first_token_ms']:.0f} ms")
+    parts.append(f"Totale: {metrics.get('total_ms') or 0:.0f} ms")
+    if metrics.get("context_tokens") is not None:
+        parts.append(f"Token di contesto: {metrics['context_tokens']}")
+    if metrics.get("completion_tokens") is not None:
+        parts.append(f"Token generati: {metrics['completion_tokens']}")
+    parts.append(f"Frammenti in streaming: {metrics.get('chunks_streamed', 0)}")
+    st.markdown("**⏱️ Tempi:** " + " · ".join(parts))
+
 # Main content
 col1, col2 = st.columns([1, 1])
 
@@ -157,78 +449,162 @@ with col1:
         help="Carica uno o più file PDF o TXT da indicizzare"
     )
     
+    background_indexing = st.checkbox(
+        "⏳ Indicizza in background",
+        value=True,
+        help="I file vengono messi in coda e indicizzati da un worker: la sessione resta libera, "
+             "l'indicizzazione prosegue anche chiudendo il browser e dopo un errore riprende da dove si era fermata"
+    )
+    
     if st.button("🚀 Indicizza Documenti", disabled=not openai_api_key or not uploaded_files):
         if not openai_api_key:
             st.error("⚠️ Inserisci una API key di OpenAI nella sidebar!")
         elif not uploaded_files:
             st.error("⚠️ Carica almeno un documento!")
+        elif background_indexing:
+            try:
+                collection_hybrid_search = collection_hybrid(get_rag_system(), st.session_state.collection_name)
+                # Il job salva le impostazioni correnti (l'API key resta solo in memoria)
+                get_ingestion_queue().submit(
+                    uploaded_files,
+                    st.session_state.collection_name,
+                    settings={
+                        "embedding_model": embedding_model,
+                        "embedding_dimensions": embedding_dimensions,
+                        "tenant_id": tenant_id,
+                        "chunk_size": chunk_size,
+                        "chunk_overlap": chunk_overlap,
+                        "token_chunking": token_chunking,
+                        "deduplicate": deduplicate_chunks,
+                        "parallel": parallel_extraction,
+                        "collection_options": {
+                            "quantization": quantization,
+                            "hybrid": collection_hybrid_search,
+                            "multitenant": True,
+                        },
+                        "backend": vector_backend_config(vector_backend, qdrant_server),
+                    },
+                    openai_api_key=openai_api_key
+                )
+                st.success(f"📬 {len(uploaded_files)} documento/i in coda per l'indicizzazione")
+            except Exception as e:
+                st.error(f"❌ Errore durante l'invio dei documenti: {str(e)}")
         else:
             with st.spinner("📚 Elaborazione documenti in corso..."):
                 try:
-                    # Inizializza il sistema RAG se non esiste già
-                    if st.session_state.rag_system is None:
-                        st.session_state.rag_system = RAGSystem(
-                            openai_api_key=openai_api_key,
-                            model_name=model_name,
-                            embedding_model=embedding_model
-                        )
-                    
-                    # Inizializza Qdrant se non è già inizializzato
-                    if st.session_state.rag_system.qdrant_client is None:
-                        st.session_state.rag_system.initialize_qdrant(
-                            use_memory=True  # usa_memory=True ora significa persistenza locale
-                        )
+                    # Inizializza il sistema RAG e il backend vettoriale se non esistono già
+                    rag_system = get_rag_system()
                     
-                    # Crea collection
-                    vector_size = get_vector_size(embedding_model)
+                    # Crea collection (se esiste già viene mantenuta: indicizzazione incrementale)
+                    # (dimensione e modello di embedding vengono salvati con la collection)
                     st.session_state.rag_system.create_collection_if_not_exists(
                         st.session_state.collection_name,
-                        vector_size
+                        quantization=quantization,
+                        hybrid=collection_hybrid(rag_system, st.session_state.collection_name),
+                        multitenant=True
                     )
                     
-                    # Processa i file
-                    all_chunks = []
-                    for uploaded_file in uploaded_files:
-                        chunks = process_uploaded_files([uploaded_file], chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-                        all_chunks.extend(chunks)
+                    # Processa i file in streaming (ogni chunk ricorda il documento di origine):
+                    # i chunk vengono indicizzati mentre l'estrazione delle pagine è in corso
+                    files_started = [0]
                     
-                    # Indicizza con progress bar
+                    def track_documents(chunks):
+                        # Conta i documenti man mano che ne arrivano i chunk
+                        current_document = None
+                        for chunk in chunks:
+                            if chunk["document_id"] != current_document:
+                                current_document = chunk["document_id"]
+                                files_started[0] += 1
+                            yield chunk
+                    
+                    all_chunks = track_documents(iter_uploaded_documents(
+                        uploaded_files,
+                        chunk_size=chunk_size,
+                        chunk_overlap=chunk_overlap,
+                        parallel=parallel_extraction,
+                        token_chunking=token_chunking,
+                        embedding_model=embedding_model
+                    ))
+                    
+                    # Indicizza con progress bar (il numero totale di chunk non è noto in anticipo)
                     progress_bar = st.progress(0)
                     status_text = st.empty()
                     
                     def update_progress(current, total):
-                        progress = current / total
+                        progress = max(files_started[0] - 1, 0) / len(uploaded_files)
                         progress_bar.progress(progress)
-                        status_text.text(f"Indicizzazione: {current}/{total} chunks")
+                        status_text.text(
+                            f"Indicizzazione: {current} chunks "
+                            f"(documento {files_started[0]}/{len(uploaded_files)})"
+                        )
                     
                     num_indexed = st.session_state.rag_system.index_documents(
                         st.session_state.collection_name,
                         all_chunks,
-                        progress_callback=update_progress
+                        progress_callback=update_progress,
+                        deduplicate=deduplicate_chunks
                     )
                     
                     progress_bar.empty()
                     status_text.empty()
                     
-                    # Crea la pipeline
-                    st.session_state.pipeline = st.session_state.rag_system.create_pipeline(
-                        collection_name=st.session_state.collection_name,
-                        k=k_documents,
-                        temperature=temperature,
-                        system_prompt=system_prompt,
-                        user_prompt_template=user_prompt_template,
-                        retrieval_prompt_template=retrieval_prompt_template
-                    )
-                    
                     st.session_state.documents_loaded = True
                     
-                    st.success(f"✅ Indicizzati {num_indexed} chunks da {len(uploaded_files)} documento/i!")
+                    index_stats = st.session_state.rag_system.last_index_stats
+                    st.success(
+                        f"✅ Indicizzati {num_indexed} chunks nuovi o modificati da {len(uploaded_files)} documento/i "
+                        f"({index_stats['skipped']} già presenti, {index_stats['duplicates']} duplicati scartati, "
+                        f"{index_stats['deleted']} obsoleti rimossi)!"
+                    )
                     
                 except Exception as e:
                     st.error(f"❌ Errore durante l'indicizzazione: {str(e)}")
                     import traceback
                     st.code(traceback.format_exc())
     
+    # Con impostazioni di embedding diverse da quelle della collection ricerca e
+    # indicizzazione falliscono finché la collection non viene ricreata
+    if st.session_state.rag_system is not None:
+        try:
+            if st.session_state.rag_system.is_hybrid_collection(st.session_state.collection_name) is not None:
+                st.session_state.rag_system.check_collection_embedding(st.session_state.collection_name)
+        except ValueError as e:
+            st.warning(f"⚠️ {e} Per usare le nuove impostazioni ricrea la collection qui sotto.")
+        except Exception:
+            pass
+    
+    with st.expander("♻️ Ricrea la collection"):
+        st.caption(
+            "Cancella la collection, con i documenti di tutte le aree di lavoro, e la ricrea con le "
+            "impostazioni correnti (modello e dimensione embedding, ricerca ibrida, quantizzazione). "
+            "Poi i documenti vanno indicizzati di nuovo."
+        )
+        confirm_recreate = st.checkbox("Confermo la cancellazione di tutti i documenti indicizzati")
+        if st.button("♻️ Ricrea collection", disabled=not openai_api_key or not confirm_recreate):
+            try:
+                get_rag_system().create_collection_if_not_exists(
+                    st.session_state.collection_name,
+                    recreate=True,
+                    quantization=quantization,
+                    hybrid=hybrid_search,
+                    multitenant=True
+                )
+                st.session_state.documents_loaded = False
+                st.success("✅ Collection ricreata: carica e indicizza di nuovo i documenti")
+            except Exception as e:
+                st.error(f"❌ Errore durante la ricreazione della collection: {str(e)}")
+    
+    # Job in background dell'area di lavoro (anche inviati da sessioni precedenti)
+    recent_jobs = get_ingestion_queue().jobs(
+        limit=5, tenant_id=tenant_id, collection_name=st.session_state.collection_name
+    )
+    if recent_jobs:
+        st.markdown("#### 📋 Indicizzazioni in background")
+        if any(job["status"] in ("queued", "running") for job in recent_jobs):
+            poll_ingestion_jobs(tenant_id, st.session_state.collection_name)
+        else:
+            render_ingestion_jobs(recent_jobs)
+    
     # Mostra stato
     if st.session_state.documents_loaded:
  
@@ -242,21 +618,12 @@ with col2:
     if openai_api_key:
         try:
             # Prova a inizializzare il sistema RAG se non esiste
-            if st.session_state.rag_system is None:
-                st.session_state.rag_system = RAGSystem(
-                    openai_api_key=openai_api_key,
-                    model_name=model_name,
-                    embedding_model=embedding_model
-                )
-                st.session_state.rag_system.initialize_qdrant(
-                    use_memory=True  # usa_memory=True ora significa persistenza locale
-                )
+            get_rag_system()
             
             # Verifica se la collection esiste
-            if st.session_state.rag_system and st.session_state.rag_system.qdrant_client:
+            if st.session_state.rag_system:
                 try:
-                    collection_info = st.session_state.rag_system.qdrant_client.get_collection(st.session_state.collection_name)
-                    if collection_info.points_count > 0:
+                    if st.session_state.rag_system.count_points(st.session_state.collection_name) > 0:
                         documents_available = True
                         if not st.session_state.documents_loaded:
                             st.info("📚 Documenti trovati da sessioni precedenti. Puoi fare domande!")
@@ -265,6 +632,23 @@ with col2:
         except:
             pass
     
+    # Filtro per documento: la ricerca considera solo i chunks dei file scelti
+    # (per document_id, che comprende i chunks deduplicati condivisi con altri file)
+    selected_files = []
+    if documents_available:
+        try:
+            indexed_files = st.session_state.rag_system.list_documents(
+                st.session_state.collection_name, field="document_id"
+            )
+        except Exception:
+            indexed_files = []
+        if len(indexed_files) > 1:
+            selected_files = st.multiselect(
+                "📂 Cerca solo nei documenti",
+                indexed_files,
+                help="Limita la ricerca ai documenti scelti (vuoto = tutti)"
+            )
+    
     # Container per i messaggi (invertito per mostrare i più recenti in alto)
     chat_container = st.container()
     
@@ -275,6 +659,8 @@ with col2:
                 st.markdown(message["content"])
                 if "sources" in message and message["sources"]:
                     with st.expander("📚 Fonti"):
+                        if show_metrics and message.get("metrics"):
+                            render_metrics(message["metrics"])
                         for i, source in enumerate(message["sources"], 1):
                             st.markdown(f"**Fonte {i}:**")
                             st.text(source[:300] + "..." if len(source) > 300 else source)
@@ -307,25 +693,24 @@ with col2:
                 message_placeholder = st.empty()
                 full_response = ""
                 sources = []
+                metrics = None
                 
                 try:
-                    # Crea/ricrea la pipeline se necessario
-                    if st.session_state.pipeline is None:
-                        st.session_state.pipeline = st.session_state.rag_system.create_pipeline(
-                            collection_name=st.session_state.collection_name,
-                            k=k_documents,
-                            temperature=temperature,
-                            system_prompt=system_prompt,
-                            user_prompt_template=user_prompt_template,
-                            retrieval_prompt_template=retrieval_prompt_template
-                        )
-                    
-                    # Usa streaming
-                    for chunk_text, chunk_sources in st.session_state.rag_system.query_stream(
-                        pipeline=st.session_state.pipeline,
+                    # Usa streaming: i componenti (client, embedder, retriever) vengono presi
+                    # dal registro del sistema RAG, creati una sola volta per configurazione
+                    for chunk_text, chunk_sources, chunk_metrics in st.session_state.rag_system.query_stream(
                         user_query=user_query,
                         collection_name=st.session_state.collection_name,
-                        k=k_documents
+                        k=k_documents,
+                        temperature=temperature,
+                        speculative_retrieval=speculative_retrieval,
+                        include_metrics=True,
+                        search_options={
+                            "hybrid": hybrid_search,
+                            # lambda MMR: 1 = solo rilevanza (None disattiva la diversificazione)
+                            "mmr_lambda": 1 - mmr_diversity if mmr_diversity else None,
+                        },
+                        filters={"document_id": selected_files} if selected_files else None
                     ):
                         full_response += chunk_text
                         message_placeholder.markdown(full_response + "▌")
@@ -333,6 +718,9 @@ with col2:
                         # Salva le fonti dal primo chunk
                         if chunk_sources is not None:
                             sources = chunk_sources
+                        # Le metriche arrivano con l'ultimo chunk
+                        if chunk_metrics is not None:
+                            metrics = chunk_metrics.to_dict()
                     
                     # Mostra risposta finale senza cursore
                     message_placeholder.markdown(full_response)
@@ -340,6 +728,8 @@ with col2:
                     # Mostra fonti
                     if sources:
                         with st.expander("📚 Fonti"):
+                            if show_metrics and metrics:
+                                render_metrics(metrics)
                             for i, source in enumerate(sources, 1):
                                 st.markdown(f"**Fonte {i}:**")
                                 st.text(source[:300] + "..." if len(source) > 300 else source)
@@ -348,7 +738,8 @@ with col2:
                     st.session_state.messages.insert(0, {
                         "role": "assistant",
                         "content": full_response,
-                        "sources": sources
+                        "sources": sources,
+                        "metrics": metrics
                     })
                     
                 except Exception as e:
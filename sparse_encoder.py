@@ -0,0 +1,96 @@
+"""
+Sparse Encoder Module
+Vettori sparsi BM25 per la ricerca ibrida: il documento contribuisce con la
+componente di frequenza dei termini, mentre l'IDF viene calcolato da Qdrant
+sulla collection (sparse vector con modifier IDF).
+"""
+
+import re
+import unicodedata
+import zlib
+from collections import Counter
+
+
+# Parole e codici composti (es. "INV-2024/001", "v1.2"): il composto viene
+# indicizzato insieme alle sue parti, così si trova con entrambe le grafie
+_TOKEN_RE = re.compile(r"\w+(?:[-./_]\w+)*", re.UNICODE)
+_PART_RE = re.compile(r"[-./_]")
+
+
+def tokenize(text):
+    """
+    Divide un testo nei termini usati da BM25
+
+    Args:
+        text: Testo da dividere
+
+    Returns:
+        Lista di termini minuscoli e senza accenti
+    """
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    terms = []
+    for match in _TOKEN_RE.finditer(text):
+        term = match.group()
+        terms.append(term)
+        if _PART_RE.search(term):
+            terms.extend(part for part in _PART_RE.split(term) if part)
+    return terms
+
+
+def term_index(term):
+    """Indice (uint32) della dimensione sparsa di un termine"""
+    return zlib.crc32(term.encode("utf-8"))
+
+
+class BM25Encoder:
+    """Codifica testi e query in vettori sparsi BM25 (indici, valori)"""
+
+    def __init__(self, k1=1.2, b=0.75, avg_len=100):
+        """
+        Args:
+            k1: Saturazione della frequenza dei termini (default: 1.2)
+            b: Peso della normalizzazione per lunghezza (default: 0.75)
+            avg_len: Lunghezza media (in termini) dei chunk indicizzati; circa 100
+                     per chunk da 500 caratteri
+        """
+        self.k1 = k1
+        self.b = b
+        self.avg_len = avg_len
+
+    def _weights(self, counts, length):
+        """Pesi BM25 dei termini a partire dalle loro frequenze"""
+        norm = self.k1 * (1 - self.b + self.b * length / self.avg_len)
+        weights = {}
+        for term, tf in counts.items():
+            index = term_index(term)
+            # Due termini con lo stesso hash sommano i pesi
+            weights[index] = weights.get(index, 0.0) + tf * (self.k1 + 1) / (tf + norm)
+        return weights
+
+    def encode_document(self, text):
+        """
+        Vettore sparso di un chunk da indicizzare
+
+        Args:
+            text: Testo del chunk
+
+        Returns:
+            Tuple (indici, valori); liste vuote se il testo non contiene termini
+        """
+        terms = tokenize(text)
+        weights = self._weights(Counter(terms), len(terms))
+        return list(weights), list(weights.values())
+
+    def encode_query(self, text):
+        """
+        Vettore sparso di una query: ogni termine pesa 1, l'IDF lo applica Qdrant
+
+        Args:
+            text: Testo della query
+
+        Returns:
+            Tuple (indici, valori)
+        """
+        indices = sorted({term_index(term) for term in tokenize(text)})
+        return indices, [1.0] * len(indices)
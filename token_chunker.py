@@ -0,0 +1,226 @@
+"""
+Token Chunker Module
+Chunking basato sui token del modello di embedding, con allineamento ai
+confini di frase o paragrafo. Lavora sugli offset del testo: ogni chunk viene
+estratto con una sola slice, senza copie intermedie.
+"""
+
+import re
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken è opzionale: senza, i token vengono stimati
+    tiktoken = None
+
+
+# Stima dei token senza tiktoken: parole spezzate ogni 4 caratteri e punteggiatura
+_APPROX_TOKEN_RE = re.compile(r"\s*\w{1,4}|\s*[^\w\s]|\s+")
+
+_PARAGRAPH_RE = re.compile(r"\n[ \t]*\n\s*")
+# Fine frase, oppure a capo (voci di elenco, titoli)
+_SENTENCE_RE = re.compile(r"[.!?…]+[\"'»”)\]]*\s+|\n\s*")
+
+
+@lru_cache(maxsize=8)
+def get_encoding(embedding_model):
+    """
+    Restituisce l'encoding tiktoken del modello di embedding
+
+    Args:
+        embedding_model: Nome del modello di embedding
+
+    Returns:
+        Encoding tiktoken, oppure None se tiktoken non è installato
+    """
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(embedding_model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def token_offsets(text, embedding_model="text-embedding-3-small"):
+    """
+    Calcola l'offset (in caratteri) di inizio di ogni token del testo
+
+    Args:
+        text: Testo da tokenizzare
+        embedding_model: Nome del modello di embedding
+
+    Returns:
+        Lista non decrescente di offset, uno per token
+    """
+    encoding = get_encoding(embedding_model)
+    if encoding is None:
+        return [match.start() for match in _APPROX_TOKEN_RE.finditer(text)]
+    _, offsets = encoding.decode_with_offsets(encoding.encode(text, disallowed_special=()))
+    return offsets
+
+
+def count_tokens(text, embedding_model="text-embedding-3-small"):
+    """
+    Conta i token di un testo per il modello di embedding
+
+    Args:
+        text: Testo da contare
+        embedding_model: Nome del modello di embedding
+
+    Returns:
+        Numero di token (esatto con tiktoken, stimato altrimenti)
+    """
+    encoding = get_encoding(embedding_model)
+    if encoding is None:
+        return sum(1 for _ in _APPROX_TOKEN_RE.finditer(text))
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def _boundaries(text, offsets, pattern):
+    """Indici dei token con cui inizia una frase (o un paragrafo)"""
+    boundaries = []
+    for match in pattern.finditer(text):
+        # Il token può includere lo spazio che lo precede (es. " The")
+        index = bisect_right(offsets, match.end()) - 1
+        if index < 0 or offsets[index] < match.start():
+            index += 1
+        if not boundaries or boundaries[-1] != index:
+            boundaries.append(index)
+    return boundaries
+
+
+def _snap(boundaries, low, high):
+    """Ultimo confine nell'intervallo (low, high], oppure None"""
+    index = bisect_left(boundaries, high + 1) - 1
+    if index >= 0 and boundaries[index] > low:
+        return boundaries[index]
+    return None
+
+
+def _iter_spans(text, chunk_tokens, overlap_tokens, embedding_model, snap, final):
+    """
+    Calcola gli intervalli dei chunk di un testo
+
+    Se final è False si ferma prima degli ultimi token (che potrebbero
+    continuare nel testo successivo) e restituisce l'offset da cui riprendere.
+
+    Yields:
+        Tuple (inizio, fine, numero_token) in caratteri
+
+    Returns:
+        Offset del primo carattere non ancora assegnato a un chunk
+    """
+    offsets = token_offsets(text, embedding_model)
+    num_tokens = len(offsets)
+    paragraphs = _boundaries(text, offsets, _PARAGRAPH_RE) if snap == "paragraph" else []
+    sentences = _boundaries(text, offsets, _SENTENCE_RE) if snap else []
+    if paragraphs:
+        sentences = sorted(set(sentences) | set(paragraphs))
+
+    start = 0
+    while start < num_tokens:
+        end = start + chunk_tokens
+        if not final and end + chunk_tokens > num_tokens:
+            return offsets[start]
+        end = min(end, num_tokens)
+
+        if end < num_tokens and snap:
+            # Taglia sull'ultimo confine nella seconda metà del chunk
+            low = start + chunk_tokens // 2
+            end = _snap(paragraphs, low, end) or _snap(sentences, low, end) or end
+
+        char_end = offsets[end] if end < num_tokens else len(text)
+        yield offsets[start], char_end, end - start
+        if end >= num_tokens:
+            break
+
+        # L'overlap riparte, se possibile, dall'inizio di una frase
+        next_start = max(end - overlap_tokens, start + 1)
+        if snap and overlap_tokens:
+            index = bisect_left(sentences, next_start)
+            if index < len(sentences) and sentences[index] < end:
+                next_start = sentences[index]
+        start = next_start
+    return len(text)
+
+
+def iter_token_chunks(pieces, chunk_tokens=256, overlap_tokens=32,
+                      embedding_model="text-embedding-3-small", snap="paragraph"):
+    """
+    Divide in chunk di chunk_tokens token un testo che arriva a pezzi (es. pagine)
+
+    Ogni chunk ha al massimo chunk_tokens token e, se snap è attivo, termina
+    sull'ultimo confine di paragrafo o frase della sua seconda metà. I chunk
+    consecutivi condividono circa overlap_tokens token.
+
+    Args:
+        pieces: Iterabile di stringhe consecutive del testo
+        chunk_tokens: Numero massimo di token per chunk (default: 256)
+        overlap_tokens: Token di sovrapposizione tra chunk consecutivi (default: 32)
+        embedding_model: Modello di embedding di cui usare il tokenizer
+        snap: "paragraph" (paragrafi, poi frasi), "sentence" oppure None (taglio esatto)
+
+    Yields:
+        Tuple (testo, numero_token)
+    """
+    for chunk, num_tokens, _ in iter_token_chunk_offsets(pieces, chunk_tokens, overlap_tokens, embedding_model, snap):
+        yield chunk, num_tokens
+
+
+def iter_token_chunk_offsets(pieces, chunk_tokens=256, overlap_tokens=32,
+                             embedding_model="text-embedding-3-small", snap="paragraph"):
+    """
+    Come iter_token_chunks, ma restituisce anche la posizione di ogni chunk
+
+    Yields:
+        Tuple (testo, numero_token, offset) dove offset è la posizione (in
+        caratteri) del primo carattere del chunk nel testo concatenato
+    """
+    if chunk_tokens < 1:
+        raise ValueError("chunk_tokens deve essere almeno 1")
+    if not 0 <= overlap_tokens < chunk_tokens:
+        raise ValueError("overlap_tokens deve essere compreso tra 0 e chunk_tokens - 1")
+    if snap not in (None, "sentence", "paragraph"):
+        raise ValueError("snap deve essere None, 'sentence' o 'paragraph'")
+
+    # Si tokenizza solo quando il buffer contiene abbastanza testo per più chunk
+    min_buffer = 16 * chunk_tokens
+    buffer = ""
+    # Offset nel testo concatenato del primo carattere del buffer
+    buffer_offset = 0
+    for piece in pieces:
+        buffer += piece
+        if len(buffer) < min_buffer:
+            continue
+        consumed = yield from _yield_chunks(
+            buffer, buffer_offset, chunk_tokens, overlap_tokens, embedding_model, snap, False
+        )
+        buffer = buffer[consumed:]
+        buffer_offset += consumed
+    yield from _yield_chunks(buffer, buffer_offset, chunk_tokens, overlap_tokens, embedding_model, snap, True)
+
+
+def _yield_chunks(text, text_offset, chunk_tokens, overlap_tokens, embedding_model, snap, final):
+    """Estrae i chunk non vuoti (con il loro offset) dagli intervalli calcolati da _iter_spans"""
+    spans = _iter_spans(text, chunk_tokens, overlap_tokens, embedding_model, snap, final)
+    while True:
+        try:
+            start, end, num_tokens = next(spans)
+        except StopIteration as stop:
+            return stop.value
+        stripped = text[start:end].lstrip()
+        chunk = stripped.rstrip()
+        if chunk:
+            yield chunk, num_tokens, text_offset + end - len(stripped)
+
+
+def token_chunk_text(text, chunk_tokens=256, overlap_tokens=32,
+                     embedding_model="text-embedding-3-small", snap="paragraph"):
+    """
+    Divide il testo in chunk basati sui token (vedi iter_token_chunks)
+
+    Returns:
+        Lista di chunk di testo
+    """
+    return [chunk for chunk, _ in iter_token_chunks([text], chunk_tokens, overlap_tokens, embedding_model, snap)]